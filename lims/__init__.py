@@ -91,10 +91,12 @@ def register():
         notebook.NotebookLine,
         notebook.NotebookLineAllFields,
         notebook.NotebookLineProfessional,
+        notebook.NotebookSummary,
         control_tendency.RangeType,
         results_report.ResultsReportVersion,
         results_report.ResultsReportVersionDetail,
         results_report.ResultsReportCachedReport,
+        results_report.ResultsReportCachedGlobalReport,
         results_report.ResultsReportComment,
         results_report.ResultsReportVersionDetailSigner,
         results_report.ResultsReportVersionDetailSample,
@@ -194,6 +196,7 @@ def register():
         control_tendency.TrendChartAnalysis2,
         control_tendency.OpenTrendChartStart,
         control_tendency.TrendChartData,
+        control_tendency.PlotCache,
         module='lims', type_='model')
     Pool.register(
         results_report.DivideReportsStart,
@@ -5,6 +5,7 @@
 import logging
 import operator
 import json
+from collections import defaultdict
 from datetime import datetime, date
 from decimal import Decimal
 from sql import Literal
@@ -17,6 +18,8 @@ from trytond.report import Report
 from trytond.pool import Pool
 from trytond.transaction import Transaction
 from trytond.pyson import PYSONEncoder, Eval, Equal, Bool, Not, Or, And
+from trytond.cache import Cache
+from trytond.tools import grouped_slice
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 
@@ -1018,6 +1021,8 @@ class Analysis(Workflow, ModelSQL, ModelView):
     estimated_waiting_report = fields.Integer('Number of days for Reporting',
         help='Estimated number of days needed to report the result of the '
             'analysis')
+    _included_cache = Cache('lims.analysis.included_graph',
+        size_limit=10240, context=False)
 
     @classmethod
     def __setup__(cls):
@@ -1124,79 +1129,148 @@ class Analysis(Workflow, ModelSQL, ModelView):
             ]
 
     @classmethod
-    def get_included_analysis(cls, analysis_id):
+    def get_included_edges(cls, analysis_ids, parents=False):
+        '''
+        Return for each analysis the edges of its included analysis
+        graph, resolved with one recursive query per batch of analysis:
+        (analysis, included analysis, method, type, code) or, if parents,
+        the edges of its active parents graph: (analysis, parent)
+        '''
         cursor = Transaction().connection.cursor()
         pool = Pool()
         AnalysisIncluded = pool.get('lims.analysis.included')
+        Analysis = pool.get('lims.analysis')
+
+        kind = 'parents' if parents else 'childs'
+        result, missing = {}, []
+        for analysis_id in set(analysis_ids):
+            edges = cls._included_cache.get((kind, analysis_id))
+            if edges is None:
+                missing.append(analysis_id)
+            else:
+                result[analysis_id] = edges
+
+        for sub_ids in grouped_slice(missing):
+            sub_ids = list(sub_ids)
+            roots_ids = ', '.join(str(a) for a in sub_ids)
+            if parents:
+                cursor.execute('WITH RECURSIVE parents '
+                        '(root, id, analysis, included_analysis) AS ('
+                        'SELECT ia.included_analysis, ia.id, ia.analysis, '
+                            'ia.included_analysis '
+                        'FROM "' + AnalysisIncluded._table + '" ia '
+                            'INNER JOIN "' + Analysis._table + '" a '
+                            'ON a.id = ia.analysis '
+                        'WHERE ia.included_analysis IN (' + roots_ids + ') '
+                            'AND a.state = \'active\' '
+                        'UNION '
+                        'SELECT p.root, ia.id, ia.analysis, '
+                            'ia.included_analysis '
+                        'FROM "' + AnalysisIncluded._table + '" ia '
+                            'INNER JOIN "' + Analysis._table + '" a '
+                            'ON a.id = ia.analysis '
+                            'INNER JOIN parents p '
+                            'ON ia.included_analysis = p.analysis '
+                        'WHERE a.state = \'active\') '
+                    'SELECT root, included_analysis, analysis '
+                    'FROM parents '
+                    'ORDER BY root, id')
+            else:
+                cursor.execute('WITH RECURSIVE included '
+                        '(root, id, analysis, included_analysis, method) AS ('
+                        'SELECT ia.analysis, ia.id, ia.analysis, '
+                            'ia.included_analysis, ia.method '
+                        'FROM "' + AnalysisIncluded._table + '" ia '
+                        'WHERE ia.analysis IN (' + roots_ids + ') '
+                        'UNION '
+                        'SELECT i.root, ia.id, ia.analysis, '
+                            'ia.included_analysis, ia.method '
+                        'FROM "' + AnalysisIncluded._table + '" ia '
+                            'INNER JOIN included i '
+                            'ON ia.analysis = i.included_analysis) '
+                    'SELECT i.root, i.analysis, i.included_analysis, '
+                        'i.method, a.type, a.code '
+                    'FROM included i '
+                        'INNER JOIN "' + Analysis._table + '" a '
+                        'ON a.id = i.included_analysis '
+                    'ORDER BY i.root, i.id')
+            edges = defaultdict(list)
+            for x in cursor.fetchall():
+                edges[x[0]].append(tuple(x[1:]))
+            for analysis_id in sub_ids:
+                result[analysis_id] = tuple(edges[analysis_id])
+                cls._included_cache.set((kind, analysis_id),
+                    result[analysis_id])
+        return result
+
+    @classmethod
+    def get_included_graph(cls, analysis_id, parents=False):
+        '''
+        Return the included analysis graph of an analysis as a dict:
+        {analysis: [(included analysis, method, type, code), ...]}
+        or, if parents, its active parents graph: {analysis: [parent, ...]}
+        '''
+        edges = cls.get_included_edges([analysis_id], parents=parents)
+        graph = defaultdict(list)
+        for edge in edges[analysis_id]:
+            if parents:
+                graph[edge[0]].append(edge[1])
+            else:
+                graph[edge[0]].append(edge[1:])
+        return graph
+
+    @classmethod
+    def get_included_analysis(cls, analysis_id):
+        graph = cls.get_included_graph(analysis_id)
 
-        childs = []
-        cursor.execute('SELECT included_analysis '
-            'FROM "' + AnalysisIncluded._table + '" '
-            'WHERE analysis = %s', (analysis_id,))
-        included_analysis_ids = [x[0] for x in cursor.fetchall()]
-        for analysis_id in included_analysis_ids:
-            if analysis_id not in childs:
-                childs.append(analysis_id)
-                childs.extend(cls.get_included_analysis(analysis_id))
-        return childs
+        def _get_included_analysis(analysis_id):
+            childs = []
+            for included in graph[analysis_id]:
+                if included[0] not in childs:
+                    childs.append(included[0])
+                    childs.extend(_get_included_analysis(included[0]))
+            return childs
+        return _get_included_analysis(analysis_id)
 
     @classmethod
     def get_included_analysis_analysis(cls, analysis_id):
-        cursor = Transaction().connection.cursor()
-        pool = Pool()
-        AnalysisIncluded = pool.get('lims.analysis.included')
-        Analysis = pool.get('lims.analysis')
+        graph = cls.get_included_graph(analysis_id)
 
-        childs = []
-        cursor.execute('SELECT ia.included_analysis, a.type '
-            'FROM "' + AnalysisIncluded._table + '" ia '
-                'INNER JOIN "' + Analysis._table + '" a '
-                'ON a.id = ia.included_analysis '
-            'WHERE analysis = %s', (analysis_id,))
-        included_analysis = cursor.fetchall()
-        for analysis in included_analysis:
-            if analysis[1] == 'analysis' and analysis[0] not in childs:
-                childs.append(analysis[0])
-            childs.extend(cls.get_included_analysis_analysis(analysis[0]))
-        return childs
+        def _get_included_analysis(analysis_id):
+            childs = []
+            for included in graph[analysis_id]:
+                if included[2] == 'analysis' and included[0] not in childs:
+                    childs.append(included[0])
+                childs.extend(_get_included_analysis(included[0]))
+            return childs
+        return _get_included_analysis(analysis_id)
 
     @classmethod
     def get_included_analysis_method(cls, analysis_id):
-        cursor = Transaction().connection.cursor()
-        pool = Pool()
-        AnalysisIncluded = pool.get('lims.analysis.included')
-
-        childs = []
-        cursor.execute('SELECT included_analysis, method '
-            'FROM "' + AnalysisIncluded._table + '" '
-            'WHERE analysis = %s', (analysis_id,))
-        included_analysis = cursor.fetchall()
-        for analysis in included_analysis:
-            if analysis not in childs:
-                childs.append(analysis)
-            childs.extend(cls.get_included_analysis_method(analysis[0]))
-        return childs
+        graph = cls.get_included_graph(analysis_id)
+
+        def _get_included_analysis(analysis_id):
+            childs = []
+            for included in graph[analysis_id]:
+                analysis = included[:2]
+                if analysis not in childs:
+                    childs.append(analysis)
+                childs.extend(_get_included_analysis(analysis[0]))
+            return childs
+        return _get_included_analysis(analysis_id)
 
     @classmethod
     def get_parents_analysis(cls, analysis_id):
-        cursor = Transaction().connection.cursor()
-        pool = Pool()
-        AnalysisIncluded = pool.get('lims.analysis.included')
-        Analysis = pool.get('lims.analysis')
+        graph = cls.get_included_graph(analysis_id, parents=True)
 
-        parents = []
-        cursor.execute('SELECT ia.analysis '
-            'FROM "' + AnalysisIncluded._table + '" ia '
-                'INNER JOIN "' + Analysis._table + '" a '
-                'ON a.id = ia.analysis '
-            'WHERE ia.included_analysis = %s '
-                'AND a.state = \'active\'', (analysis_id,))
-        parents_analysis_ids = [x[0] for x in cursor.fetchall()]
-        for analysis_id in parents_analysis_ids:
-            if analysis_id not in parents:
-                parents.append(analysis_id)
-                parents.extend(cls.get_parents_analysis(analysis_id))
-        return parents
+        def _get_parents_analysis(analysis_id):
+            parents = []
+            for parent_id in graph[analysis_id]:
+                if parent_id not in parents:
+                    parents.append(parent_id)
+                    parents.extend(_get_parents_analysis(parent_id))
+            return parents
+        return _get_parents_analysis(analysis_id)
 
     def get_rec_name(self, name):
         if self.code:
@@ -1248,6 +1322,18 @@ class Analysis(Workflow, ModelSQL, ModelView):
                     cls.check_duplicate_description(vals.get('type', a.type),
                         vals['description'], a.id)
         super().write(*args)
+        cls._included_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        analysis = super().create(vlist)
+        cls._included_cache.clear()
+        return analysis
+
+    @classmethod
+    def delete(cls, analysis):
+        super().delete(analysis)
+        cls._included_cache.clear()
 
     @classmethod
     @ModelView.button_action('lims.wiz_lims_relate_analysis')
@@ -1604,7 +1690,9 @@ class Analysis(Workflow, ModelSQL, ModelView):
         dates_where += ('AND srv.confirmation_date::date <= \'%s\'::date ' %
             date_to)
 
-        cursor.execute('SELECT DISTINCT(nl.service) '
+        # Services in preplanned planifications are not pending
+        preplanned_clause = ('AND srv.id NOT IN ('
+            'SELECT nl.service '
             'FROM "' + NotebookLine._table + '" nl '
                 'INNER JOIN "' + PlanificationServiceDetail._table +
                 '" psd ON psd.notebook_line = nl.id '
@@ -1612,52 +1700,41 @@ class Analysis(Workflow, ModelSQL, ModelView):
                 'ON psd.detail = pd.id '
                 'INNER JOIN "' + Planification._table + '" p '
                 'ON pd.planification = p.id '
-            'WHERE p.state = \'preplanned\'')
-        planned_services = [s[0] for s in cursor.fetchall()]
-        planned_services_ids = ', '.join(
-            str(s) for s in [0] + planned_services)
-        preplanned_clause = 'AND srv.id NOT IN (%s) ' % planned_services_ids
+            'WHERE p.state = \'preplanned\' '
+                'AND nl.service IS NOT NULL) ')
 
-        cursor.execute('SELECT DISTINCT(d.service) '
+        not_planned_services_clause = ('AND srv.id IN ('
+            'SELECT d.service '
             'FROM "' + EntryDetailAnalysis._table + '" d '
                 'INNER JOIN "' + Analysis._table + '" a '
                 'ON a.id = d.analysis '
             'WHERE d.plannable = TRUE '
                 'AND d.state IN (\'draft\', \'unplanned\') '
-                'AND a.behavior != \'internal_relation\'')
-        not_planned_services = [s[0] for s in cursor.fetchall()]
-        not_planned_services_ids = ', '.join(
-            str(s) for s in [0] + not_planned_services)
-        not_planned_services_clause = ('AND id IN (%s) ' %
-            not_planned_services_ids)
+                'AND a.behavior != \'internal_relation\') ')
+
+        sql_query = ('SELECT srv.analysis, COUNT(srv.id) '
+            'FROM "' + Service._table + '" srv '
+                'INNER JOIN "' + Fraction._table + '" frc '
+                'ON frc.id = srv.fraction '
+            'WHERE frc.confirmed = TRUE ' +
+                dates_where + preplanned_clause +
+                not_planned_services_clause)
 
+        res = {}
         if analysis_ids:
-            all_analysis_ids = analysis_ids
+            for sub_ids in grouped_slice(analysis_ids):
+                sub_ids = list(sub_ids)
+                res.update(dict.fromkeys(sub_ids, 0))
+                cursor.execute(sql_query +
+                    'AND srv.analysis IN (' +
+                        ', '.join(str(a) for a in sub_ids) + ') '
+                    'GROUP BY srv.analysis')
+                res.update(cursor.fetchall())
         else:
             cursor.execute('SELECT id FROM "' + cls._table + '"')
-            all_analysis_ids = [a[0] for a in cursor.fetchall()]
-
-        res = {}
-        for analysis_id in all_analysis_ids:
-            count = 0
-            cursor.execute('SELECT srv.id '
-                'FROM "' + Service._table + '" srv '
-                    'INNER JOIN "' + Fraction._table + '" frc '
-                    'ON frc.id = srv.fraction '
-                'WHERE srv.analysis = %s '
-                    'AND frc.confirmed = TRUE ' +
-                    dates_where + preplanned_clause,
-                (analysis_id,))
-            pending_services = [s[0] for s in cursor.fetchall()]
-            if pending_services:
-                pending_services_ids = ', '.join(str(s) for s in
-                    pending_services)
-                cursor.execute('SELECT COUNT(*) '
-                    'FROM "' + Service._table + '" '
-                    'WHERE id IN (' + pending_services_ids + ') ' +
-                        not_planned_services_clause)
-                count = cursor.fetchone()[0]
-            res[analysis_id] = count
+            res.update(dict.fromkeys((a[0] for a in cursor.fetchall()), 0))
+            cursor.execute(sql_query + 'GROUP BY srv.analysis')
+            res.update(cursor.fetchall())
         return res
 
     @staticmethod
@@ -1783,10 +1860,18 @@ class AnalysisIncluded(ModelSQL, ModelView):
 
     @classmethod
     def create(cls, vlist):
+        Analysis = Pool().get('lims.analysis')
         included_analysis = super().create(vlist)
+        Analysis._included_cache.clear()
         cls.create_typification_calculated(included_analysis)
         return included_analysis
 
+    @classmethod
+    def write(cls, *args):
+        Analysis = Pool().get('lims.analysis')
+        super().write(*args)
+        Analysis._included_cache.clear()
+
     @classmethod
     def create_typification_calculated(cls, included_analysis):
         cursor = Transaction().connection.cursor()
@@ -1881,8 +1966,10 @@ class AnalysisIncluded(ModelSQL, ModelView):
 
     @classmethod
     def delete(cls, included_analysis):
+        Analysis = Pool().get('lims.analysis')
         cls.delete_typification_calculated(included_analysis)
         super().delete(included_analysis)
+        Analysis._included_cache.clear()
 
     @classmethod
     def delete_typification_calculated(cls, included_analysis):
@@ -671,6 +671,10 @@ class Cron(metaclass=PoolMeta):
                     "Lims Process Waiting Planification"),
                 ('lims.trend.chart|clean',
                     "Lims Clean Inactive Trend Charts"),
+                ('lims.notebook.summary|check',
+                    "Lims Check Notebook Summary"),
+                ('lims.results_report.version.detail|cache_reports',
+                    "Lims Cache Released Results Reports"),
                 ])
 
 
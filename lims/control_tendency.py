@@ -2,21 +2,33 @@
 # This file is part of lims module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import hashlib
+import json
 import pandas as pd
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
 from io import BytesIO
 from math import sqrt
-import matplotlib.pyplot as plt
 
+from trytond.config import config
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.wizard import (Wizard, StateTransition, StateView, StateAction,
     StateReport, Button)
 from trytond.pyson import PYSONEncoder, Eval, Bool
 from trytond.pool import Pool
 from trytond.transaction import Transaction
+from trytond.tools import grouped_slice
 from trytond.report import Report
+from trytond.rpc import RPC
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 
+# Format and resolution of the charts plots
+PLOT_FORMAT = config.get('lims', 'plot_format', default='png')
+PLOT_DPI = config.getint('lims', 'plot_dpi', default=300)
+# Days a plot is kept in the plot cache
+PLOT_CACHE_DAYS = config.getint('lims', 'plot_cache_days', default=30)
+
 
 class RangeType(ModelSQL, ModelView):
     'Origins'
@@ -785,286 +797,220 @@ class MeansDeviationsCalc(Wizard):
             return 'result'
         return 'empty'
 
-    def _create_lines(self):
+    def _get_control_results(self, filter_sample=True):
+        '''
+        Read the control results of the search criteria with one query,
+        ordered by end date. Results that are not numbers or are out of
+        the range are skipped.
+        '''
         cursor = Transaction().connection.cursor()
         pool = Pool()
-        ControlResultLine = pool.get('lims.control.result_line')
-        AnalysisFamilyCertificant = pool.get(
-            'lims.analysis.family.certificant')
         NotebookLine = pool.get('lims.notebook.line')
-
-        clause = [
-            ('laboratory', '=', self.start.laboratory.id),
-            ('end_date', '>=', self.start.date_from),
-            ('end_date', '<=', self.start.date_to),
-            ('notebook.fraction.type', '=', self.start.fraction_type.id),
-            ('analysis.behavior', '=', 'normal'),
-            ('concentration_level', '!=', None),
-            ('result', 'not in', [None, '']),
-            ('annulled', '=', False),
-            ]
-        if self.start.product_type:
-            clause.append(('notebook.product_type', '=',
-                self.start.product_type.id))
-        if self.start.matrix:
-            clause.append(('notebook.matrix', '=', self.start.matrix.id))
+        Notebook = pool.get('lims.notebook')
+        Fraction = pool.get('lims.fraction')
+        Sample = pool.get('lims.sample')
+        Analysis = pool.get('lims.analysis')
+
+        sql_query = ('SELECT nl.id, s.product_type, s.matrix, f.type, '
+                'nl.analysis, nl.concentration_level, nl.result, '
+                'nl.end_date, f.id, nl.device '
+            'FROM "' + NotebookLine._table + '" nl '
+                'INNER JOIN "' + Notebook._table + '" n '
+                'ON n.id = nl.notebook '
+                'INNER JOIN "' + Fraction._table + '" f '
+                'ON f.id = n.fraction '
+                'INNER JOIN "' + Sample._table + '" s '
+                'ON s.id = f.sample '
+                'INNER JOIN "' + Analysis._table + '" a '
+                'ON a.id = nl.analysis '
+            'WHERE nl.laboratory = %s '
+                'AND nl.end_date >= %s '
+                'AND nl.end_date <= %s '
+                'AND f.type = %s '
+                'AND a.behavior = \'normal\' '
+                'AND nl.concentration_level IS NOT NULL '
+                'AND nl.result IS NOT NULL '
+                'AND nl.result != \'\' '
+                'AND nl.annulled = FALSE ')
+        params = [self.start.laboratory.id, self.start.date_from,
+            self.start.date_to, self.start.fraction_type.id]
+        if filter_sample and self.start.product_type:
+            sql_query += 'AND s.product_type = %s '
+            params.append(self.start.product_type.id)
+        if filter_sample and self.start.matrix:
+            sql_query += 'AND s.matrix = %s '
+            params.append(self.start.matrix.id)
         if self.start.concentration_level:
-            clause.append(('concentration_level', '=',
-                self.start.concentration_level.id))
-
-        lines = NotebookLine.search(clause,
-            order=[('end_date', 'ASC'), ('id', 'ASC')])
-        if not lines:
-            return []
+            sql_query += 'AND nl.concentration_level = %s '
+            params.append(self.start.concentration_level.id)
+        sql_query += 'ORDER BY nl.end_date ASC, nl.id ASC'
+        cursor.execute(sql_query, params)
 
         range_min = self.start.range_min
         range_max = self.start.range_max
 
-        check_line_family = False
-        if self.start.family:
-            check_line_family = True
-            cursor.execute('SELECT product_type, matrix '
-                'FROM "' + AnalysisFamilyCertificant._table + '" '
-                'WHERE family = %s',
-                (self.start.family.id,))
-            res = cursor.fetchall()
-            families = [(x[0], x[1]) for x in res]
-
-        records = {}
-        for line in lines:
-            if check_line_family:
-                family_key = (line.notebook.product_type.id,
-                    line.notebook.matrix.id)
-                if family_key not in families:
-                    continue
+        results = []
+        for x in cursor.fetchall():
             try:
-                result = float(line.result or None)
+                result = float(x[6] or None)
             except (TypeError, ValueError):
                 continue
             if range_min and result < range_min:
                 continue
             if range_max and result > range_max:
                 continue
-
-            product_type_id = line.notebook.product_type.id
-            matrix_id = line.notebook.matrix.id
-            fraction_type_id = line.notebook.fraction_type.id
-            analysis_id = line.analysis.id
-            concentration_level_id = line.concentration_level.id
-
-            key = (product_type_id, matrix_id, analysis_id,
-                concentration_level_id)
-            if key not in records:
-                records[key] = {
-                    'product_type': product_type_id,
-                    'matrix': matrix_id,
-                    'fraction_type': fraction_type_id,
-                    'analysis': analysis_id,
-                    'concentration_level': concentration_level_id,
-                    'details': {},
-                    'mr_last_result': None,
-                    }
-            mr = (records[key]['mr_last_result'] and
-                abs(result - records[key]['mr_last_result']) or 0.0)
-            records[key]['mr_last_result'] = result
-            records[key]['details'][line.id] = {
-                'date': line.end_date,
-                'fraction': line.notebook.fraction.id,
-                'device': line.device.id if line.device else None,
+            results.append({
+                'line': x[0],
+                'product_type': x[1],
+                'matrix': x[2],
+                'fraction_type': x[3],
+                'analysis': x[4],
+                'concentration_level': x[5],
                 'result': result,
-                'mr': mr,
-                }
-        if not records:
-            return []
-
-        to_create = []
-        for record in records.values():
-            details = [d for d in record['details'].values()]
-            to_create.append({
-                'session_id': self._session_id,
-                'family': None,
-                'product_type': record['product_type'],
-                'matrix': record['matrix'],
-                'fraction_type': record['fraction_type'],
-                'analysis': record['analysis'],
-                'concentration_level': record['concentration_level'],
-                'details': [('create', details)],
-                'date_from': self.start.date_from,
-                'date_to': self.start.date_to,
-                'range_min': range_min,
-                'range_max': range_max,
+                'date': x[7],
+                'fraction': x[8],
+                'device': x[9],
                 })
-        if to_create:
-            res_lines = ControlResultLine.create(to_create)
-
-            to_save = []
-            for line in res_lines:
-                count = 0
-                total = 0.00
-                mr_abs_diff = 0.00
-                for detail in line.details:
-                    count += 1
-                    total += detail.result
-                    mr_abs_diff += detail.mr
-                if count > 2:
-                    mr_avg_abs_diff = round(
-                        mr_abs_diff / (count - 1), 2)
-                else:
-                    mr_avg_abs_diff = mr_abs_diff
-                mean = round(total / count, 2)
-                total = 0.00
-                for detail in line.details:
-                    total += (detail.result - mean) ** 2
-                # Se toma correcion poblacional Bessel n-1
-                if count > 1:
-                    deviation = round(sqrt(total / (count - 1)), 2)
-                else:
-                    deviation = 0.00
-                line.mean = mean
-                line.deviation = deviation
-                line.mr_avg_abs_diff = mr_avg_abs_diff
-                to_save.append(line)
-            ControlResultLine.save(to_save)
-            return res_lines
-        return []
+        return results
 
-    def _create_grouped_lines(self):
+    def _get_families(self, family_id=None):
+        '''
+        Return the (product type, matrix) pairs of each family
+        '''
         cursor = Transaction().connection.cursor()
-        pool = Pool()
-        ControlResultLine = pool.get('lims.control.result_line')
-        AnalysisFamily = pool.get('lims.analysis.family')
-        AnalysisFamilyCertificant = pool.get(
+        AnalysisFamilyCertificant = Pool().get(
             'lims.analysis.family.certificant')
-        NotebookLine = pool.get('lims.notebook.line')
 
-        clause = [
-            ('laboratory', '=', self.start.laboratory.id),
-            ('end_date', '>=', self.start.date_from),
-            ('end_date', '<=', self.start.date_to),
-            ('notebook.fraction.type', '=', self.start.fraction_type.id),
-            ('analysis.behavior', '=', 'normal'),
-            ('concentration_level', '!=', None),
-            ('result', 'not in', [None, '']),
-            ('annulled', '=', False),
-            ]
-        if self.start.concentration_level:
-            clause.append(('concentration_level', '=',
-                self.start.concentration_level.id))
+        sql_query = ('SELECT family, product_type, matrix '
+            'FROM "' + AnalysisFamilyCertificant._table + '"')
+        params = []
+        if family_id:
+            sql_query += ' WHERE family = %s'
+            params.append(family_id)
+        cursor.execute(sql_query, params)
+        families = {}
+        for x in cursor.fetchall():
+            families.setdefault(x[0], set()).add((x[1], x[2]))
+        return families
 
-        lines = NotebookLine.search(clause,
-            order=[('end_date', 'ASC'), ('id', 'ASC')])
-        if not lines:
-            return []
+    def _create_lines(self):
+        results = self._get_control_results()
 
-        range_min = self.start.range_min
-        range_max = self.start.range_max
+        if self.start.family:
+            families = self._get_families(self.start.family.id).get(
+                self.start.family.id, set())
+            results = [r for r in results
+                if (r['product_type'], r['matrix']) in families]
+
+        return self._create_result_lines(results,
+            ['product_type', 'matrix', 'analysis', 'concentration_level'],
+            {'family': None})
+
+    def _create_grouped_lines(self):
+        AnalysisFamily = Pool().get('lims.analysis.family')
+
+        results = self._get_control_results(filter_sample=False)
+        if not results:
+            return []
 
         if self.start.family:
             all_families = [self.start.family]
         else:
             all_families = AnalysisFamily.search([])
+        families = self._get_families(
+            self.start.family and self.start.family.id)
 
-        records = {}
+        grouped_results = []
         for family in all_families:
-            cursor.execute('SELECT product_type, matrix '
-                'FROM "' + AnalysisFamilyCertificant._table + '" '
-                'WHERE family = %s',
-                (family.id,))
-            res = cursor.fetchall()
-            families = [(x[0], x[1]) for x in res]
-
-            for line in lines:
-                family_key = (line.notebook.product_type.id,
-                    line.notebook.matrix.id)
-                if family_key not in families:
-                    continue
-                try:
-                    result = float(line.result or None)
-                except (TypeError, ValueError):
-                    continue
-                if range_min and result < range_min:
-                    continue
-                if range_max and result > range_max:
-                    continue
-
-                family_id = family.id
-                fraction_type_id = line.notebook.fraction_type.id
-                analysis_id = line.analysis.id
-                concentration_level_id = line.concentration_level.id
-
-                key = (family_id, analysis_id, concentration_level_id)
-                if key not in records:
-                    records[key] = {
-                        'family': family_id,
-                        'fraction_type': fraction_type_id,
-                        'analysis': analysis_id,
-                        'concentration_level': concentration_level_id,
-                        'details': {},
-                        'mr_last_result': None,
-                        }
-                mr = (records[key]['mr_last_result'] and
-                    abs(result - records[key]['mr_last_result']) or 0.0)
-                records[key]['mr_last_result'] = result
-                records[key]['details'][line.id] = {
-                    'date': line.end_date,
-                    'fraction': line.notebook.fraction.id,
-                    'device': line.device.id if line.device else None,
-                    'result': result,
-                    'mr': mr,
-                    }
-        if not records:
+            pairs = families.get(family.id, set())
+            grouped_results.extend(dict(r, family=family.id)
+                for r in results if (r['product_type'], r['matrix']) in pairs)
+
+        return self._create_result_lines(grouped_results,
+            ['family', 'analysis', 'concentration_level'],
+            {'product_type': None, 'matrix': None})
+
+    def _create_result_lines(self, results, keys, defaults):
+        '''
+        Group the results by keys and create the result lines with their
+        mean, standard deviation and mobile range average
+        '''
+        pool = Pool()
+        ControlResultLine = pool.get('lims.control.result_line')
+        ControlResultLineDetail = pool.get('lims.control.result_line.detail')
+
+        if not results:
             return []
 
-        to_create = []
-        for record in records.values():
-            details = [d for d in record['details'].values()]
-            to_create.append({
+        df = pd.DataFrame({
+            'result': [r['result'] for r in results],
+            }, dtype=float)
+        for key in keys:
+            df[key] = [r[key] for r in results]
+
+        # Mobile range: difference with the previous result of the group
+        previous = df.groupby(keys, sort=False)['result'].shift()
+        df['mr'] = (df['result'] - previous).abs().where(
+            previous.notnull() & (previous != 0), 0.0)
+
+        stats = df.groupby(keys, sort=False).agg(
+            count=('result', 'count'), total=('result', 'sum'),
+            mr_total=('mr', 'sum'))
+        stats['mean'] = [round(total / count, 2)
+            for total, count in zip(stats['total'], stats['count'])]
+        df = df.join(stats['mean'], on=keys)
+        df['square'] = (df['result'] - df['mean']) ** 2
+        stats['square'] = df.groupby(keys, sort=False)['square'].sum()
+
+        fraction_types = {}
+        for r in results:
+            fraction_types.setdefault(tuple(r[k] for k in keys),
+                r['fraction_type'])
+
+        to_create, lines_keys = [], []
+        for key, count, square, mr_total, mean in zip(stats.index,
+                stats['count'], stats['square'], stats['mr_total'],
+                stats['mean']):
+            key = tuple(int(k) for k in key)
+            count = int(count)
+            # Se toma correcion poblacional Bessel n-1
+            if count > 1:
+                deviation = round(sqrt(square / (count - 1)), 2)
+            else:
+                deviation = 0.00
+            if count > 2:
+                mr_avg_abs_diff = round(mr_total / (count - 1), 2)
+            else:
+                mr_avg_abs_diff = float(mr_total)
+            values = dict(defaults, **dict(zip(keys, key)))
+            values.update({
                 'session_id': self._session_id,
-                'family': record['family'],
-                'product_type': None,
-                'matrix': None,
-                'fraction_type': record['fraction_type'],
-                'analysis': record['analysis'],
-                'concentration_level': record['concentration_level'],
-                'details': [('create', details)],
+                'fraction_type': fraction_types[key],
+                'mean': mean,
+                'deviation': deviation,
+                'mr_avg_abs_diff': mr_avg_abs_diff,
                 'date_from': self.start.date_from,
                 'date_to': self.start.date_to,
-                'range_min': range_min,
-                'range_max': range_max,
+                'range_min': self.start.range_min,
+                'range_max': self.start.range_max,
                 })
-        if to_create:
-            res_lines = ControlResultLine.create(to_create)
-
-            to_save = []
-            for line in res_lines:
-                count = 0
-                total = 0.00
-                mr_abs_diff = 0.00
-                for detail in line.details:
-                    count += 1
-                    total += detail.result
-                    mr_abs_diff += detail.mr
-                if count > 2:
-                    mr_avg_abs_diff = round(
-                        mr_abs_diff / (count - 1), 2)
-                else:
-                    mr_avg_abs_diff = mr_abs_diff
-                mean = round(total / count, 2)
-                total = 0.00
-                for detail in line.details:
-                    total += (detail.result - mean) ** 2
-                # Se toma correcion poblacional Bessel n-1
-                if count > 1:
-                    deviation = round(sqrt(total / (count - 1)), 2)
-                else:
-                    deviation = 0.00
-                line.mean = mean
-                line.deviation = deviation
-                line.mr_avg_abs_diff = mr_avg_abs_diff
-                to_save.append(line)
-            ControlResultLine.save(to_save)
-            return res_lines
-        return []
+            to_create.append(values)
+            lines_keys.append(key)
+        res_lines = ControlResultLine.create(to_create)
+        lines = dict(zip(lines_keys, res_lines))
+
+        details = []
+        for r, mr in zip(results, df['mr'].tolist()):
+            details.append({
+                'line': lines[tuple(r[k] for k in keys)].id,
+                'date': r['date'],
+                'fraction': r['fraction'],
+                'device': r['device'],
+                'result': r['result'],
+                'mr': mr,
+                })
+        ControlResultLineDetail.create(details)
+        return res_lines
 
     def default_result(self, fields):
         lines = [l.id for l in self.result.lines]
@@ -1253,6 +1199,55 @@ class TendenciesAnalysisStart(ModelView):
             return [x[0] for x in cursor.fetchall()]
 
 
+class TendencyRules(object):
+    '''
+    Streaming evaluation of the tendency rules. Each result is compared
+    once with the limits of every rule and the length of the run of
+    consecutive results on the same side is kept, so the rules of a new
+    result are known in constant time. Gives the same rules as
+    TendenciesAnalysis.get_rules on the list of results added so far.
+    '''
+
+    def __init__(self, mean, one_sd, two_sd, three_sd):
+        # rule, upper limit, lower limit, occurrences, total
+        self.rules = [
+            ('4', mean + three_sd, mean - three_sd, 1, 1),
+            ('3', mean + two_sd, mean - two_sd, 2, 3),
+            ('2', mean + one_sd, mean - one_sd, 4, 5),
+            ('1', mean, mean, 8, 8),
+            ]
+        # (side, run length) of the last 'total' results of each rule
+        self.windows = [deque(maxlen=r[4]) for r in self.rules]
+
+    def add(self, result):
+        rules = []
+        for (rule, upper, lower, occurrences, total), window in zip(
+                self.rules, self.windows):
+            if result > upper:
+                side = 1
+            elif result < lower:
+                side = -1
+            else:
+                side = 0
+            run = 0
+            if side:
+                run = 1
+                if window and window[-1][0] == side:
+                    run += window[-1][1]
+            window.append((side, run))
+            if len(window) < total:
+                continue
+            # A run of results on the same side that starts with the
+            # oldest result of the window or with the next one
+            if (window[occurrences - 1][1] >= occurrences or
+                    (occurrences < total and
+                        window[occurrences][1] >= occurrences)):
+                rules.append(rule)
+        if not rules:
+            rules.append('')
+        return rules
+
+
 class TendenciesAnalysisResult(ModelView):
     'Tendencies Analysis'
     __name__ = 'lims.control.tendencies_analysis.result'
@@ -1283,8 +1278,9 @@ class TendenciesAnalysis(Wizard):
         AnalysisFamilyCertificant = pool.get(
             'lims.analysis.family.certificant')
         NotebookLine = pool.get('lims.notebook.line')
-
-        tendency_result = []
+        Notebook = pool.get('lims.notebook')
+        Fraction = pool.get('lims.fraction')
+        Sample = pool.get('lims.sample')
 
         clause = [
             ('fraction_type', '=', self.start.fraction_type.id),
@@ -1312,128 +1308,125 @@ class TendenciesAnalysis(Wizard):
         if not tendencies:
             return 'end'
 
-        check_tendency_family = False
-        if self.start.family and not self.start.group_by_family:
-            check_tendency_family = True
-            cursor.execute('SELECT product_type, matrix '
-                'FROM "' + AnalysisFamilyCertificant._table + '" '
-                'WHERE family = %s',
-                (self.start.family.id,))
-            res = cursor.fetchall()
-            families = [(x[0], x[1]) for x in res]
+        cursor.execute('SELECT family, product_type, matrix '
+            'FROM "' + AnalysisFamilyCertificant._table + '"')
+        families = {}
+        for x in cursor.fetchall():
+            families.setdefault(x[0], set()).add((x[1], x[2]))
 
-        for tendency in tendencies:
-            if check_tendency_family:
-                family_key = (tendency.product_type.id, tendency.matrix.id)
-                if family_key not in families:
-                    continue
+        if self.start.family and not self.start.group_by_family:
+            start_families = families.get(self.start.family.id, set())
+            tendencies = [t for t in tendencies
+                if (t.product_type.id, t.matrix.id) in start_families]
+        if not tendencies:
+            return 'end'
 
-            old_details = ControlTendencyDetail.search([
-                ('tendency', '=', tendency.id),
-                ])
-            if old_details:
-                ControlTendencyDetail.delete(old_details)
+        old_details = ControlTendencyDetail.search([
+            ('tendency', 'in', [t.id for t in tendencies]),
+            ])
+        if old_details:
+            ControlTendencyDetail.delete(old_details)
+
+        sql_select = ('SELECT nl.id, nl.analysis, nl.concentration_level, '
+                's.product_type, s.matrix, nl.result, nl.end_date, f.id, '
+                'nl.device '
+            'FROM "' + NotebookLine._table + '" nl '
+                'INNER JOIN "' + Notebook._table + '" n '
+                'ON n.id = nl.notebook '
+                'INNER JOIN "' + Fraction._table + '" f '
+                'ON f.id = n.fraction '
+                'INNER JOIN "' + Sample._table + '" s '
+                'ON s.id = f.sample '
+            'WHERE nl.laboratory = %s '
+                'AND f.type = %s '
+                'AND nl.result IS NOT NULL '
+                'AND nl.result != \'\' '
+                'AND nl.annulled = FALSE ')
+
+        # Lines of all the tendencies, grouped by tendency key
+        analysis_ids = ', '.join(str(i) for i in
+            set(t.analysis.id for t in tendencies))
+        cursor.execute(sql_select +
+                'AND nl.analysis IN (' + analysis_ids + ') '
+                'AND nl.end_date >= %s '
+                'AND nl.end_date <= %s '
+            'ORDER BY nl.end_date ASC, nl.id ASC',
+            (self.start.laboratory.id, self.start.fraction_type.id,
+                self.start.date_from, self.start.date_to))
+        lines_by_key = defaultdict(list)
+        for x in cursor.fetchall():
+            lines_by_key[(x[1], x[2])].append(x)
 
-            check_line_family = False
+        tendency_result = []
+        to_create = []
+        to_write = []
+        for tendency in tendencies:
+            key = (tendency.analysis.id, tendency.concentration_level.id)
             if tendency.family:
-                check_line_family = True
-                cursor.execute('SELECT product_type, matrix '
-                    'FROM "' + AnalysisFamilyCertificant._table + '" '
-                    'WHERE family = %s',
-                    (tendency.family.id,))
-                res = cursor.fetchall()
-                tendency_families = [(x[0], x[1]) for x in res]
-
-            clause = [
-                ('laboratory', '=', self.start.laboratory.id),
-                ('notebook.fraction.type', '=', tendency.fraction_type.id),
-                ('analysis', '=', tendency.analysis.id),
-                ('concentration_level', '=', tendency.concentration_level.id),
-                ('result', 'not in', [None, '']),
-                ('annulled', '=', False),
-                ]
-            if not check_line_family:
-                clause.extend([
-                    ('notebook.product_type', '=', tendency.product_type.id),
-                    ('notebook.matrix', '=', tendency.matrix.id),
-                    ])
-
-            rule_1_count = 0
-            rule_2_count = 0
-            rule_3_count = 0
-            rule_4_count = 0
-            all_lines = NotebookLine.search(clause + [
-                    ('end_date', '>=', self.start.date_from),
-                    ('end_date', '<=', self.start.date_to),
-                    ], order=[('end_date', 'ASC'), ('id', 'ASC')])
-            if not check_line_family:
-                lines = all_lines
+                tendency_families = families.get(tendency.family.id, set())
+                lines = [x for x in lines_by_key[key]
+                    if (x[3], x[4]) in tendency_families]
             else:
-                lines = []
-                for line in all_lines:
-                    family_key = (line.notebook.product_type.id,
-                        line.notebook.matrix.id)
-                    if family_key in tendency_families:
-                        lines.append(line)
+                lines = [x for x in lines_by_key[key]
+                    if x[3] == tendency.product_type.id and
+                    x[4] == tendency.matrix.id]
+
+            counts = {'1': 0, '2': 0, '3': 0, '4': 0}
             if lines:
-                results = []
+                tendency_rules = TendencyRules(tendency.mean,
+                    tendency.one_sd_adj, tendency.two_sd_adj,
+                    tendency.three_sd_adj)
                 prevs = 8 - len(lines)  # Qty of previous results required
                 if prevs > 0:
-                    all_prev_lines = NotebookLine.search(clause + [
-                            ('end_date', '<', self.start.date_from),
-                            ], order=[('end_date', 'ASC'), ('id', 'ASC')],
-                            limit=prevs)
-                    if not check_line_family:
-                        prev_lines = all_prev_lines
-                    else:
-                        prev_lines = []
-                        for line in all_prev_lines:
-                            family_key = (line.notebook.product_type.id,
-                                line.notebook.matrix.id)
-                            if family_key in tendency_families:
-                                prev_lines.append(line)
-                    if prev_lines:
-                        for line in prev_lines:
-                            try:
-                                result = float(line.result if
-                                    line.result else None)
-                            except(TypeError, ValueError):
-                                continue
-                            results.append(result)
+                    sql_query = (sql_select +
+                        'AND nl.analysis = %s '
+                        'AND nl.concentration_level = %s '
+                        'AND nl.end_date < %s ')
+                    params = [self.start.laboratory.id,
+                        tendency.fraction_type.id, tendency.analysis.id,
+                        tendency.concentration_level.id,
+                        self.start.date_from]
+                    if not tendency.family:
+                        sql_query += ('AND s.product_type = %s '
+                            'AND s.matrix = %s ')
+                        params.extend([tendency.product_type.id,
+                            tendency.matrix.id])
+                    cursor.execute(sql_query +
+                        'ORDER BY nl.end_date ASC, nl.id ASC '
+                        'LIMIT %s', params + [prevs])
+                    for x in cursor.fetchall():
+                        if (tendency.family and
+                                (x[3], x[4]) not in tendency_families):
+                            continue
+                        try:
+                            result = float(x[5] if x[5] else None)
+                        except(TypeError, ValueError):
+                            continue
+                        tendency_rules.add(result)
 
                 mr_last_result = None
-                to_create = []
-                for line in lines:
+                for x in lines:
                     try:
-                        result = float(line.result if
-                            line.result else None)
+                        result = float(x[5] if x[5] else None)
                     except(TypeError, ValueError):
                         continue
                     mr = (mr_last_result and
                           abs(result - mr_last_result) or 0.0)
                     mr_last_result = result
-                    results.append(result)
-                    rules = self.get_rules(results, tendency)
+                    rules = tendency_rules.add(result)
                     rules_to_create = []
                     for r in rules:
                         if r == '':
                             continue
                         rules_to_create.append({'rule': r})
-                        if r == '1':
-                            rule_1_count += 1
-                        elif r == '2':
-                            rule_2_count += 1
-                        elif r == '3':
-                            rule_3_count += 1
-                        elif r == '4':
-                            rule_4_count += 1
+                        counts[r] += 1
 
                     record = {
-                        'notebook_line': line.id,
+                        'notebook_line': x[0],
                         'tendency': tendency.id,
-                        'date': line.end_date,
-                        'fraction': line.notebook.fraction.id,
-                        'device': line.device.id if line.device else None,
+                        'date': x[6],
+                        'fraction': x[7],
+                        'device': x[8],
                         'result': result,
                         'rule': rules[0],
                         'mr': mr,
@@ -1441,16 +1434,18 @@ class TendenciesAnalysis(Wizard):
                     if rules_to_create:
                         record['rules'] = [('create', rules_to_create)]
                     to_create.append(record)
-
-                ControlTendencyDetail.create(to_create)
                 tendency_result.append(tendency)
 
-            ControlTendency.write([tendency], {
-                'rule_1_count': rule_1_count,
-                'rule_2_count': rule_2_count,
-                'rule_3_count': rule_3_count,
-                'rule_4_count': rule_4_count,
-                })
+            to_write.extend(([tendency], {
+                'rule_1_count': counts['1'],
+                'rule_2_count': counts['2'],
+                'rule_3_count': counts['3'],
+                'rule_4_count': counts['4'],
+                }))
+
+        if to_create:
+            ControlTendencyDetail.create(to_create)
+        ControlTendency.write(*to_write)
 
         if tendency_result:
             self.result.tendencies = tendency_result
@@ -1604,6 +1599,12 @@ class ControlChartReport(Report):
     'Control Chart'
     __name__ = 'lims.control_chart.report'
 
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        # The plot cache is filled while rendering
+        cls.__rpc__['execute'] = RPC(False)
+
     @classmethod
     def get_context(cls, records, header, data):
         pool = Pool()
@@ -1663,6 +1664,13 @@ class ControlChartReport(Report):
 
     @classmethod
     def _get_plot(cls, columns, records):
+        PlotCache = Pool().get('lims.plot.cache')
+        key = PlotCache.get_key(cls.__name__, columns, records)
+        return PlotCache.get_plot(key,
+            lambda: cls._render_plot(columns, records))
+
+    @classmethod
+    def _render_plot(cls, columns, records):
         index = columns
         cols = []
         ds = {}
@@ -1700,7 +1708,8 @@ class ControlChartReport(Report):
                     figsize=(10, 7.5), marker='o', linestyle='-', ax=ax)
 
             ax.legend(loc='center left', bbox_to_anchor=(1.0, 0.5))
-            ax.get_figure().savefig(output, bbox_inches='tight', dpi=300)
+            ax.get_figure().savefig(output, bbox_inches='tight',
+                dpi=PLOT_DPI, format=PLOT_FORMAT)
             image = output.getvalue()
             output.close()
             return image
@@ -1892,6 +1901,7 @@ class TrendChart(ModelSQL, ModelView):
     def get_plot(self, session_id):
         pool = Pool()
         TrendChartData = pool.get('lims.trend.chart.data')
+        PlotCache = pool.get('lims.plot.cache')
 
         index = []
         cols, cols_y2 = {}, {}
@@ -1923,6 +1933,16 @@ class TrendChart(ModelSQL, ModelView):
                 ds2[a_description].append(float(val)
                     if val is not None else None)
 
+        key = PlotCache.get_key(self.__name__, index,
+            list(cols.values()), ds, list(cols_y2.values()), ds2,
+            self.x_axis_string, self.uom and self.uom.symbol,
+            self.uom_y2 and self.uom_y2.symbol)
+        return PlotCache.get_plot(key,
+            lambda: self._render_plot(index, cols, ds, cols_y2, ds2))
+
+    def _render_plot(self, index, cols, ds, cols_y2, ds2):
+        import matplotlib.pyplot as plt
+
         df = pd.DataFrame(ds, index=index)
         df = df.reindex(cols.values(), axis=1)
         try:
@@ -1978,7 +1998,8 @@ class TrendChart(ModelSQL, ModelView):
                     axis.legend(handles, labels, loc=loc[i], fontsize=14)
                     i += 1
 
-                ax.get_figure().savefig(output, bbox_inches='tight', dpi=300)
+                ax.get_figure().savefig(output, bbox_inches='tight',
+                    dpi=PLOT_DPI, format=PLOT_FORMAT)
                 image = output.getvalue()
                 output.close()
             return image
@@ -2012,7 +2033,7 @@ class TrendChart(ModelSQL, ModelView):
                         i += 1
 
                     ax.get_figure().savefig(output, bbox_inches='tight',
-                        dpi=300)
+                        dpi=PLOT_DPI, format=PLOT_FORMAT)
                     image = output.getvalue()
                     output.close()
                     return image
@@ -2023,11 +2044,54 @@ class TrendChart(ModelSQL, ModelView):
 
     @classmethod
     def clean(cls):
-        TrendChartData = Pool().get('lims.trend.chart.data')
+        pool = Pool()
+        TrendChartData = pool.get('lims.trend.chart.data')
+        PlotCache = pool.get('lims.plot.cache')
         to_delete = cls.search([('active', '=', False)])
         cls.delete(to_delete)
         to_delete = TrendChartData.search([])
         TrendChartData.delete(to_delete)
+        PlotCache.clean()
+
+
+class PlotCache(ModelSQL):
+    'Plot Cache'
+    __name__ = 'lims.plot.cache'
+
+    key = fields.Char('Key', required=True, select=True)
+    image = fields.Binary('Image', file_id='image_id', store_prefix='plot')
+    image_id = fields.Char('Image id')
+
+    @staticmethod
+    def get_key(*data):
+        '''
+        Hash of the plotted data, the chart options and the rendering
+        parameters
+        '''
+        data = json.dumps([PLOT_FORMAT, PLOT_DPI] + list(data),
+            sort_keys=True, default=str)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def get_plot(cls, key, render):
+        '''
+        Return the cached plot of key or store the one returned by render
+        '''
+        plots = cls.search([('key', '=', key)], limit=1)
+        if plots:
+            return plots[0].image
+        image = render()
+        # Read-only callers render the plot without storing it
+        if image and not Transaction().readonly:
+            with Transaction().set_user(0):
+                cls.create([{'key': key, 'image': image}])
+        return image
+
+    @classmethod
+    def clean(cls):
+        limit = datetime.now() - timedelta(days=PLOT_CACHE_DAYS)
+        to_delete = cls.search([('create_date', '<', limit)])
+        cls.delete(to_delete)
 
 
 class TrendChartAnalysis(ModelSQL, ModelView):
@@ -2092,7 +2156,6 @@ class OpenTrendChart(Wizard):
         pool = Pool()
         TrendChartData = pool.get('lims.trend.chart.data')
         Notebook = pool.get('lims.notebook')
-        NotebookLine = pool.get('lims.notebook.line')
 
         session_id = self._session_id
         cursor.execute('DELETE FROM "' + TrendChartData._table + '" '
@@ -2103,45 +2166,25 @@ class OpenTrendChart(Wizard):
         order = self._get_order()
         reportable_analysis = self._get_reportable_analysis()
 
-        records = []
+        columns = []
+        for a in list(chart.analysis) + list(chart.analysis_y2):
+            columns.append(a.analysis.id
+                if a.analysis.id in reportable_analysis else None)
+
         notebooks = Notebook.search(clause, order=order, limit=chart.quantity)
         notebooks.reverse()
+        results = self._get_results([n.id for n in notebooks],
+            [a_id for a_id in columns if a_id])
+
+        records = []
         for notebook in notebooks:
             record = {
                 'session_id': session_id,
                 'x_axis': self._get_x_axis(notebook),
                 }
-            i = 1
-            for a in chart.analysis:
-                record['analysis%s' % str(i)] = None
-                if a.analysis.id not in reportable_analysis:
-                    i += 1
-                    continue
-                line = NotebookLine.search([
-                    ('notebook', '=', notebook),
-                    ('analysis', '=', a.analysis),
-                    ('accepted', '=', True),
-                    ('result', 'not in', [None, '']),
-                    ])
-                if line:
-                    record['analysis%s' % str(i)] = line[0].result.replace(
-                        ',', '.')
-                i += 1
-            for a in chart.analysis_y2:
-                record['analysis%s' % str(i)] = None
-                if a.analysis.id not in reportable_analysis:
-                    i += 1
-                    continue
-                line = NotebookLine.search([
-                    ('notebook', '=', notebook),
-                    ('analysis', '=', a.analysis),
-                    ('accepted', '=', True),
-                    ('result', 'not in', [None, '']),
-                    ])
-                if line:
-                    record['analysis%s' % str(i)] = line[0].result.replace(
-                        ',', '.')
-                i += 1
+            for i, analysis_id in enumerate(columns, 1):
+                record['analysis%s' % str(i)] = results.get(
+                    (notebook.id, analysis_id))
             records.append(record)
         TrendChartData.create(records)
 
@@ -2149,6 +2192,38 @@ class OpenTrendChart(Wizard):
             return 'open'
         return 'end'
 
+    def _get_results(self, notebook_ids, analysis_ids):
+        '''
+        Return the first accepted result of each notebook and analysis
+        '''
+        cursor = Transaction().connection.cursor()
+        NotebookLine = Pool().get('lims.notebook.line')
+
+        res = {}
+        if not notebook_ids or not analysis_ids:
+            return res
+
+        all_analysis_ids = ', '.join(str(a) for a in set(analysis_ids))
+        for sub_notebooks in grouped_slice(notebook_ids):
+            all_notebook_ids = ', '.join(str(n) for n in sub_notebooks)
+            cursor.execute('SELECT notebook, analysis, result '
+                'FROM ('
+                    'SELECT nl.notebook, nl.analysis, nl.result, '
+                        'ROW_NUMBER() OVER (PARTITION BY nl.notebook, '
+                        'nl.analysis ORDER BY nl.repetition ASC, '
+                        'nl.id ASC) AS rn '
+                    'FROM "' + NotebookLine._table + '" nl '
+                    'WHERE nl.notebook IN (' + all_notebook_ids + ') '
+                        'AND nl.analysis IN (' + all_analysis_ids + ') '
+                        'AND nl.accepted = TRUE '
+                        'AND nl.result IS NOT NULL '
+                        'AND nl.result != \'\''
+                    ') r '
+                'WHERE rn = 1')
+            for notebook_id, analysis_id, result in cursor.fetchall():
+                res[(notebook_id, analysis_id)] = result.replace(',', '.')
+        return res
+
     def _get_clause(self):
         chart = self.start.chart
         notebook = self.start.notebook
@@ -2283,6 +2358,12 @@ class TrendChartReport(Report):
     'Trend Chart'
     __name__ = 'lims.trend.chart.report'
 
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        # The plot cache is filled while rendering
+        cls.__rpc__['execute'] = RPC(False)
+
     @classmethod
     def get_context(cls, records, header, data):
         TrendChart = Pool().get('lims.trend.chart')
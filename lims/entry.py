@@ -8,7 +8,7 @@ from email import encoders
 from email.mime.base import MIMEBase
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from sql import Literal
+from sql import Literal, Table
 
 from trytond.model import Workflow, Model, ModelView, ModelSQL, fields, Unique
 from trytond.wizard import Wizard, StateTransition, StateView, StateReport, \
@@ -16,7 +16,7 @@ from trytond.wizard import Wizard, StateTransition, StateView, StateReport, \
 from trytond.pool import Pool
 from trytond.pyson import Eval, Equal, Bool, Not, If
 from trytond.transaction import Transaction
-from trytond.tools import get_smtp_server
+from trytond.tools import get_smtp_server, grouped_slice
 from trytond.config import config as tconfig
 from trytond.report import Report
 from trytond.rpc import RPC
@@ -1290,12 +1290,63 @@ class EntryDetailAnalysis(ModelSQL, ModelView):
             if not notebooks:
                 return
             notebook = notebooks[0]
+        if not details:
+            return
+
+        product_type_id = fraction.product_type.id
+        method_ids = list(set(d.method.id for d in details))
+        analysis_ids = list(set(d.analysis.id for d in details))
+        party_ids = list(set(d.party.id for d in details))
+
+        typifications = {}
+        all_method_ids = ', '.join(str(m) for m in method_ids)
+        for sub_analysis in grouped_slice(analysis_ids):
+            all_analysis_ids = ', '.join(str(a) for a in sub_analysis)
+            cursor.execute('SELECT analysis, method, id '
+                'FROM "' + Typification._table + '" '
+                'WHERE product_type = %s '
+                    'AND matrix = %s '
+                    'AND analysis IN (' + all_analysis_ids + ') '
+                    'AND method IN (' + all_method_ids + ') '
+                    'AND valid',
+                (product_type_id, fraction.matrix.id))
+            for analysis_id, method_id, t_id in cursor.fetchall():
+                typifications.setdefault((analysis_id, method_id), t_id)
+        typifications = dict(zip(typifications.keys(),
+            Typification.browse(list(typifications.values()))))
+
+        waiting_times = {}
+        all_party_ids = ', '.join(str(p) for p in party_ids)
+        cursor.execute('SELECT method, party, results_estimated_waiting '
+            'FROM "' + WaitingTime._table + '" '
+            'WHERE method IN (' + all_method_ids + ') '
+                'AND party IN (' + all_party_ids + ')')
+        for method_id, party_id, waiting in cursor.fetchall():
+            waiting_times.setdefault((method_id, party_id), waiting)
+        cursor.execute('SELECT id, results_estimated_waiting '
+            'FROM "' + Method._table + '" '
+            'WHERE id IN (' + all_method_ids + ')')
+        methods_waiting = dict(cursor.fetchall())
+
+        departments = {}
+        for sub_analysis in grouped_slice(analysis_ids):
+            all_analysis_ids = ', '.join(str(a) for a in sub_analysis)
+            cursor.execute('SELECT analysis, laboratory, department '
+                'FROM "' + AnalysisLaboratory._table + '" '
+                'WHERE analysis IN (' + all_analysis_ids + ') '
+                'ORDER BY by_default DESC')
+            for analysis_id, laboratory_id, department in cursor.fetchall():
+                departments.setdefault((analysis_id, laboratory_id),
+                    department)
+        cursor.execute('SELECT department '
+            'FROM "' + ProductType._table + '" '
+            'WHERE id = %s', (product_type_id,))
+        product_type_department = cursor.fetchone()[0]
 
         lines_to_create = []
+        lines_typification = []
         for detail in details:
-            t = Typification.get_valid_typification(
-                fraction.product_type.id, fraction.matrix.id,
-                detail.analysis.id, detail.method.id)
+            t = typifications.get((detail.analysis.id, detail.method.id))
 
             if t:
                 repetitions = t.default_repetitions
@@ -1330,40 +1381,17 @@ class EntryDetailAnalysis(ModelSQL, ModelView):
                 report = False
                 department = None
 
-            results_estimated_waiting = None
-            cursor.execute('SELECT results_estimated_waiting '
-                'FROM "' + WaitingTime._table + '" '
-                'WHERE method = %s '
-                    'AND party = %s',
-                (detail.method.id, detail.party.id))
-            res = cursor.fetchone()
-            if res:
-                results_estimated_waiting = res[0]
+            key = (detail.method.id, detail.party.id)
+            if key in waiting_times:
+                results_estimated_waiting = waiting_times[key]
             else:
-                cursor.execute('SELECT results_estimated_waiting '
-                    'FROM "' + Method._table + '" '
-                    'WHERE id = %s', (detail.method.id,))
-                res = cursor.fetchone()
-                if res:
-                    results_estimated_waiting = res[0]
+                results_estimated_waiting = methods_waiting.get(
+                    detail.method.id)
 
             if not department:
-                cursor.execute('SELECT department '
-                    'FROM "' + AnalysisLaboratory._table + '" '
-                    'WHERE analysis = %s '
-                        'AND laboratory = %s '
-                    'ORDER BY by_default DESC',
-                    (detail.analysis.id, detail.laboratory.id))
-                res = cursor.fetchone()
-                if res and res[0]:
-                    department = res[0]
-                else:
-                    cursor.execute('SELECT department '
-                        'FROM "' + ProductType._table + '" '
-                        'WHERE id = %s', (fraction.product_type.id,))
-                    res = cursor.fetchone()
-                    if res and res[0]:
-                        department = res[0]
+                department = (departments.get(
+                        (detail.analysis.id, detail.laboratory.id)) or
+                    product_type_department or None)
 
             for i in range(0, repetitions + 1):
                 notebook_line = {
@@ -1394,34 +1422,55 @@ class EntryDetailAnalysis(ModelSQL, ModelView):
                     'department': department,
                     }
                 lines_to_create.append(notebook_line)
+                lines_typification.append(t and t.id)
 
         with Transaction().set_user(0):
             lines = NotebookLine.create(lines_to_create)
 
             # copy translated fields from typification
             default_language = Config(1).results_report_language
-            for line in lines:
-                t = Typification.get_valid_typification(
-                    line.product_type.id, line.matrix.id,
-                    line.analysis.id, line.method.id)
-                if not t:
-                    continue
-                for field in ['initial_concentration', 'final_concentration',
-                        'literal_final_concentration']:
-                    cursor.execute("SELECT lang, src, value "
-                        "FROM ir_translation "
-                        "WHERE name = %s "
-                            "AND res_id = %s "
-                            "AND type = 'model' "
-                            "AND lang != %s",
-                        ('lims.typification,' + field, str(t.id),
-                            default_language.code))
-                    for x in cursor.fetchall():
-                        cursor.execute("INSERT INTO ir_translation "
-                            "(name, res_id, type, lang, src, value) "
-                            "VALUES (%s, %s, 'model', %s, %s, %s)",
-                            ('lims.notebook.line,' + field, str(line.id),
-                                x[0], x[1], x[2]))
+            cls._copy_typification_translations(
+                list(zip(lines, lines_typification)), default_language)
+
+    @classmethod
+    def _copy_typification_translations(cls, lines, default_language):
+        '''
+        Copy the translations of the typifications concentrations to the
+        notebook lines, lines is a list of (notebook line, typification id)
+        '''
+        cursor = Transaction().connection.cursor()
+        translation = Table('ir_translation')
+
+        fields = ['initial_concentration', 'final_concentration',
+            'literal_final_concentration']
+        typification_ids = list(set(t_id for _, t_id in lines if t_id))
+        if not typification_ids:
+            return
+
+        translations = {}
+        for sub_ids in grouped_slice(typification_ids):
+            cursor.execute(*translation.select(
+                translation.res_id, translation.name, translation.lang,
+                translation.src, translation.value,
+                where=translation.name.in_(
+                    ['lims.typification,' + f for f in fields]) &
+                translation.res_id.in_(list(sub_ids)) &
+                (translation.type == 'model') &
+                (translation.lang != default_language.code)))
+            for res_id, name, lang, src, value in cursor.fetchall():
+                field = name.split(',', 1)[1]
+                translations.setdefault(res_id, []).append(
+                    ('lims.notebook.line,' + field, lang, src, value))
+
+        values = []
+        for line, t_id in lines:
+            for name, lang, src, value in translations.get(t_id, []):
+                values.append([name, line.id, 'model', lang, src, value])
+        columns = [translation.name, translation.res_id, translation.type,
+            translation.lang, translation.src, translation.value]
+        for sub_values in grouped_slice(values):
+            cursor.execute(*translation.insert(columns,
+                    values=list(sub_values)))
 
     @staticmethod
     def default_service_view():
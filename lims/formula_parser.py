@@ -2,37 +2,78 @@
 # This file is part of lims module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+from functools import lru_cache
 
 from trytond.model import Model
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 
+CONSTANTS = {
+    'pi': 3.141592653589793,
+    'e': 2.718281828459045,
+    }
+
 
 class FormulaParser(Model):
     'Formula Parser'
-    __slots__ = ('_string', '_index', '_vars')
+    __slots__ = ('_string', '_vars')
 
     def __init__(self, string, vars={}, id=None, **kwargs):
         self._string = string.replace('{', '').replace('}', '')
-        self._index = 0
-        self._vars = {
-            'pi': 3.141592653589793,
-            'e': 2.718281828459045,
-            }
-        for var in list(vars.keys()):
-            if self._vars.get(var) is not None:
-                raise UserError(gettext(
-                    'lims.msg_variable_redefine', variable=var))
-            self._vars[var] = vars[var]
+        self._vars = _get_variables(vars)
         super().__init__(id, **kwargs)
 
     def getValue(self):
-        value = self.parseExpression()
+        return compile_formula(self._string)(self._vars)
+
+
+def _get_variables(vars):
+    variables = CONSTANTS.copy()
+    for var in list(vars.keys()):
+        if variables.get(var) is not None:
+            raise UserError(gettext(
+                'lims.msg_variable_redefine', variable=var))
+        variables[var] = vars[var]
+    return variables
+
+
+@lru_cache(maxsize=1024)
+def compile_formula(string):
+    '''
+    Compile a formula into a function of a variables mapping.
+    The result is cached by formula text, so the parse cost is paid
+    once per distinct formula.
+    '''
+    return _FormulaCompiler(
+        string.replace('{', '').replace('}', '')).compile()
+
+
+def evaluate_many(formula, rows):
+    '''
+    Evaluate a formula against each variables mapping in rows
+    '''
+    expression = compile_formula(formula)
+    return [expression(_get_variables(vars)) for vars in rows]
+
+
+class _FormulaCompiler(object):
+    '''
+    Recursive-descent parser that builds a tree of closures instead of
+    evaluating the formula while it reads it
+    '''
+    __slots__ = ('_string', '_index')
+
+    def __init__(self, string):
+        self._string = string
+        self._index = 0
+
+    def compile(self):
+        expression = self.parseExpression()
         self.skipWhitespace()
         if self.hasNext():
             raise UserError(gettext('lims.msg_unexpected_character',
                 character=self.peek(), index=str(self._index)))
-        return value
+        return expression
 
     def peek(self):
         return self._string[self._index:self._index + 1]
@@ -51,43 +92,52 @@ class FormulaParser(Model):
         return self.parseAddition()
 
     def parseAddition(self):
-        values = [self.parseMultiplication()]
+        terms = [(1, self.parseMultiplication())]
         while True:
             self.skipWhitespace()
             char = self.peek()
             if char == '+':
                 self._index += 1
-                values.append(self.parseMultiplication())
+                terms.append((1, self.parseMultiplication()))
             elif char == '-':
                 self._index += 1
-                values.append(-1 * self.parseMultiplication())
+                terms.append((-1, self.parseMultiplication()))
             else:
                 break
-        return sum(values)
+        if len(terms) == 1:
+            return terms[0][1]
+
+        def addition(vars):
+            return sum(sign * term(vars) for sign, term in terms)
+        return addition
 
     def parseMultiplication(self):
-        values = [self.parsePower()]
+        factors = [(False, self.parsePower())]
         while True:
             self.skipWhitespace()
             char = self.peek()
             if char == '*':
                 self._index += 1
-                values.append(self.parsePower())
+                factors.append((False, self.parsePower()))
             elif char == '/':
-                # div_index = self._index
                 self._index += 1
-                denominator = self.parsePower()
-                if denominator == 0:
-                    # raise UserError(gettext(
-                    #     'lims.msg_division_zero', index=str(div_index)))
-                    return 0.0
-                values.append(1.0 / denominator)
+                factors.append((True, self.parsePower()))
             else:
                 break
-        value = 1.0
-        for factor in values:
-            value *= factor
-        return value
+        if len(factors) == 1:
+            return factors[0][1]
+
+        def multiplication(vars):
+            value = 1.0
+            for divide, factor in factors:
+                factor = factor(vars)
+                if divide:
+                    if factor == 0:
+                        return 0.0
+                    factor = 1.0 / factor
+                value *= factor
+            return value
+        return multiplication
 
     def parsePower(self):
         values = [self.parseParenthesis()]
@@ -99,23 +149,28 @@ class FormulaParser(Model):
                 values.append(self.parseParenthesis())
             else:
                 break
-        value = values[0]
-        for exponent in values[1:]:
-            value **= exponent
-        return value
+        if len(values) == 1:
+            return values[0]
+
+        def power(vars):
+            value = values[0](vars)
+            for exponent in values[1:]:
+                value **= exponent(vars)
+            return value
+        return power
 
     def parseParenthesis(self):
         self.skipWhitespace()
         char = self.peek()
         if char == '(':
             self._index += 1
-            value = self.parseExpression()
+            expression = self.parseExpression()
             self.skipWhitespace()
             if self.peek() != ')':
                 raise UserError(gettext(
                     'lims.msg_closing_parenthesis', index=str(self._index)))
             self._index += 1
-            return value
+            return expression
         else:
             return self.parseNegative()
 
@@ -124,7 +179,8 @@ class FormulaParser(Model):
         char = self.peek()
         if char == '-':
             self._index += 1
-            return -1 * self.parseParenthesis()
+            operand = self.parseParenthesis()
+            return lambda vars: -1 * operand(vars)
         else:
             return self.parseValue()
 
@@ -132,7 +188,8 @@ class FormulaParser(Model):
         self.skipWhitespace()
         char = self.peek()
         if char in '0123456789.':
-            return self.parseNumber()
+            value = self.parseNumber()
+            return lambda vars: value
         else:
             return self.parseVariable()
 
@@ -147,17 +204,19 @@ class FormulaParser(Model):
             else:
                 break
 
-        value = self._vars.get(var, None)
-        if value is None:
-            raise UserError(gettext(
-                'lims.msg_unrecognized_variable', variable=var))
-        if value == '':
-            return float(0)
-        try:
-            value = float(value)
-        except (ValueError):
-            return float(0)
-        return value
+        def variable(vars):
+            value = vars.get(var, None)
+            if value is None:
+                raise UserError(gettext(
+                    'lims.msg_unrecognized_variable', variable=var))
+            if value == '':
+                return float(0)
+            try:
+                value = float(value)
+            except (ValueError):
+                return float(0)
+            return value
+        return variable
 
     def parseNumber(self):
         self.skipWhitespace()
@@ -2,6 +2,7 @@
 # This file is part of lims module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import logging
 import operator
 import re
 from collections import defaultdict
@@ -9,17 +10,22 @@ from datetime import datetime
 from dateutil.relativedelta import relativedelta
 from sql import Literal, Join
 
-from trytond.model import ModelView, ModelSQL, fields
+from trytond import backend
+from trytond.model import ModelView, ModelSQL, Unique, fields
 from trytond.wizard import Wizard, StateTransition, StateView, StateAction, \
     StateReport, Button
 from trytond.pool import Pool
 from trytond.pyson import PYSONEncoder, Eval, Bool, Not, Or
 from trytond.transaction import Transaction
+from trytond.tools import grouped_slice
 from trytond.report import Report
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 from .configuration import get_print_date
 from .formula_parser import FormulaParser
+from .state_queue import defer_state, get_state_queue, flush_state_queue
+
+logger = logging.getLogger(__name__)
 
 
 class Notebook(ModelSQL, ModelView):
@@ -296,7 +302,18 @@ class Notebook(ModelSQL, ModelView):
             for n in notebooks:
                 result[n.id] = None
             return result
+        pool = Pool()
+        NotebookSummary = pool.get('lims.notebook.summary')
+
+        in_progress_column = cls._get_samples_in_progress_column()
+        summary = NotebookSummary.get_summary([n.id for n in notebooks],
+            laboratory_id)
         for n in notebooks:
+            counters = summary.get(n.id)
+            if not counters or not (counters['lines_accepted'] or
+                    counters[in_progress_column]):
+                result[n.id] = None
+                continue
             result[n.id] = cls._get_notebook_state(n.id, laboratory_id)
         return result
 
@@ -398,12 +415,20 @@ class Notebook(ModelSQL, ModelView):
         Fraction = pool.get('lims.fraction')
         FractionType = pool.get('lims.fraction.type')
         EntryDetailAnalysis = pool.get('lims.entry.detail.analysis')
+        NotebookSummary = pool.get('lims.notebook.summary')
 
         laboratory_id = Transaction().context.get(
             'samples_pending_reporting_laboratory', None)
         if not laboratory_id:
             return []
 
+        # Only notebooks with accepted lines pending reporting can be complete
+        candidates_ids = NotebookSummary.search_notebooks(laboratory_id,
+            'lines_accepted')
+        if not candidates_ids:
+            return []
+        candidates_ids = ', '.join(str(n) for n in candidates_ids)
+
         draft_lines_ids = ResultsLine.get_draft_lines_ids(laboratory_id)
         draft_lines_ids = ', '.join(str(l) for l in [0] + draft_lines_ids)
 
@@ -416,6 +441,7 @@ class Notebook(ModelSQL, ModelView):
                 'INNER JOIN "' + FractionType._table + '" ft '
                 'ON ft.id = f.type '
             'WHERE nl.laboratory = %s '
+                'AND nl.notebook IN (' + candidates_ids + ') '
                 'AND ft.report = TRUE '
                 'AND nl.report = TRUE '
                 'AND nl.annulled = FALSE '
@@ -423,7 +449,7 @@ class Notebook(ModelSQL, ModelView):
                 'AND nl.accepted = TRUE '
                 'AND nl.id NOT IN (' + draft_lines_ids + ') ')
         cursor.execute(sql_query, (laboratory_id,))
-        notebooks_ids = [x[0] for x in cursor.fetchall()]
+        notebooks_ids = list(set(x[0] for x in cursor.fetchall()))
 
         excluded_notebooks = cls._get_excluded_notebooks(notebooks_ids,
             laboratory_id)
@@ -440,7 +466,7 @@ class Notebook(ModelSQL, ModelView):
                     for l in [0] + excluded_lines)
                 sql_query += 'AND nl.id NOT IN (' + excluded_lines_ids + ') '
             cursor.execute(sql_query, (laboratory_id,))
-            notebooks_ids = [x[0] for x in cursor.fetchall()]
+            notebooks_ids = list(set(x[0] for x in cursor.fetchall()))
         return notebooks_ids
 
     @classmethod
@@ -512,16 +538,23 @@ class Notebook(ModelSQL, ModelView):
         Fraction = pool.get('lims.fraction')
         FractionType = pool.get('lims.fraction.type')
         ResultModifier = pool.get('lims.result_modifier')
+        NotebookSummary = pool.get('lims.notebook.summary')
 
         laboratory_id = Transaction().context.get(
             'samples_pending_reporting_laboratory', None)
         if not laboratory_id:
             return []
 
+        candidates_ids = NotebookSummary.search_notebooks(laboratory_id,
+            cls._get_samples_in_progress_column())
+        if not candidates_ids:
+            return []
+        candidates_ids = ', '.join(str(n) for n in candidates_ids)
+
         draft_lines_ids = ResultsLine.get_draft_lines_ids(laboratory_id)
         draft_lines_ids = ', '.join(str(l) for l in [0] + draft_lines_ids)
 
-        sql_query = ('SELECT nl.notebook '
+        sql_query = ('SELECT DISTINCT(nl.notebook) '
             'FROM "' + NotebookLine._table + '" nl '
                 'INNER JOIN "' + Notebook._table + '" n '
                 'ON n.id = nl.notebook '
@@ -532,6 +565,7 @@ class Notebook(ModelSQL, ModelView):
                 'LEFT JOIN "' + ResultModifier._table + '" rm '
                 'ON rm.id = nl.result_modifier '
             'WHERE nl.laboratory = %s '
+                'AND nl.notebook IN (' + candidates_ids + ') '
                 'AND ft.report = TRUE '
                 'AND nl.report = TRUE '
                 'AND nl.annulled = FALSE '
@@ -563,6 +597,20 @@ class Notebook(ModelSQL, ModelView):
                 ]]
         return clause
 
+    @classmethod
+    def _get_samples_in_progress_column(cls):
+        '''
+        Notebook summary counter of the lines that put a notebook
+        in progress
+        '''
+        Config = Pool().get('lims.configuration')
+        samples_in_progress = Config(1).samples_in_progress
+        if samples_in_progress == 'accepted':
+            return 'lines_accepted'
+        elif samples_in_progress == 'result':
+            return 'lines_result'
+        return 'lines_pending'
+
     @classmethod
     def _get_samples_in_progress_sql_clause(cls):
         Config = Pool().get('lims.configuration')
@@ -812,6 +860,188 @@ class Notebook(ModelSQL, ModelView):
         return [('fraction.sample.entry.number',) + tuple(clause[1:])]
 
 
+class NotebookSummary(ModelSQL):
+    'Laboratory Notebook Summary'
+    __name__ = 'lims.notebook.summary'
+
+    notebook = fields.Many2One('lims.notebook', 'Laboratory notebook',
+        required=True, ondelete='CASCADE', select=True)
+    laboratory = fields.Many2One('lims.laboratory', 'Laboratory',
+        ondelete='CASCADE', select=True)
+    lines_pending = fields.Integer('Lines pending reporting')
+    lines_accepted = fields.Integer('Accepted lines pending reporting')
+    lines_draft = fields.Integer('Not accepted lines pending reporting')
+    lines_result = fields.Integer('Lines pending reporting with result')
+    lines_reported = fields.Integer('Reported lines')
+    lines_annulled = fields.Integer('Annulled lines')
+    last_end_date = fields.Date('Last end date')
+    last_acceptance_date = fields.DateTime('Last acceptance date')
+
+    _counters = ['lines_pending', 'lines_accepted', 'lines_draft',
+        'lines_result', 'lines_reported', 'lines_annulled']
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('notebook_laboratory_uniq', Unique(t, t.notebook, t.laboratory),
+                'lims.msg_notebook_summary_unique_id'),
+            ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        exist = backend.TableHandler.table_exist(cls._table)
+        super().__register__(module_name)
+        if not exist:
+            cls.rebuild()
+
+    @classmethod
+    def _get_summary_query(cls, notebook_ids=None, audit=False):
+        pool = Pool()
+        NotebookLine = pool.get('lims.notebook.line')
+        Notebook = pool.get('lims.notebook')
+        Fraction = pool.get('lims.fraction')
+        FractionType = pool.get('lims.fraction.type')
+        ResultModifier = pool.get('lims.result_modifier')
+
+        pending = ('ft.report = TRUE '
+            'AND nl.report = TRUE '
+            'AND nl.annulled = FALSE '
+            'AND nl.results_report IS NULL')
+        with_result = ('((nl.result IS NOT NULL '
+            'AND nl.result != \'\') '
+            'OR (nl.literal_result IS NOT NULL '
+            'AND nl.literal_result != \'\') '
+            'OR rm.code IN '
+            '(\'d\', \'nd\', \'pos\', \'neg\', '
+            '\'ni\', \'abs\', \'pre\', \'na\'))')
+
+        sql_query = ('SELECT nl.notebook, nl.laboratory, '
+                'SUM(CASE WHEN ' + pending + ' '
+                    'THEN 1 ELSE 0 END), '
+                'SUM(CASE WHEN ' + pending + ' AND nl.accepted = TRUE '
+                    'THEN 1 ELSE 0 END), '
+                'SUM(CASE WHEN ' + pending + ' AND nl.accepted = FALSE '
+                    'THEN 1 ELSE 0 END), '
+                'SUM(CASE WHEN ' + pending + ' AND ' + with_result + ' '
+                    'THEN 1 ELSE 0 END), '
+                'SUM(CASE WHEN nl.results_report IS NOT NULL '
+                    'THEN 1 ELSE 0 END), '
+                'SUM(CASE WHEN nl.annulled = TRUE '
+                    'THEN 1 ELSE 0 END), '
+                'MAX(nl.end_date), MAX(nl.acceptance_date) ')
+        if audit:
+            sql_query += ', %s, %s '
+        sql_query += ('FROM "' + NotebookLine._table + '" nl '
+                'INNER JOIN "' + Notebook._table + '" n '
+                'ON n.id = nl.notebook '
+                'INNER JOIN "' + Fraction._table + '" f '
+                'ON f.id = n.fraction '
+                'INNER JOIN "' + FractionType._table + '" ft '
+                'ON ft.id = f.type '
+                'LEFT JOIN "' + ResultModifier._table + '" rm '
+                'ON rm.id = nl.result_modifier ')
+        if notebook_ids is not None:
+            sql_query += 'WHERE nl.notebook IN (%s) ' % ', '.join(
+                str(n) for n in notebook_ids)
+        sql_query += 'GROUP BY nl.notebook, nl.laboratory'
+        return sql_query
+
+    @classmethod
+    def update_notebooks(cls, notebook_ids):
+        notebook_ids = list(set(notebook_ids))
+        if not notebook_ids:
+            return
+        if defer_state():
+            get_state_queue().notebooks.update(notebook_ids)
+            return
+        cls._update_notebooks(notebook_ids)
+
+    @classmethod
+    def _update_notebooks(cls, notebook_ids=None):
+        '''
+        Recompute the summary rows of the notebooks (all of them if None)
+        '''
+        cursor = Transaction().connection.cursor()
+
+        columns = ('notebook, laboratory, ' + ', '.join(cls._counters) +
+            ', last_end_date, last_acceptance_date, create_uid, create_date')
+        if notebook_ids is None:
+            sub_ids_list = [None]
+        else:
+            sub_ids_list = (list(sub_ids)
+                for sub_ids in grouped_slice(notebook_ids))
+        for sub_ids in sub_ids_list:
+            if sub_ids is None:
+                cursor.execute('DELETE FROM "' + cls._table + '"')
+            else:
+                cursor.execute('DELETE FROM "' + cls._table + '" '
+                    'WHERE notebook IN (%s)' % ', '.join(
+                        str(n) for n in sub_ids))
+            sql_query = cls._get_summary_query(sub_ids, audit=True)
+            cursor.execute('INSERT INTO "' + cls._table + '" '
+                '(' + columns + ') ' + sql_query,
+                (Transaction().user, datetime.now()))
+
+    @classmethod
+    def rebuild(cls):
+        cls._update_notebooks()
+
+    @classmethod
+    def check(cls):
+        '''
+        Compare the summary with the notebook lines and refresh the
+        notebooks whose counters drifted. Return their ids.
+        '''
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(cls._get_summary_query())
+        expected = {(x[0], x[1]): tuple(x[2:8]) for x in cursor.fetchall()}
+        cursor.execute('SELECT notebook, laboratory, ' +
+            ', '.join(cls._counters) + ' '
+            'FROM "' + cls._table + '"')
+        current = {(x[0], x[1]): tuple(x[2:8]) for x in cursor.fetchall()}
+
+        notebook_ids = set(key[0] for key in
+            set(expected.keys()) ^ set(current.keys()))
+        notebook_ids.update(key[0] for key, counters in expected.items()
+            if key in current and current[key] != counters)
+        if notebook_ids:
+            logger.warning('Notebook summary out of date for %s notebooks',
+                len(notebook_ids))
+            cls._update_notebooks(list(notebook_ids))
+        return sorted(notebook_ids)
+
+    @classmethod
+    def get_summary(cls, notebook_ids, laboratory_id):
+        cursor = Transaction().connection.cursor()
+
+        result = {}
+        for sub_ids in grouped_slice(notebook_ids):
+            cursor.execute('SELECT notebook, ' +
+                ', '.join(cls._counters) + ' '
+                'FROM "' + cls._table + '" '
+                'WHERE laboratory = %s '
+                    'AND notebook IN (' + ', '.join(
+                        str(n) for n in sub_ids) + ')',
+                (laboratory_id,))
+            for x in cursor.fetchall():
+                result[x[0]] = dict(zip(cls._counters, x[1:]))
+        return result
+
+    @classmethod
+    def search_notebooks(cls, laboratory_id, counter):
+        cursor = Transaction().connection.cursor()
+        assert counter in cls._counters
+        cursor.execute('SELECT notebook '
+            'FROM "' + cls._table + '" '
+            'WHERE laboratory = %s '
+                'AND ' + counter + ' > 0',
+            (laboratory_id,))
+        return [x[0] for x in cursor.fetchall()]
+
+
 class NotebookLine(ModelSQL, ModelView):
     'Laboratory Notebook Line'
     __name__ = 'lims.notebook.line'
@@ -1014,6 +1244,11 @@ class NotebookLine(ModelSQL, ModelView):
 
     del _states, _depends
 
+    # Fields counted by the notebook summary
+    _summary_fields = {'notebook', 'laboratory', 'report', 'annulled',
+        'accepted', 'results_report', 'result', 'literal_result',
+        'result_modifier', 'end_date', 'acceptance_date'}
+
     @classmethod
     def __register__(cls, module_name):
         cursor = Transaction().connection.cursor()
@@ -1097,6 +1332,7 @@ class NotebookLine(ModelSQL, ModelView):
         pool = Pool()
         LabMethod = pool.get('lims.lab.method')
         Sample = pool.get('lims.sample')
+        NotebookSummary = pool.get('lims.notebook.summary')
 
         vlist = [x.copy() for x in vlist]
         for values in vlist:
@@ -1110,6 +1346,7 @@ class NotebookLine(ModelSQL, ModelView):
         cls.update_detail_report(lines)
         sample_ids = list(set(nl.sample.id for nl in lines))
         Sample.update_samples_state(sample_ids)
+        NotebookSummary.update_notebooks([nl.notebook.id for nl in lines])
         return lines
 
     @classmethod
@@ -1117,17 +1354,24 @@ class NotebookLine(ModelSQL, ModelView):
         pool = Pool()
         LabMethod = pool.get('lims.lab.method')
         Sample = pool.get('lims.sample')
+        NotebookSummary = pool.get('lims.notebook.summary')
 
         actions = iter(args)
         args = []
+        summary_notebook_ids = set()
         for lines, values in zip(actions, actions):
             # set method version
             if 'method' in values and values['method'] is not None:
                 values['method_version'] = LabMethod(
                     values['method']).get_current_version()
             args.extend((lines, values))
+            if cls._summary_fields & set(values.keys()):
+                summary_notebook_ids.update(nl.notebook.id for nl in lines)
+                if values.get('notebook'):
+                    summary_notebook_ids.add(values['notebook'])
 
         super().write(*args)
+        NotebookSummary.update_notebooks(summary_notebook_ids)
 
         actions = iter(args)
         for lines, vals in zip(actions, actions):
@@ -1155,6 +1399,13 @@ class NotebookLine(ModelSQL, ModelView):
             if update_referrals_state:
                 cls.update_referrals_state(lines)
 
+    @classmethod
+    def delete(cls, lines):
+        NotebookSummary = Pool().get('lims.notebook.summary')
+        notebook_ids = [nl.notebook.id for nl in lines]
+        super().delete(lines)
+        NotebookSummary.update_notebooks(notebook_ids)
+
     @staticmethod
     def update_detail_analysis(lines, accepted):
         EntryDetailAnalysis = Pool().get('lims.entry.detail.analysis')
@@ -1188,15 +1439,25 @@ class NotebookLine(ModelSQL, ModelView):
 
     @staticmethod
     def update_detail_report(lines):
+        NotebookLine = Pool().get('lims.notebook.line')
+        details_ids = list(set(nl.analysis_detail.id for nl in lines))
+        if defer_state():
+            get_state_queue().details.update(details_ids)
+            return
+        NotebookLine._update_detail_report(details_ids)
+
+    @staticmethod
+    def _update_detail_report(details_ids):
         cursor = Transaction().connection.cursor()
         pool = Pool()
         EntryDetailAnalysis = pool.get('lims.entry.detail.analysis')
         NotebookLine = pool.get('lims.notebook.line')
 
         to_save = []
-        details_ids = list(set(nl.analysis_detail.id for nl in lines))
         with Transaction().set_context(_check_access=False):
-            analysis_details = EntryDetailAnalysis.browse(details_ids)
+            analysis_details = EntryDetailAnalysis.search([
+                ('id', 'in', details_ids),
+                ])
         for d in analysis_details:
             cursor.execute('SELECT report '
                 'FROM "' + NotebookLine._table + '" '
@@ -1210,12 +1471,18 @@ class NotebookLine(ModelSQL, ModelView):
 
     @classmethod
     def update_referrals_state(cls, lines):
-        Referral = Pool().get('lims.referral')
-
-        referral_ids = [l.analysis_detail.referral.id
-            for l in lines if l.analysis_detail.referral]
+        referral_ids = list(set(l.analysis_detail.referral.id
+            for l in lines if l.analysis_detail.referral))
         if not referral_ids:
             return
+        if defer_state():
+            get_state_queue().referrals.update(referral_ids)
+            return
+        cls._update_referrals_state(referral_ids)
+
+    @classmethod
+    def _update_referrals_state(cls, referral_ids):
+        Referral = Pool().get('lims.referral')
 
         referrals = Referral.search([
             ('state', '=', 'sent'),
@@ -4296,33 +4563,36 @@ class NotebookLoadResultsFormula(Wizard):
         actions = NotebookLoadResultsFormulaAction.search([
             ('session_id', '=', self._session_id),
             ])
-        for data in actions:
-            notebook_line = NotebookLine(data.line.id)
-            if not notebook_line:
-                continue
-            notebook_line_write = {
-                'result': data.result,
-                'result_modifier': (data.result_modifier.id if
-                    data.result_modifier else None),
-                'end_date': data.end_date,
-                'chromatogram': data.chromatogram,
-                'initial_concentration': data.initial_concentration,
-                'comments': data.comments,
-                'converted_result': None,
-                'converted_result_modifier': None,
-                'backup': None,
-                'verification': None,
-                'uncertainty': None,
-                }
-            if data.result_modifier and data.result_modifier.code == 'na':
-                notebook_line_write['annulled'] = True
-                notebook_line_write['annulment_date'] = datetime.now()
-                notebook_line_write['report'] = False
-            professionals = [{'professional': data.professional.id}]
-            notebook_line_write['professionals'] = (
-                [('delete', [p.id for p in notebook_line.professionals])] +
-                [('create', professionals)])
-            NotebookLine.write([notebook_line], notebook_line_write)
+        # States are recomputed once per sample after the loop
+        with Transaction().set_context(lims_state_recompute='commit'):
+            for data in actions:
+                notebook_line = NotebookLine(data.line.id)
+                if not notebook_line:
+                    continue
+                notebook_line_write = {
+                    'result': data.result,
+                    'result_modifier': (data.result_modifier.id if
+                        data.result_modifier else None),
+                    'end_date': data.end_date,
+                    'chromatogram': data.chromatogram,
+                    'initial_concentration': data.initial_concentration,
+                    'comments': data.comments,
+                    'converted_result': None,
+                    'converted_result_modifier': None,
+                    'backup': None,
+                    'verification': None,
+                    'uncertainty': None,
+                    }
+                if data.result_modifier and data.result_modifier.code == 'na':
+                    notebook_line_write['annulled'] = True
+                    notebook_line_write['annulment_date'] = datetime.now()
+                    notebook_line_write['report'] = False
+                professionals = [{'professional': data.professional.id}]
+                notebook_line_write['professionals'] = (
+                    [('delete', [p.id for p in notebook_line.professionals])] +
+                    [('create', professionals)])
+                NotebookLine.write([notebook_line], notebook_line_write)
+        flush_state_queue()
 
         # Write Supervisors to Notebook lines
         supervisor_lines = {}
@@ -4704,41 +4974,46 @@ class NotebookLoadResultsManual(Wizard):
             ('session_id', '=', self._session_id),
             ])
 
-        for data in actions:
-            notebook_line = NotebookLine(data.line.id)
-            if not notebook_line:
-                continue
-            notebook_line_write = {
-                'result': data.result,
-                'result_modifier': (data.result_modifier.id if
-                    data.result_modifier else None),
-                'chromatogram': data.chromatogram,
-                'initial_unit': (data.initial_unit.id if
-                    data.initial_unit else None),
-                'comments': data.comments,
-                'literal_result': data.literal_result,
-                'converted_result': None,
-                'converted_result_modifier': None,
-                'backup': None,
-                'verification': None,
-                'uncertainty': data.uncertainty,
-                'device': (data.device.id if
-                    data.device else None),
-                }
-            if (not (not data.result_modifier and not data.result) or
-                    data.literal_result):
-                notebook_line_write['end_date'] = data.end_date
-            if data.result_modifier and data.result_modifier.code == 'na':
-                notebook_line_write['annulled'] = True
-                notebook_line_write['annulment_date'] = datetime.now()
-                notebook_line_write['report'] = False
-            if (notebook_line_write.get('end_date') or
-                    notebook_line_write.get('annulment_date')):
-                professionals = [{'professional': self.result.professional.id}]
-                notebook_line_write['professionals'] = (
-                    [('delete', [p.id for p in notebook_line.professionals])] +
-                    [('create', professionals)])
-            NotebookLine.write([notebook_line], notebook_line_write)
+        # States are recomputed once per sample after the loop
+        with Transaction().set_context(lims_state_recompute='commit'):
+            for data in actions:
+                notebook_line = NotebookLine(data.line.id)
+                if not notebook_line:
+                    continue
+                notebook_line_write = {
+                    'result': data.result,
+                    'result_modifier': (data.result_modifier.id if
+                        data.result_modifier else None),
+                    'chromatogram': data.chromatogram,
+                    'initial_unit': (data.initial_unit.id if
+                        data.initial_unit else None),
+                    'comments': data.comments,
+                    'literal_result': data.literal_result,
+                    'converted_result': None,
+                    'converted_result_modifier': None,
+                    'backup': None,
+                    'verification': None,
+                    'uncertainty': data.uncertainty,
+                    'device': (data.device.id if
+                        data.device else None),
+                    }
+                if (not (not data.result_modifier and not data.result) or
+                        data.literal_result):
+                    notebook_line_write['end_date'] = data.end_date
+                if data.result_modifier and data.result_modifier.code == 'na':
+                    notebook_line_write['annulled'] = True
+                    notebook_line_write['annulment_date'] = datetime.now()
+                    notebook_line_write['report'] = False
+                if (notebook_line_write.get('end_date') or
+                        notebook_line_write.get('annulment_date')):
+                    professionals = [{
+                        'professional': self.result.professional.id}]
+                    notebook_line_write['professionals'] = (
+                        [('delete',
+                            [p.id for p in notebook_line.professionals])] +
+                        [('create', professionals)])
+                NotebookLine.write([notebook_line], notebook_line_write)
+        flush_state_queue()
 
         # Write Supervisors to Notebook lines
         supervisor_lines = {}
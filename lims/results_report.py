@@ -2,6 +2,8 @@
 # This file is part of lims module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import json
+import logging
 from io import BytesIO
 from datetime import datetime
 from PyPDF2 import PdfFileMerger
@@ -22,6 +24,8 @@ from trytond import backend
 from .configuration import get_print_date
 from .notebook import NotebookLineRepeatAnalysis
 
+logger = logging.getLogger(__name__)
+
 
 class ResultsReport(ModelSQL, ModelView):
     'Results Report'
@@ -392,10 +396,36 @@ class ResultsReport(ModelSQL, ModelView):
             'WHERE rv.results_report = %s '
                 'AND rd.valid = TRUE '
                 'AND cr.report_language = %s '
-                'AND cr.report_format = \'pdf\'',
+                'AND cr.report_format = \'pdf\' '
+            'ORDER BY rd.id',
             (self.id, language.id))
         return [x[0] for x in cursor.fetchall()]
 
+    def _get_details_not_cached(self, language):
+        cursor = Transaction().connection.cursor()
+        pool = Pool()
+        CachedReport = pool.get('lims.results_report.cached_report')
+        ResultsDetail = pool.get('lims.results_report.version.detail')
+        ResultsVersion = pool.get('lims.results_report.version')
+
+        cursor.execute('SELECT rd.id '
+            'FROM "' + ResultsDetail._table + '" rd '
+                'INNER JOIN "' + ResultsVersion._table + '" rv '
+                'ON rd.report_version = rv.id '
+            'WHERE rv.results_report = %s '
+                'AND rd.valid = TRUE '
+                'AND rd.state = \'released\' '
+                'AND rd.report_language = %s '
+                'AND NOT EXISTS ('
+                    'SELECT 1 FROM "' + CachedReport._table + '" cr '
+                    'WHERE cr.version_detail = rd.id '
+                        'AND cr.report_language = %s '
+                        'AND (cr.report_cache IS NOT NULL '
+                            'OR cr.report_cache_id IS NOT NULL)) '
+            'ORDER BY rd.id',
+            (self.id, language.id, language.id))
+        return [x[0] for x in cursor.fetchall()]
+
     def has_report_cached(self, language):
         return bool(self._get_details_cached(language))
 
@@ -406,6 +436,15 @@ class ResultsReport(ModelSQL, ModelView):
             return ResultsDetail.browse(self._get_details_cached(language))
 
     def build_report(self, language):
+        ResultsDetail = Pool().get('lims.results_report.version.detail')
+
+        # the details are only rendered in their report language
+        details_not_cached = self._get_details_not_cached(language)
+        if details_not_cached:
+            with Transaction().set_user(0):
+                ResultsDetail.generate_reports(
+                    ResultsDetail.browse(details_not_cached))
+
         details = self.details_cached(language)
         if not details:
             raise UserError(gettext('lims.msg_global_report_cache',
@@ -423,26 +462,22 @@ class ResultsReport(ModelSQL, ModelView):
     def _get_global_report(self, details, language):
         pool = Pool()
         CachedReport = pool.get('lims.results_report.cached_report')
+        CachedGlobalReport = pool.get(
+            'lims.results_report.cached_global_report')
 
-        all_cache = []
-        for detail in details:
-            cached_reports = CachedReport.search([
-                ('version_detail', '=', detail.id),
+        cached_reports = {}
+        for cached_report in CachedReport.search([
+                ('version_detail', 'in', [d.id for d in details]),
                 ('report_language', '=', language.id),
                 ('report_format', '=', 'pdf'),
-                ])
-            if cached_reports:
-                all_cache.append(cached_reports[0].report_cache)
-        if not all_cache:
+                ]):
+            cached_reports.setdefault(cached_report.version_detail.id,
+                cached_report)
+        cached_reports = [cached_reports[d.id] for d in details
+            if d.id in cached_reports]
+        if not cached_reports:
             return False
-
-        merger = PdfFileMerger(strict=False)
-        for cache in all_cache:
-            filedata = BytesIO(cache)
-            merger.append(filedata)
-        output = BytesIO()
-        merger.write(output)
-        return bytearray(output.getvalue())
+        return CachedGlobalReport.get_report(self, language, cached_reports)
 
     @classmethod
     def get_samples_list(cls, reports, name):
@@ -1350,9 +1385,34 @@ class ResultsReportVersionDetail(Workflow, ModelSQL, ModelView):
     @classmethod
     @ModelView.button
     def release_all_lang(cls, details):
+        cls.generate_reports(details)
+
+    @classmethod
+    def generate_reports(cls, details):
         for detail in details:
             detail.generate_report()
 
+    @classmethod
+    def cache_reports(cls):
+        '''
+        Cron: store the reports of the valid released details that are
+        not cached in their report language yet
+        '''
+        cursor = Transaction().connection.cursor()
+        CachedReport = Pool().get('lims.results_report.cached_report')
+
+        cursor.execute('SELECT d.id '
+            'FROM "' + cls._table + '" d '
+            'WHERE d.state = \'released\' '
+                'AND d.valid = TRUE '
+                'AND NOT EXISTS ('
+                    'SELECT 1 FROM "' + CachedReport._table + '" cr '
+                    'WHERE cr.version_detail = d.id '
+                        'AND cr.report_language = d.report_language '
+                        'AND (cr.report_cache IS NOT NULL '
+                            'OR cr.report_cache_id IS NOT NULL))')
+        cls.generate_reports(cls.browse([x[0] for x in cursor.fetchall()]))
+
     def generate_report(self):
         pool = Pool()
         ResultReport = pool.get('lims.result_report', type='report')
@@ -1827,6 +1887,9 @@ class ResultsReportCachedReport(ModelSQL):
     transcription_report_format = fields.Char(
         'Transcription Report format', readonly=True)
 
+    # Cache hits and misses of the results reports printed by this process
+    _stats = {'hit': 0, 'miss': 0}
+
     @classmethod
     def __setup__(cls):
         super().__setup__()
@@ -1837,6 +1900,134 @@ class ResultsReportCachedReport(ModelSQL):
                 'lims.msg_detail_language_unique_id'),
             ]
 
+    @classmethod
+    def get_cached_report(cls, detail, transcription=False):
+        '''
+        Return the format and content of the report cached for the
+        detail in its report language or None
+        '''
+        clause = [
+            ('version_detail', '=', detail.id),
+            ('report_language', '=', detail.report_language.id),
+            ]
+        if transcription:
+            clause.append(('transcription_report_cache', '!=', None))
+        else:
+            clause.append(['OR',
+                ('report_cache', '!=', None),
+                ('report_cache_id', '!=', None)])
+        cached_reports = cls.search(clause, limit=1)
+        if not cached_reports:
+            cls._stats['miss'] += 1
+            logger.debug('Results report cache miss: %s', detail.rec_name)
+            return None
+        cls._stats['hit'] += 1
+        cached_report = cached_reports[0]
+        if transcription:
+            return (cached_report.transcription_report_format,
+                cached_report.transcription_report_cache)
+        return cached_report.report_format, cached_report.report_cache
+
+    @classmethod
+    def set_cached_report(cls, detail, report_format, report_cache,
+            transcription=False):
+        prefix = 'transcription_' if transcription else ''
+        values = {
+            prefix + 'report_cache': report_cache,
+            prefix + 'report_format': report_format,
+            }
+        cached_reports = cls.search([
+            ('version_detail', '=', detail.id),
+            ('report_language', '=', detail.report_language.id),
+            ])
+        if cached_reports:
+            cls.write(cached_reports, values)
+        else:
+            values['version_detail'] = detail.id
+            values['report_language'] = detail.report_language.id
+            cls.create([values])
+
+    @classmethod
+    def get_stats(cls):
+        return dict(cls._stats)
+
+
+class ResultsReportCachedGlobalReport(ModelSQL):
+    'Cached Global Results Report'
+    __name__ = 'lims.results_report.cached_global_report'
+
+    results_report = fields.Many2One('lims.results_report', 'Results Report',
+        required=True, ondelete='CASCADE', select=True)
+    report_language = fields.Many2One('ir.lang', 'Language', required=True)
+    report_cache = fields.Binary('Report cache', readonly=True,
+        file_id='report_cache_id', store_prefix='results_report')
+    report_cache_id = fields.Char('Report cache id', readonly=True)
+    components = fields.Text('Components', readonly=True,
+        help='Cached reports merged and their number of pages')
+
+    @staticmethod
+    def _get_component_key(cached_report):
+        date = cached_report.write_date or cached_report.create_date
+        return '%s-%s-%s' % (cached_report.version_detail.id,
+            cached_report.id, date.isoformat())
+
+    @classmethod
+    def get_report(cls, results_report, language, cached_reports):
+        '''
+        Return the merge of the cached reports. The pages of the components
+        already merged in the stored global report are reused and only the
+        new components are appended.
+        '''
+        CachedReport = Pool().get('lims.results_report.cached_report')
+
+        keys = [cls._get_component_key(c) for c in cached_reports]
+        global_reports = cls.search([
+            ('results_report', '=', results_report.id),
+            ('report_language', '=', language.id),
+            ], limit=1)
+        global_report = global_reports and global_reports[0] or None
+        previous = []
+        if (global_report and global_report.components and
+                global_report.report_cache_id):
+            previous = json.loads(global_report.components)
+
+        reused = 0
+        for (key, pages), new_key in zip(previous, keys):
+            if key != new_key:
+                break
+            reused += 1
+        if reused == len(previous) == len(keys):
+            return global_report.report_cache
+
+        merger = PdfFileMerger(strict=False)
+        components = previous[:reused]
+        if components:
+            merger.append(BytesIO(global_report.report_cache),
+                pages=(0, sum(pages for key, pages in components)))
+        caches = {c['id']: c['report_cache'] for c in CachedReport.read(
+            [c.id for c in cached_reports[reused:]], ['report_cache'])}
+        for key, cached_report in zip(keys[reused:],
+                cached_reports[reused:]):
+            start = len(merger.pages)
+            merger.append(BytesIO(caches[cached_report.id]))
+            components.append([key, len(merger.pages) - start])
+        output = BytesIO()
+        merger.write(output)
+        cache = bytearray(output.getvalue())
+
+        values = {
+            'report_cache': cache,
+            'components': json.dumps(components),
+            }
+        with Transaction().set_user(0):
+            if global_report:
+                cls.write([global_report], values)
+            else:
+                values['results_report'] = results_report.id
+                values['report_language'] = language.id
+                cls.create([values])
+        return cache
+
 
 class ResultsReportComment(ModelSQL):
     'Results Report Comment'
@@ -3571,40 +3762,51 @@ class ResultReport(Report):
             data = {}
         current_data = data.copy()
         current_data['alt_lang'] = results_report.report_language.code
+
+        result = cls._get_cached_result(results_report, current_data)
+        if result:
+            return result
+
         result = super().execute(ids, current_data)
+        if current_data.get('save_cache', False):
+            CachedReport.set_cached_report(results_report,
+                result[0], result[1])
+        return result
 
-        cached_reports = CachedReport.search([
-            ('version_detail', '=', results_report.id),
-            ('report_language', '=', results_report.report_language.id),
-            ['OR',
-                ('report_cache', '!=', None),
-                ('report_cache_id', '!=', None)],
-            ])
-        if cached_reports:
-            result = (cached_reports[0].report_format,
-                cached_reports[0].report_cache) + result[2:]
+    @classmethod
+    def _get_cached_result(cls, results_report, data, transcription=False):
+        '''
+        Return the cached report of the detail without rendering it
+        '''
+        pool = Pool()
+        ActionReport = pool.get('ir.action.report')
+        CachedReport = pool.get('lims.results_report.cached_report')
 
+        cached_report = CachedReport.get_cached_report(results_report,
+            transcription)
+        if not cached_report:
+            return None
+
+        cls.check_access()
+        action_id = data.get('action_id')
+        if action_id is None:
+            action_reports = ActionReport.search([
+                ('report_name', '=', cls.__name__),
+                ])
+            assert action_reports, '%s not found' % cls
+            action = action_reports[0]
         else:
-            if current_data.get('save_cache', False):
-                cached_reports = CachedReport.search([
-                    ('version_detail', '=', results_report.id),
-                    ('report_language', '=',
-                        results_report.report_language.id),
-                    ])
-                if cached_reports:
-                    CachedReport.write(cached_reports, {
-                        'report_cache': result[1],
-                        'report_format': result[0],
-                        })
-                else:
-                    CachedReport.create([{
-                        'version_detail': results_report.id,
-                        'report_language': results_report.report_language.id,
-                        'report_cache': result[1],
-                        'report_format': result[0],
-                        }])
+            action = ActionReport(action_id)
+        return cached_report + (action.direct_print,
+            cls._get_report_name(action, [results_report]))
 
-        return result
+    @classmethod
+    def _get_report_name(cls, action, records):
+        '''
+        Return the report name as the rendered report does
+        '''
+        record_name = records[0].rec_name if len(records) == 1 else None
+        return '-'.join(filter(None, [action.name, record_name]))
 
     @classmethod
     def get_context(cls, records, header, data):
@@ -4500,37 +4702,16 @@ class ResultReportTranscription(ResultReport):
             data = {}
         current_data = data.copy()
         current_data['alt_lang'] = results_report.report_language.code
-        result = super(ResultReport, cls).execute(ids, current_data)
 
-        cached_reports = CachedReport.search([
-            ('version_detail', '=', results_report.id),
-            ('report_language', '=', results_report.report_language.id),
-            ('transcription_report_cache', '!=', None),
-            ])
-        if cached_reports:
-            result = (cached_reports[0].transcription_report_format,
-                cached_reports[0].transcription_report_cache) + result[2:]
-
-        else:
-            if current_data.get('save_cache', False):
-                cached_reports = CachedReport.search([
-                    ('version_detail', '=', results_report.id),
-                    ('report_language', '=',
-                        results_report.report_language.id),
-                    ])
-                if cached_reports:
-                    CachedReport.write(cached_reports, {
-                        'transcription_report_cache': result[1],
-                        'transcription_report_format': result[0],
-                        })
-                else:
-                    CachedReport.create([{
-                        'version_detail': results_report.id,
-                        'report_language': results_report.report_language.id,
-                        'transcription_report_cache': result[1],
-                        'transcription_report_format': result[0],
-                        }])
+        result = cls._get_cached_result(results_report, current_data,
+            transcription=True)
+        if result:
+            return result
 
+        result = super(ResultReport, cls).execute(ids, current_data)
+        if current_data.get('save_cache', False):
+            CachedReport.set_cached_report(results_report,
+                result[0], result[1], transcription=True)
         return result
 
 
@@ -4,6 +4,8 @@
 # the full copyright notices and license terms.
 import logging
 import operator
+from collections import defaultdict
+from itertools import chain
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 from decimal import Decimal
@@ -24,8 +26,9 @@ from trytond.exceptions import UserError, UserWarning
 from trytond.i18n import gettext
 from trytond.rpc import RPC
 from trytond.config import config as tconfig
-from trytond.tools import get_smtp_server
+from trytond.tools import get_smtp_server, grouped_slice
 from trytond import backend
+from .state_queue import defer_state, get_state_queue
 
 logger = logging.getLogger(__name__)
 
@@ -566,8 +569,7 @@ class Service(ModelSQL, ModelView):
                 # from lims_account_invoice
                 if hasattr(aditional_services[0].fraction.type,
                         'invoiceable'):
-                    for aditional_service in aditional_services:
-                        aditional_service.create_invoice_line()
+                    cls.create_invoice_lines(aditional_services)
 
         fractions_ids = list(set(s.fraction.id for s in services))
         cls.set_shared_fraction(fractions_ids)
@@ -665,6 +667,11 @@ class Service(ModelSQL, ModelView):
         pool = Pool()
         Service = pool.get('lims.service')
         EntryDetailAnalysis = pool.get('lims.entry.detail.analysis')
+        Analysis = pool.get('lims.analysis')
+
+        # Resolve the included analysis of all the services at once
+        Analysis.get_included_edges([s.analysis.id for s in services
+            if s.analysis.type != 'analysis'])
 
         for service in services:
             if service.annulled:
@@ -720,74 +727,72 @@ class Service(ModelSQL, ModelView):
             service_context=None):
         cursor = Transaction().connection.cursor()
         pool = Pool()
+        Analysis = pool.get('lims.analysis')
         Typification = pool.get('lims.typification')
 
-        childs = []
-        if analysis.included_analysis:
-            for included in analysis.included_analysis:
-                if (analysis.type == 'set' and
-                        included.included_analysis.type == 'analysis'):
+        graph = Analysis.get_included_graph(analysis.id)
+        analysis_ids = list(set(included[0]
+            for edges in graph.values() for included in edges
+            if included[2] == 'analysis'))
+
+        default_laboratories, default_methods = {}, {}
+        for sub_ids in grouped_slice(analysis_ids):
+            cursor.execute('SELECT analysis, laboratory, method '
+                'FROM "' + Typification._table + '" '
+                'WHERE product_type = %s '
+                    'AND matrix = %s '
+                    'AND analysis IN (' +
+                    ', '.join(str(a) for a in sub_ids) + ') '
+                    'AND valid IS TRUE '
+                    'AND by_default IS TRUE '
+                'ORDER BY id',
+                (service_context['product_type'],
+                    service_context['matrix']))
+            for analysis_id, laboratory_id, method_id in cursor.fetchall():
+                if laboratory_id:
+                    default_laboratories.setdefault(analysis_id,
+                        laboratory_id)
+                default_methods.setdefault(analysis_id, method_id)
+        included_analysis = {a.id: a for a in Analysis.browse(analysis_ids)}
+
+        def _get_included_analysis(analysis_id, analysis_type,
+                analysis_origin):
+            childs = []
+            for included in graph[analysis_id]:
+                included_id, method_id, included_type, code = included
+                if analysis_type == 'set' and included_type == 'analysis':
                     origin = analysis_origin
                 else:
-                    origin = (analysis_origin + ' > ' +
-                        included.included_analysis.code)
+                    origin = analysis_origin + ' > ' + code
 
-                if included.included_analysis.type == 'analysis':
-
-                    laboratory_id = None
-                    cursor.execute('SELECT laboratory '
-                        'FROM "' + Typification._table + '" '
-                        'WHERE product_type = %s '
-                            'AND matrix = %s '
-                            'AND analysis = %s '
-                            'AND valid IS TRUE '
-                            'AND by_default IS TRUE '
-                            'AND laboratory IS NOT NULL',
-                        (service_context['product_type'],
-                            service_context['matrix'],
-                            included.included_analysis.id))
-                    res = cursor.fetchone()
-                    if res:
-                        laboratory_id = res[0]
+                if included_type == 'analysis':
+                    laboratory_id = default_laboratories.get(included_id)
                     if not laboratory_id:
-                        for l in included.included_analysis.laboratories:
+                        for l in included_analysis[included_id].laboratories:
                             if l.by_default is True:
                                 laboratory_id = l.laboratory.id
 
-                    method_id = (included.method.id
-                        if included.method else None)
                     if not method_id:
-                        cursor.execute('SELECT method '
-                            'FROM "' + Typification._table + '" '
-                            'WHERE product_type = %s '
-                                'AND matrix = %s '
-                                'AND analysis = %s '
-                                'AND valid IS TRUE '
-                                'AND by_default IS TRUE',
-                            (service_context['product_type'],
-                                service_context['matrix'],
-                                included.included_analysis.id))
-                        res = cursor.fetchone()
-                        if res:
-                            method_id = res[0]
+                        method_id = default_methods.get(included_id)
 
                     device_id = None
-                    if included.included_analysis.devices:
-                        for d in included.included_analysis.devices:
-                            if (d.laboratory.id == laboratory_id and
-                                    d.by_default is True):
-                                device_id = d.device.id
+                    for d in included_analysis[included_id].devices:
+                        if (d.laboratory.id == laboratory_id and
+                                d.by_default is True):
+                            device_id = d.device.id
 
                     childs.append({
-                        'id': included.included_analysis.id,
+                        'id': included_id,
                         'origin': origin,
                         'laboratory': laboratory_id,
                         'method': method_id,
                         'device': device_id,
                         })
-                childs.extend(Service._get_included_analysis(
-                    included.included_analysis, origin, service_context))
-        return childs
+                childs.extend(_get_included_analysis(
+                    included_id, included_type, origin))
+            return childs
+        return _get_included_analysis(analysis.id, analysis.type,
+            analysis_origin)
 
     @staticmethod
     def create_aditional_services(services):
@@ -3774,11 +3779,190 @@ class Sample(ModelSQL, ModelView):
 
     @classmethod
     def update_samples_state(cls, sample_ids):
+        if defer_state():
+            get_state_queue().samples.update(sample_ids)
+            return
         samples = cls.browse(sample_ids)
+        values = cls._get_samples_values(samples)
+
+        to_write = defaultdict(list)
+        for sample in samples:
+            sample_values = values[sample.id]
+            changes = dict((field, value)
+                for field, value in sample_values.items()
+                if getattr(sample, field) != value)
+            if changes:
+                to_write[tuple(sorted(changes.items()))].append(sample)
+        if to_write:
+            cls.write(*chain(*[(records, dict(changes))
+                    for changes, records in to_write.items()]))
+
+    @classmethod
+    def update_state_queue(cls, samples, detail_ids, referral_ids):
+        '''
+        Recompute the states collected by the state queue
+        '''
+        NotebookLine = Pool().get('lims.notebook.line')
+        if detail_ids:
+            NotebookLine._update_detail_report(detail_ids)
+        # Skip the samples deleted after being queued
+        samples = cls.search([('id', 'in', [s.id for s in samples])])
+        if samples:
+            cls.update_samples_state([s.id for s in samples])
+        if referral_ids:
+            NotebookLine._update_referrals_state(referral_ids)
+
+    @classmethod
+    def _get_samples_values(cls, samples):
+        '''
+        Compute the dates, state and pending lines quantities of samples
+        with a few grouped queries. Equivalent to calling
+        _get_sample_dates, _get_sample_state and the _get_qty_lines
+        methods on each sample.
+        '''
+        pool = Pool()
+        Fraction = pool.get('lims.fraction')
+        Service = pool.get('lims.service')
+        Notebook = pool.get('lims.notebook')
+        NotebookLine = pool.get('lims.notebook.line')
+        ResultsReport = pool.get('lims.results_report')
+        ResultsVersion = pool.get('lims.results_report.version')
+        ResultsDetail = pool.get('lims.results_report.version.detail')
+        ResultsSample = pool.get('lims.results_report.version.detail.sample')
+
+        cursor = Transaction().connection.cursor()
+        manage_service = Transaction().context.get('manage_service', False)
+
+        services = {}
+        lines = {}
+        reports_create = {}
+        reports_release = {}
+        for sub_samples in grouped_slice(samples):
+            sub_ids = [s.id for s in sub_samples]
+            in_ids = '(' + ', '.join(['%s'] * len(sub_ids)) + ')'
+
+            cursor.execute('SELECT f.sample, MIN(s.confirmation_date), '
+                    'MAX(s.laboratory_date), MAX(s.report_date) '
+                'FROM "' + Service._table + '" s '
+                    'INNER JOIN "' + Fraction._table + '" f '
+                    'ON f.id = s.fraction '
+                'WHERE f.sample IN ' + in_ids + ' '
+                'GROUP BY f.sample',
+                sub_ids)
+            services.update((x[0], x[1:]) for x in cursor.fetchall())
+
+            cursor.execute('SELECT f.sample, MIN(nl.start_date), '
+                    'MAX(nl.end_date), MAX(nl.acceptance_date::date), '
+                    'COUNT(*), '
+                    'SUM(CASE WHEN nl.annulled = TRUE '
+                        'THEN 1 ELSE 0 END), '
+                    'SUM(CASE WHEN nl.report = TRUE '
+                        'AND nl.annulled = FALSE '
+                        'AND nl.end_date IS NULL '
+                        'THEN 1 ELSE 0 END), '
+                    'SUM(CASE WHEN nl.report = TRUE '
+                        'AND nl.annulled = FALSE '
+                        'AND nl.acceptance_date IS NULL '
+                        'THEN 1 ELSE 0 END), '
+                    'SUM(CASE WHEN nl.report = TRUE '
+                        'AND nl.annulled = FALSE '
+                        'AND nl.end_date IS NOT NULL '
+                        'THEN 1 ELSE 0 END), '
+                    'SUM(CASE WHEN nl.report = TRUE '
+                        'AND nl.annulled = FALSE '
+                        'AND nl.end_date IS NOT NULL '
+                        'AND nl.acceptance_date IS NULL '
+                        'THEN 1 ELSE 0 END) '
+                'FROM "' + NotebookLine._table + '" nl '
+                    'INNER JOIN "' + Service._table + '" s '
+                    'ON s.id = nl.service '
+                    'INNER JOIN "' + Fraction._table + '" f '
+                    'ON f.id = s.fraction '
+                'WHERE f.sample IN ' + in_ids + ' '
+                'GROUP BY f.sample',
+                sub_ids)
+            lines.update((x[0], x[1:]) for x in cursor.fetchall())
+
+            cursor.execute('SELECT f.sample, MIN(r.create_date::date) '
+                'FROM "' + ResultsReport._table + '" r '
+                    'INNER JOIN "' + ResultsVersion._table + '" rv '
+                    'ON rv.results_report = r.id '
+                    'INNER JOIN "' + ResultsDetail._table + '" rd '
+                    'ON rd.report_version = rv.id '
+                    'INNER JOIN "' + ResultsSample._table + '" rs '
+                    'ON rs.version_detail = rd.id '
+                    'INNER JOIN "' + Notebook._table + '" n '
+                    'ON n.id = rs.notebook '
+                    'INNER JOIN "' + Fraction._table + '" f '
+                    'ON f.id = n.fraction '
+                'WHERE f.sample IN ' + in_ids + ' '
+                    'AND rd.type != \'preliminary\' '
+                'GROUP BY f.sample',
+                sub_ids)
+            reports_create.update(cursor.fetchall())
+
+            cursor.execute('SELECT f.sample, MAX(rd.release_date::date) '
+                'FROM "' + ResultsDetail._table + '" rd '
+                    'INNER JOIN "' + ResultsSample._table + '" rs '
+                    'ON rs.version_detail = rd.id '
+                    'INNER JOIN "' + Notebook._table + '" n '
+                    'ON n.id = rs.notebook '
+                    'INNER JOIN "' + Fraction._table + '" f '
+                    'ON f.id = n.fraction '
+                'WHERE f.sample IN ' + in_ids + ' '
+                    'AND rd.valid '
+                    'AND rd.type != \'preliminary\' '
+                'GROUP BY f.sample',
+                sub_ids)
+            reports_release.update(cursor.fetchall())
+
+        res = {}
         for sample in samples:
-            sample.update_sample_dates()
-            sample.update_sample_state()
-            sample.update_qty_lines()
+            (confirmation_date, laboratory_date,
+                report_date) = services.get(sample.id, (None,) * 3)
+            (start_date, end_date, acceptance_date, qty_lines,
+                qty_annulled, qty_not_ended, qty_not_accepted, qty_ended,
+                qty_pending_acceptance) = lines.get(sample.id, (None,) * 9)
+
+            values = {}
+            if manage_service:
+                values = sample._get_origin_default_dates()
+            if 'confirmation_date' not in values:
+                values['confirmation_date'] = confirmation_date or None
+            values['laboratory_date'] = laboratory_date or None
+            values['report_date'] = report_date or None
+            values['laboratory_start_date'] = start_date or None
+            values['laboratory_end_date'] = (end_date or None
+                if not qty_not_ended else None)
+            values['laboratory_acceptance_date'] = (acceptance_date or None
+                if not qty_not_accepted else None)
+            values['results_report_create_date'] = (
+                reports_create.get(sample.id) or None)
+            values['results_report_release_date'] = (
+                reports_release.get(sample.id) or None)
+
+            if values['results_report_release_date']:
+                state = 'report_released'
+            elif values['results_report_create_date']:
+                state = 'in_report'
+            elif values['laboratory_acceptance_date']:
+                state = 'pending_report'
+            elif qty_annulled and qty_annulled == qty_lines:
+                state = 'annulled'
+            elif values['laboratory_end_date']:
+                state = 'lab_pending_acceptance'
+            elif values['laboratory_start_date']:
+                state = 'in_lab' if qty_ended else 'planned'
+            elif values['confirmation_date']:
+                state = 'pending_planning'
+            else:
+                state = 'draft'
+            values['state'] = state
+            values['qty_lines_pending'] = qty_not_ended or 0
+            values['qty_lines_pending_acceptance'] = (
+                qty_pending_acceptance or 0)
+            res[sample.id] = values
+        return res
 
     def update_sample_dates(self):
         dates = self._get_sample_dates()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# This file is part of lims module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+# Sample, analysis detail and referral states and notebook summaries
+# can be recomputed:
+# - immediate: on every write (default)
+# - commit: once per record, when the transaction is committed
+# - queue: once per record, by the queue worker after the commit
+# The mode can be overridden with the 'lims_state_recompute' context key.
+STATE_RECOMPUTE = config.get('lims', 'state_recompute', default='immediate')
+
+
+def defer_state():
+    mode = Transaction().context.get('lims_state_recompute',
+        STATE_RECOMPUTE)
+    return mode in ('commit', 'queue')
+
+
+def get_state_queue():
+    return Transaction().join(StateQueue())
+
+
+def flush_state_queue():
+    '''
+    Recompute now the states collected in the current transaction
+    '''
+    queue = get_state_queue()
+    queue.flush()
+
+
+class StateQueue(object):
+    '''
+    Data manager that collects the samples, analysis details, referrals
+    and notebooks whose state must be recomputed, so each one is
+    recomputed once
+    '''
+
+    def __init__(self):
+        self.samples = set()
+        self.details = set()
+        self.referrals = set()
+        self.notebooks = set()
+
+    def __eq__(self, other):
+        return isinstance(other, StateQueue)
+
+    def __hash__(self):
+        return hash(StateQueue)
+
+    def flush(self, queued=False):
+        pool = Pool()
+        Sample = pool.get('lims.sample')
+        NotebookSummary = pool.get('lims.notebook.summary')
+
+        while (self.samples or self.details or self.referrals or
+                self.notebooks):
+            sample_ids = list(self.samples)
+            detail_ids = list(self.details)
+            referral_ids = list(self.referrals)
+            self.samples.clear()
+            self.details.clear()
+            self.referrals.clear()
+            notebook_ids = list(self.notebooks)
+            self.notebooks.clear()
+            with Transaction().set_context(
+                    lims_state_recompute='immediate', _check_access=False):
+                if queued:
+                    Sample.__queue__.update_state_queue(
+                        Sample.browse(sample_ids), detail_ids, referral_ids)
+                else:
+                    Sample.update_state_queue(
+                        Sample.browse(sample_ids), detail_ids, referral_ids)
+                # The summary filters the pending reporting searches so it
+                # is always refreshed before the transaction is committed
+                if notebook_ids:
+                    NotebookSummary._update_notebooks(notebook_ids)
+
+    def tpc_begin(self, trans):
+        pass
+
+    def commit(self, trans):
+        mode = trans.context.get('lims_state_recompute', STATE_RECOMPUTE)
+        self.flush(queued=(mode == 'queue'))
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        pass
+
+    def tpc_abort(self, trans):
+        pass
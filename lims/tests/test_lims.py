@@ -3,9 +3,13 @@
 # the full copyright notices and license terms.
 import unittest
 import doctest
+from random import Random
+from unittest.mock import patch
 
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.pool import Pool
+from trytond.transaction import Transaction
 from trytond.tests.test_tryton import doctest_teardown
 from trytond.tests.test_tryton import doctest_checker
 
@@ -14,6 +18,88 @@ class LimsTestCase(ModuleTestCase):
     'Test lims module'
     module = 'lims'
 
+    def test_formula_parser(self):
+        'Test compiled formula evaluation'
+        from trytond.modules.lims.formula_parser import (FormulaParser,
+            compile_formula, evaluate_many)
+
+        self.assertEqual(FormulaParser('{X}*2-(3/X)^2', {'X': 3}).getValue(),
+            5.0)
+        self.assertEqual(FormulaParser('-2^2').getValue(), 4.0)
+        self.assertEqual(FormulaParser('X/0+3', {'X': 1}).getValue(), 3.0)
+        self.assertEqual(FormulaParser('X+1', {'X': ''}).getValue(), 1.0)
+
+        compile_formula.cache_clear()
+        self.assertEqual(evaluate_many('A*B', [{'A': i, 'B': 2}
+                    for i in range(100)]), [i * 2.0 for i in range(100)])
+        self.assertEqual(compile_formula.cache_info().misses, 1)
+
+    def test_tendency_rules(self):
+        'Test streaming tendency rules against the tendencies analysis'
+        from trytond.modules.lims.control_tendency import (TendencyRules,
+            TendenciesAnalysis)
+
+        class Tendency:
+            mean = 10.0
+            one_sd_adj = 1.0
+            two_sd_adj = 2.0
+            three_sd_adj = 3.0
+
+        class Analysis:
+            _check_rule = TendenciesAnalysis._check_rule
+
+        random = Random(0)
+        for _ in range(200):
+            tendency_rules = TendencyRules(Tendency.mean,
+                Tendency.one_sd_adj, Tendency.two_sd_adj,
+                Tendency.three_sd_adj)
+            results = []
+            for _ in range(random.randint(1, 40)):
+                result = random.choice([
+                    10.0, 11.0, 12.0, 13.0, 8.0, 7.0,
+                    round(random.gauss(10, 2), 1)])
+                results.append(result)
+                self.assertEqual(tendency_rules.add(result),
+                    TendenciesAnalysis.get_rules(Analysis(), results,
+                        Tendency()), results)
+
+    @with_transaction()
+    def test_plot_cache(self):
+        'Test control chart rendering on a plot cache miss and hit'
+        pool = Pool()
+        PlotCache = pool.get('lims.plot.cache')
+        ControlChartReport = pool.get('lims.control_chart.report',
+            type='report')
+
+        class Detail:
+            def __init__(self, result):
+                self.result = result
+
+        class Tendency:
+            details = [Detail(r) for r in (10.0, 11.5, 9.0, 12.0)]
+            ucl, uwl, upl, cl = 13.0, 12.0, 11.0, 10.0
+            lpl, lwl, lcl, cv = 9.0, 8.0, 7.0, 5.0
+
+        columns = list(range(1, len(Tendency.details) + 1))
+        records = ControlChartReport._get_objects(Tendency())
+        with patch.object(ControlChartReport, '_render_plot',
+                wraps=ControlChartReport._render_plot) as render:
+            image = ControlChartReport._get_plot(columns, records)
+            self.assertTrue(image)
+            self.assertEqual(render.call_count, 1)
+            self.assertEqual(PlotCache.search([], count=True), 1)
+
+            self.assertEqual(
+                ControlChartReport._get_plot(columns, records), image)
+            self.assertEqual(render.call_count, 1)
+            self.assertEqual(PlotCache.search([], count=True), 1)
+
+            records['result']['recs'][1] = 12.5
+            with Transaction().new_transaction(readonly=True):
+                self.assertTrue(ControlChartReport._get_plot(columns, records))
+                self.assertEqual(render.call_count, 2)
+                self.assertEqual(PlotCache.search([], count=True), 0)
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
@@ -5,6 +5,9 @@
 import operator
 from collections import defaultdict
 from decimal import Decimal
+from sql import Cast, Null
+from sql.aggregate import Count, Max
+from sql.operators import Concat
 
 from trytond.model import fields
 from trytond.wizard import Wizard, StateAction
@@ -12,6 +15,7 @@ from trytond.report import Report
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import PYSONEncoder
 from trytond.transaction import Transaction
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 
@@ -30,13 +34,14 @@ class Entry(metaclass=PoolMeta):
     __name__ = 'lims.entry'
 
     last_release_date = fields.Function(fields.DateTime(
-        'Last Release date'), 'get_last_release_date')
+        'Last Release date'), 'get_last_release_date',
+        searcher='search_last_release_date')
     qty_lines_pending_invoicing = fields.Function(fields.Integer(
-        'Lines pending invoicing'), 'get_qty_lines_pending_invoicing')
+        'Lines pending invoicing'), 'get_qty_lines_pending_invoicing',
+        searcher='search_qty_lines_pending_invoicing')
 
     @classmethod
-    def get_last_release_date(cls, entries, name):
-        cursor = Transaction().connection.cursor()
+    def _last_release_date_query(cls):
         pool = Pool()
         ResultsVersion = pool.get('lims.results_report.version')
         ResultsDetail = pool.get('lims.results_report.version.detail')
@@ -44,63 +49,98 @@ class Entry(metaclass=PoolMeta):
         Notebook = pool.get('lims.notebook')
         Fraction = pool.get('lims.fraction')
         Sample = pool.get('lims.sample')
+        entry = cls.__table__()
+        sample = Sample.__table__()
+        fraction = Fraction.__table__()
+        notebook = Notebook.__table__()
+        notebook_line = NotebookLine.__table__()
+        version = ResultsVersion.__table__()
+        detail = ResultsDetail.__table__()
+
+        join = entry.join(sample, 'LEFT',
+            condition=sample.entry == entry.id
+            ).join(fraction, 'LEFT', condition=fraction.sample == sample.id
+            ).join(notebook, 'LEFT', condition=notebook.fraction == fraction.id
+            ).join(notebook_line, 'LEFT',
+            condition=notebook_line.notebook == notebook.id
+            ).join(version, 'LEFT',
+            condition=version.results_report == notebook_line.results_report
+            ).join(detail, 'LEFT',
+            condition=((detail.report_version == version.id) &
+                (detail.state == 'released') &
+                (detail.type != 'preliminary')))
+        return join, entry.id, Max(detail.release_date)
 
-        result = {}
-        for e in entries:
-            cursor.execute('SELECT MAX(rd.release_date) '
-                'FROM "' + ResultsVersion._table + '" rv '
-                    'INNER JOIN "' + ResultsDetail._table + '" rd '
-                    'ON rv.id = rd.report_version '
-                    'INNER JOIN "' + NotebookLine._table + '" nl '
-                    'ON nl.results_report = rv.results_report '
-                    'INNER JOIN "' + Notebook._table + '" n '
-                    'ON n.id = nl.notebook '
-                    'INNER JOIN "' + Fraction._table + '" f '
-                    'ON f.id = n.fraction '
-                    'INNER JOIN "' + Sample._table + '" s '
-                    'ON s.id = f.sample '
-                'WHERE s.entry = %s '
-                    'AND rd.state = \'released\' '
-                    'AND rd.type != \'preliminary\'',
-                (str(e.id),))
-            result[e.id] = cursor.fetchone()[0]
+    @classmethod
+    def get_last_release_date(cls, entries, name):
+        cursor = Transaction().connection.cursor()
 
+        join, entry, release_date = cls._last_release_date_query()
+        result = dict.fromkeys([e.id for e in entries])
+        for sub_ids in grouped_slice(list(result.keys())):
+            cursor.execute(*join.select(entry, release_date,
+                where=reduce_ids(entry, sub_ids),
+                group_by=entry))
+            result.update(cursor.fetchall())
         return result
 
     @classmethod
-    def get_qty_lines_pending_invoicing(cls, entries, name):
-        cursor = Transaction().connection.cursor()
+    def search_last_release_date(cls, name, clause):
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+
+        join, entry, release_date = cls._last_release_date_query()
+        expression = Operator(release_date, value)
+        if operator in {'!=', 'not in'} and value is not None:
+            expression |= (release_date == Null)
+        query = join.select(entry, group_by=entry, having=expression)
+        return [('id', 'in', query)]
+
+    @classmethod
+    def _qty_lines_pending_invoicing_query(cls):
         pool = Pool()
         Sample = pool.get('lims.sample')
         Fraction = pool.get('lims.fraction')
         Service = pool.get('lims.service')
         InvoiceLine = pool.get('account.invoice.line')
+        entry = cls.__table__()
+        sample = Sample.__table__()
+        fraction = Fraction.__table__()
+        service = Service.__table__()
+        invoice_line = InvoiceLine.__table__()
+
+        join = entry.join(sample, 'LEFT',
+            condition=sample.entry == entry.id
+            ).join(fraction, 'LEFT', condition=fraction.sample == sample.id
+            ).join(service, 'LEFT', condition=service.fraction == fraction.id
+            ).join(invoice_line, 'LEFT',
+            condition=((invoice_line.origin == Concat('lims.service,',
+                        Cast(service.id, 'VARCHAR'))) &
+                (invoice_line.invoice == Null)))
+        return join, entry.id, Count(invoice_line.id)
 
-        result = {}
-        for e in entries:
-            result[e.id] = 0
+    @classmethod
+    def get_qty_lines_pending_invoicing(cls, entries, name):
+        cursor = Transaction().connection.cursor()
 
-            cursor.execute('SELECT srv.id '
-                'FROM "' + Service._table + '" srv '
-                    'INNER JOIN "' + Fraction._table + '" f '
-                    'ON f.id = srv.fraction '
-                    'INNER JOIN "' + Sample._table + '" s '
-                    'ON s.id = f.sample '
-                'WHERE s.entry = %s',
-                (str(e.id),))
-            services_ids = [x[0] for x in cursor.fetchall()]
-            if not services_ids:
-                continue
+        join, entry, qty = cls._qty_lines_pending_invoicing_query()
+        result = dict.fromkeys([e.id for e in entries], 0)
+        for sub_ids in grouped_slice(list(result.keys())):
+            cursor.execute(*join.select(entry, qty,
+                where=reduce_ids(entry, sub_ids),
+                group_by=entry))
+            result.update(cursor.fetchall())
+        return result
 
-            origins = '\', \''.join(['lims.service,' + str(s)
-                for s in services_ids])
-            cursor.execute('SELECT COUNT(*) '
-                'FROM "' + InvoiceLine._table + '" '
-                'WHERE origin IN (\'' + origins + '\') '
-                    'AND invoice IS NULL')
-            result[e.id] = cursor.fetchone()[0]
+    @classmethod
+    def search_qty_lines_pending_invoicing(cls, name, clause):
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
 
-        return result
+        join, entry, qty = cls._qty_lines_pending_invoicing_query()
+        query = join.select(entry, group_by=entry,
+            having=Operator(qty, value))
+        return [('id', 'in', query)]
 
     @classmethod
     def on_hold(cls, entries):
@@ -116,8 +156,7 @@ class Entry(metaclass=PoolMeta):
                 ('entry', 'in', [e.id for e in entries]),
                 ('annulled', '=', False),
                 ])
-        for service in services:
-            service.create_invoice_line()
+        Service.create_invoice_lines(services)
 
     @classmethod
     def view_toolbar_get(cls):
@@ -191,8 +230,7 @@ class Fraction(metaclass=PoolMeta):
                 ('fraction', 'in', [f.id for f in fractions]),
                 ('annulled', '=', False),
                 ])
-        for service in services:
-            service.create_invoice_line()
+        Service.create_invoice_lines(services)
 
 
 class Service(metaclass=PoolMeta):
@@ -203,30 +241,50 @@ class Service(metaclass=PoolMeta):
         services = super().create(vlist)
         services_to_invoice = [s for s in services if
             s.entry.state == 'pending']
-        for service in services_to_invoice:
-            service.create_invoice_line()
+        if services_to_invoice:
+            cls.create_invoice_lines(services_to_invoice)
         return services
 
     def create_invoice_line(self):
+        self.create_invoice_lines([self])
+
+    @classmethod
+    def create_invoice_lines(cls, services):
+        '''
+        Create the invoice lines of the services with one call, the
+        values shared by services are computed once
+        '''
         InvoiceLine = Pool().get('account.invoice.line')
 
-        if (not self.fraction.type.invoiceable or
-                self.fraction.cie_fraction_type):
-            return
-        invoice_line = self.get_invoice_line()
-        if not invoice_line:
+        cache = {}
+        invoice_lines = []
+        for service in services:
+            if (not service.fraction.type.invoiceable or
+                    service.fraction.cie_fraction_type):
+                continue
+            invoice_line = service.get_invoice_line(cache)
+            if invoice_line:
+                invoice_lines.append(invoice_line)
+        if not invoice_lines:
             return
         with Transaction().set_context(_check_access=False):
-            InvoiceLine.create([invoice_line])
-
-    def get_invoice_line(self):
-        Company = Pool().get('company.company')
-
+            InvoiceLine.create(invoice_lines)
+
+    def get_invoice_line(self, cache=None):
+        '''
+        Return the values of the invoice line of the service.
+        cache is a dict shared by the services invoiced together
+        '''
+        if cache is None:
+            cache = {}
         company = Transaction().context.get('company')
-        currency = Company(company).currency.id
         product = self.analysis.product if self.analysis else None
         if not product:
             return
+        if 'currency' not in cache:
+            Company = Pool().get('company.company')
+            cache['currency'] = Company(company).currency.id
+        currency = cache['currency']
         account_revenue = product.account_revenue_used
         if not account_revenue:
             raise UserError(
@@ -235,22 +293,10 @@ class Service(metaclass=PoolMeta):
                     service=self.rec_name))
 
         party = self.entry.invoice_party
-        taxes = []
-        pattern = {}
-        for tax in product.customer_taxes_used:
-            if party.customer_tax_rule:
-                tax_ids = party.customer_tax_rule.apply(tax, pattern)
-                if tax_ids:
-                    taxes.extend(tax_ids)
-                continue
-            taxes.append(tax.id)
-        if party.customer_tax_rule:
-            tax_ids = party.customer_tax_rule.apply(None, pattern)
-            if tax_ids:
-                taxes.extend(tax_ids)
-        taxes_to_add = None
-        if taxes:
-            taxes_to_add = [('add', taxes)]
+        key = ('taxes', party.id, product.id)
+        if key not in cache:
+            cache[key] = self._get_invoice_line_taxes(party, product)
+        taxes_to_add = cache[key]
 
         return {
             'company': company,
@@ -267,6 +313,24 @@ class Service(metaclass=PoolMeta):
             'account': account_revenue,
             }
 
+    @staticmethod
+    def _get_invoice_line_taxes(party, product):
+        taxes = []
+        pattern = {}
+        for tax in product.customer_taxes_used:
+            if party.customer_tax_rule:
+                tax_ids = party.customer_tax_rule.apply(tax, pattern)
+                if tax_ids:
+                    taxes.extend(tax_ids)
+                continue
+            taxes.append(tax.id)
+        if party.customer_tax_rule:
+            tax_ids = party.customer_tax_rule.apply(None, pattern)
+            if tax_ids:
+                taxes.extend(tax_ids)
+        if taxes:
+            return [('add', taxes)]
+
     @classmethod
     def delete(cls, services):
         cls.delete_invoice_lines(services)
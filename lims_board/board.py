@@ -1,11 +1,17 @@
 # This file is part of lims_board module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+from datetime import timedelta
 from dateutil.relativedelta import relativedelta
+from sql import Literal, Null
+from sql.aggregate import Count, Sum
+from sql.conditionals import Case
 
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.pool import Pool
 from trytond.transaction import Transaction
+from trytond.cache import Cache
+from trytond.config import config
 from trytond.i18n import gettext
 
 DEPARTMENTS_LIMIT = 30
@@ -14,6 +20,108 @@ SAMPLES_IN_PROGRESS = ['pending_planning', 'planned',
     'pending_report', 'in_report']
 SAMPLES_IN_LABORATORY = ['pending_planning', 'planned',
     'in_lab', 'lab_pending_acceptance']
+# Seconds the dashboard counters are shared before being computed again
+COUNTERS_CACHE_DURATION = config.getint('lims_board',
+    'counters_cache_duration', default=60)
+
+_counters_cache = Cache('lims.board.counters',
+    duration=timedelta(seconds=COUNTERS_CACHE_DURATION), context=False)
+
+
+def get_sample_counters(board, states, group_by, date_field=None):
+    '''
+    Return the quantity of samples of the board filters in states per
+    value of group_by ('state' or 'department'), as a tuple with the
+    quantity per deadline bucket of date_field if it is set.
+    The counters are cached for COUNTERS_CACHE_DURATION seconds.
+    '''
+    pool = Pool()
+    Sample = pool.get('lims.sample')
+    ProductType = pool.get('lims.product.type')
+    Date = pool.get('ir.date')
+
+    clause = [('state', 'in', states)]
+    if board.date_from:
+        clause.append(('date2', '>=', board.date_from))
+    if board.date_to:
+        clause.append(('date2', '<=', board.date_to))
+    if board.parties:
+        clause.append(('party', 'in', [p.id for p in board.parties]))
+    if board.departments:
+        clause.append(('department', 'in',
+            [d.id for d in board.departments]))
+    if board.analysis:
+        clause.append(('fractions.services.analysis', 'in',
+            [a.id for a in board.analysis]))
+
+    today = Date.today()
+    key = (group_by, date_field, today, str(clause))
+    counters = _counters_cache.get(key)
+    if counters is not None:
+        return counters
+
+    cursor = Transaction().connection.cursor()
+    sample = Sample.__table__()
+    product_type = ProductType.__table__()
+
+    if group_by == 'department':
+        group_column = product_type.department
+    else:
+        group_column = sample.state
+
+    if date_field:
+        column = getattr(sample, date_field)
+        buckets = [column <= today - relativedelta(days=4)]
+        for days in range(-3, 4):
+            buckets.append(column == today + relativedelta(days=days))
+        buckets.append((column == Null) |
+            (column >= today + relativedelta(days=4)))
+        columns = [Sum(Case((b, 1), else_=0)) for b in buckets]
+    else:
+        columns = [Count(Literal('*'))]
+
+    query = sample.join(product_type, 'LEFT',
+        condition=sample.product_type == product_type.id
+        ).select(group_column, *columns,
+            where=sample.id.in_(Sample.search(clause, order=[],
+                query=True)),
+            group_by=[group_column])
+    cursor.execute(*query)
+    counters = {}
+    for row in cursor.fetchall():
+        counters[row[0]] = tuple(int(x or 0) for x in row[1:])
+    _counters_cache.set(key, counters)
+    return counters
+
+
+def get_deadline_records(counters):
+    '''
+    Return the rows of the deadline panels: one per bucket with the
+    quantity of samples of each department
+    '''
+    Department = Pool().get('company.department')
+
+    i = 0
+    dep = {None: ''}
+    departments = Department.search([], order=[('id', 'ASC')],
+        limit=DEPARTMENTS_LIMIT)
+    for d in departments:
+        i += 1
+        dep[d.id] = i
+
+    labels = ['< -4 d', '-3 d', '-2 d',
+        gettext('lims_board.msg_yesterday'),
+        gettext('lims_board.msg_today'),
+        gettext('lims_board.msg_tomorrow'),
+        '+2 d', '+3 d', '> +4 d']
+    records = []
+    for bucket, label in enumerate(labels):
+        record = {'t': label}
+        for d_id, d_it in dep.items():
+            quantities = counters.get(d_id)
+            record['q%s' % d_it] = quantities[bucket] if quantities else 0
+        records.append(record)
+    return records
 
 
 class BoardGeneral(ModelSQL, ModelView):
@@ -101,191 +209,35 @@ class BoardGeneral(ModelSQL, ModelView):
         return records
 
     def get_samples_state(self):
-        pool = Pool()
-        Sample = pool.get('lims.sample')
-
-        clause = []
-        if self.date_from:
-            clause.append(('date2', '>=', self.date_from))
-        if self.date_to:
-            clause.append(('date2', '<=', self.date_to))
-        if self.parties:
-            clause.append(('party', 'in', [p.id for p in self.parties]))
-        if self.departments:
-            clause.append(('department', 'in',
-                [d.id for d in self.departments]))
-        if self.analysis:
-            clause.append(('fractions.services.analysis', 'in',
-                [a.id for a in self.analysis]))
-
+        counters = get_sample_counters(self, SAMPLES_IN_PROGRESS, 'state')
         records = []
-
         for state in SAMPLES_IN_PROGRESS:
             record = {
                 's': gettext('lims_board.msg_sample_state_%s' % state),
+                'q': counters.get(state, (0,))[0],
                 }
-            record['q'] = Sample.search_count(clause + [
-                ('state', '=', state),
-                ])
             records.append(record)
-
         return records
 
     def get_samples_department(self):
-        pool = Pool()
-        Sample = pool.get('lims.sample')
-        Department = pool.get('company.department')
-
-        clause = [('state', 'in', SAMPLES_IN_PROGRESS)]
-        if self.date_from:
-            clause.append(('date2', '>=', self.date_from))
-        if self.date_to:
-            clause.append(('date2', '<=', self.date_to))
-        if self.parties:
-            clause.append(('party', 'in', [p.id for p in self.parties]))
-        if self.departments:
-            clause.append(('department', 'in',
-                [d.id for d in self.departments]))
-        if self.analysis:
-            clause.append(('fractions.services.analysis', 'in',
-                [a.id for a in self.analysis]))
+        Department = Pool().get('company.department')
 
+        counters = get_sample_counters(self, SAMPLES_IN_PROGRESS,
+            'department')
         records = []
-
         departments = Department.search([], order=[('id', 'ASC')])
         for d in departments:
-            record = {'d': d.name}
-            record['q'] = Sample.search_count(clause + [
-                ('department', '=', d.id),
-                ])
+            record = {
+                'd': d.name,
+                'q': counters.get(d.id, (0,))[0],
+                }
             records.append(record)
-
         return records
 
     def get_samples_report_date(self):
-        pool = Pool()
-        Sample = pool.get('lims.sample')
-        Department = pool.get('company.department')
-        Date = pool.get('ir.date')
-
-        i = 0
-        dep = {None: ''}
-        departments = Department.search([], order=[('id', 'ASC')],
-            limit=DEPARTMENTS_LIMIT)
-        for d in departments:
-            i += 1
-            dep[d.id] = i
-
-        clause = [('state', 'in', SAMPLES_IN_PROGRESS)]
-        if self.date_from:
-            clause.append(('date2', '>=', self.date_from))
-        if self.date_to:
-            clause.append(('date2', '<=', self.date_to))
-        if self.parties:
-            clause.append(('party', 'in', [p.id for p in self.parties]))
-        if self.departments:
-            clause.append(('department', 'in',
-                [d.id for d in self.departments]))
-        if self.analysis:
-            clause.append(('fractions.services.analysis', 'in',
-                [a.id for a in self.analysis]))
-
-        records = []
-        today = Date.today()
-
-        # < -4 d
-        report_date = today - relativedelta(days=4)
-        record = {'t': '< -4 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('report_date', '<=', report_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # -3 d
-        report_date = today - relativedelta(days=3)
-        record = {'t': '-3 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('report_date', '=', report_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # -2 d
-        report_date = today - relativedelta(days=2)
-        record = {'t': '-2 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('report_date', '=', report_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # -1 d
-        report_date = today - relativedelta(days=1)
-        record = {'t': gettext('lims_board.msg_yesterday')}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('report_date', '=', report_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # t
-        record = {'t': gettext('lims_board.msg_today')}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('report_date', '=', today),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # +1 d
-        report_date = today + relativedelta(days=1)
-        record = {'t': gettext('lims_board.msg_tomorrow')}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('report_date', '=', report_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # +2 d
-        report_date = today + relativedelta(days=2)
-        record = {'t': '+2 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('report_date', '=', report_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # +3 d
-        report_date = today + relativedelta(days=3)
-        record = {'t': '+3 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('report_date', '=', report_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # > +4 d
-        report_date = today + relativedelta(days=4)
-        record = {'t': '> +4 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ['OR',
-                    ('report_date', '=', None),
-                    ('report_date', '>=', report_date),
-                    ],
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        return records
+        counters = get_sample_counters(self, SAMPLES_IN_PROGRESS,
+            'department', 'report_date')
+        return get_deadline_records(counters)
 
 
 class BoardGeneralSampleState(ModelView):
@@ -522,129 +474,9 @@ class BoardLaboratory(ModelSQL, ModelView):
         return records
 
     def get_samples_laboratory_date(self):
-        pool = Pool()
-        Sample = pool.get('lims.sample')
-        Department = pool.get('company.department')
-        Date = pool.get('ir.date')
-
-        i = 0
-        dep = {None: ''}
-        departments = Department.search([], order=[('id', 'ASC')],
-            limit=DEPARTMENTS_LIMIT)
-        for d in departments:
-            i += 1
-            dep[d.id] = i
-
-        clause = [('state', 'in', SAMPLES_IN_LABORATORY)]
-        if self.date_from:
-            clause.append(('date2', '>=', self.date_from))
-        if self.date_to:
-            clause.append(('date2', '<=', self.date_to))
-        if self.parties:
-            clause.append(('party', 'in', [p.id for p in self.parties]))
-        if self.departments:
-            clause.append(('department', 'in',
-                [d.id for d in self.departments]))
-        if self.analysis:
-            clause.append(('fractions.services.analysis', 'in',
-                [a.id for a in self.analysis]))
-
-        records = []
-        today = Date.today()
-
-        # < -4 d
-        laboratory_date = today - relativedelta(days=4)
-        record = {'t': '< -4 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('laboratory_date', '<=', laboratory_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # -3 d
-        laboratory_date = today - relativedelta(days=3)
-        record = {'t': '-3 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('laboratory_date', '=', laboratory_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # -2 d
-        laboratory_date = today - relativedelta(days=2)
-        record = {'t': '-2 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('laboratory_date', '=', laboratory_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # -1 d
-        laboratory_date = today - relativedelta(days=1)
-        record = {'t': gettext('lims_board.msg_yesterday')}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('laboratory_date', '=', laboratory_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # t
-        record = {'t': gettext('lims_board.msg_today')}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('laboratory_date', '=', today),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # +1 d
-        laboratory_date = today + relativedelta(days=1)
-        record = {'t': gettext('lims_board.msg_tomorrow')}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('laboratory_date', '=', laboratory_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # +2 d
-        laboratory_date = today + relativedelta(days=2)
-        record = {'t': '+2 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('laboratory_date', '=', laboratory_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # +3 d
-        laboratory_date = today + relativedelta(days=3)
-        record = {'t': '+3 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('laboratory_date', '=', laboratory_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # > +4 d
-        laboratory_date = today + relativedelta(days=4)
-        record = {'t': '> +4 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ['OR',
-                    ('laboratory_date', '=', None),
-                    ('laboratory_date', '>=', laboratory_date),
-                    ],
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        return records
+        counters = get_sample_counters(self, SAMPLES_IN_LABORATORY,
+            'department', 'laboratory_date')
+        return get_deadline_records(counters)
 
 
 class BoardLaboratorySampleLaboratoryDate(ModelView):
@@ -14,13 +14,16 @@ from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
 from trytond.transaction import Transaction
-from trytond.tools import get_smtp_server
 from trytond.config import config as tconfig
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
+from .smtp import SMTPPool
 
 logger = logging.getLogger(__name__)
 
+# Messages built before they are delivered together
+SMTP_BATCH_SIZE = tconfig.getint('lims_email', 'smtp_batch_size', default=20)
+
 
 class ResultsReportVersionDetail(metaclass=PoolMeta):
     __name__ = 'lims.results_report.version.detail'
@@ -510,6 +513,8 @@ class SendResultsReport(Wizard):
 
         reports_not_ready = []
         reports_not_sent = []
+        outbox = []
+        smtp_pool = SMTPPool()
         for group in self.get_grouped_reports(active_ids).values():
             group['reports_ready'] = []
             group['to_addrs'] = {}
@@ -606,20 +611,14 @@ class SendResultsReport(Wizard):
 
             msg = self._create_msg(from_addr, to_addrs, subject,
                 body, hide_recipients, group['attachments_data'])
-            sent = self._send_msg(from_addr, to_addrs, msg)
-            if not sent:
-                reports_not_sent.extend(group['reports_ready'])
-                logger.warning('Send Results Report: Not sent')
-                continue
-            logger.info('Send Results Report: Sent')
+            outbox.append((group, to_addrs, msg))
+            if len(outbox) >= SMTP_BATCH_SIZE:
+                reports_not_sent.extend(
+                    self._deliver(smtp_pool, from_addr, outbox))
+                outbox = []
 
-            addresses = ', '.join(['"%s" <%s>' % (v, k)
-                    for k, v in group['to_addrs'].items()])
-            ResultsReport.write(group['reports_ready'], {
-                'sent': True, 'sent_date': datetime.now(),
-                'mailings': [('create', [{'addresses': addresses}])],
-                })
-            Transaction().commit()
+        reports_not_sent.extend(self._deliver(smtp_pool, from_addr, outbox))
+        smtp_pool.close()
 
         if reports_not_ready or reports_not_sent:
             logger.warning('Send Results Report: FAILED')
@@ -770,18 +769,35 @@ class SendResultsReport(Wizard):
             msg.attach(attachment)
         return msg
 
-    def _send_msg(self, from_addr, to_addrs, msg):
-        to_addrs = list(set(to_addrs))
-        success = False
-        try:
-            server = get_smtp_server()
-            server.sendmail(from_addr, to_addrs, msg.as_string())
-            server.quit()
-            success = True
-        except Exception as e:
-            logger.error('Send Results Report: Unable to deliver mail')
-            logger.error(str(e))
-        return success
+    def _deliver(self, smtp_pool, from_addr, outbox):
+        '''
+        Send the messages of the outbox and mark their reports as sent.
+        Return the reports not sent.
+        '''
+        ResultsReport = Pool().get('lims.results_report')
+
+        reports_not_sent = []
+        if not outbox:
+            return reports_not_sent
+
+        sent = smtp_pool.send_many([
+            (from_addr, list(set(to_addrs)), msg.as_string())
+            for _, to_addrs, msg in outbox])
+        for (group, _, _), success in zip(outbox, sent):
+            if not success:
+                reports_not_sent.extend(group['reports_ready'])
+                logger.warning('Send Results Report: Not sent')
+                continue
+            logger.info('Send Results Report: Sent')
+
+            addresses = ', '.join(['"%s" <%s>' % (v, k)
+                    for k, v in group['to_addrs'].items()])
+            ResultsReport.write(group['reports_ready'], {
+                'sent': True, 'sent_date': datetime.now(),
+                'mailings': [('create', [{'addresses': addresses}])],
+                })
+            Transaction().commit()
+        return reports_not_sent
 
     def default_failed(self, fields):
         default = {
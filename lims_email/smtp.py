@@ -0,0 +1,122 @@
+# This file is part of lims_email module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+
+from trytond.config import config
+from trytond.tools import get_smtp_server
+
+logger = logging.getLogger(__name__)
+
+# Connections kept open to deliver the messages
+SMTP_CONNECTIONS = config.getint('lims_email', 'smtp_connections',
+    default=4)
+# Messages sent through a connection before it is renewed
+SMTP_MESSAGES_PER_CONNECTION = config.getint('lims_email',
+    'smtp_messages_per_connection', default=50)
+# Attempts to deliver a message, the delay before the second attempt is
+# doubled on each retry
+SMTP_RETRIES = config.getint('lims_email', 'smtp_retries', default=3)
+SMTP_RETRY_DELAY = config.getfloat('lims_email', 'smtp_retry_delay',
+    default=1)
+
+
+class SMTPConnection(object):
+    '''
+    SMTP connection opened on the first message and renewed after
+    max_messages messages or an error
+    '''
+
+    def __init__(self, max_messages):
+        self.max_messages = max_messages
+        self.server = None
+        self.count = 0
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        if self.server is None:
+            self.server = get_smtp_server()
+        try:
+            self.server.sendmail(from_addr, to_addrs, msg)
+        except Exception:
+            self.close()
+            raise
+        self.count += 1
+        if self.count >= self.max_messages:
+            self.close()
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:
+                pass
+        self.server = None
+        self.count = 0
+
+
+class SMTPPool(object):
+    '''
+    Deliver messages in parallel through a small pool of persistent SMTP
+    connections, retrying the failed deliveries with backoff
+    '''
+
+    def __init__(self, size=None, messages_per_connection=None,
+            retries=None, retry_delay=None):
+        self.size = max(size or SMTP_CONNECTIONS, 1)
+        self.retries = max(retries or SMTP_RETRIES, 1)
+        self.retry_delay = (SMTP_RETRY_DELAY
+            if retry_delay is None else retry_delay)
+        self._connections = Queue()
+        for _ in range(self.size):
+            self._connections.put(SMTPConnection(
+                messages_per_connection or SMTP_MESSAGES_PER_CONNECTION))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def send(self, from_addr, to_addrs, msg):
+        '''
+        Send msg (a string) and return if it was delivered
+        '''
+        connection = self._connections.get()
+        try:
+            delay = self.retry_delay
+            for attempt in range(1, self.retries + 1):
+                try:
+                    connection.sendmail(from_addr, to_addrs, msg)
+                    return True
+                except Exception as e:
+                    logger.error('Unable to deliver mail (attempt %s/%s)',
+                        attempt, self.retries)
+                    logger.error(str(e))
+                if attempt < self.retries:
+                    time.sleep(delay)
+                    delay *= 2
+            return False
+        finally:
+            self._connections.put(connection)
+
+    def send_many(self, messages):
+        '''
+        Send the (from_addr, to_addrs, msg) messages and return for each
+        one if it was delivered
+        '''
+        if not messages:
+            return []
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            return list(executor.map(lambda m: self.send(*m), messages))
+
+    def close(self):
+        connections = []
+        while not self._connections.empty():
+            connection = self._connections.get()
+            connection.close()
+            connections.append(connection)
+        for connection in connections:
+            self._connections.put(connection)
@@ -1,16 +1,86 @@
 # This file is part of lims_email module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import threading
 import unittest
+import warnings
 
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import ModuleTestCase
+from trytond.config import config
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', DeprecationWarning)
+    import asyncore
+    import smtpd
+
+
+class SMTPServer(smtpd.SMTPServer):
+    'Local SMTP server that keeps the received messages'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.messages = []
+        self.connections = 0
+
+    def handle_accepted(self, conn, addr):
+        self.connections += 1
+        super().handle_accepted(conn, addr)
+
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        self.messages.append((mailfrom, rcpttos, data))
 
 
 class LimsTestCase(ModuleTestCase):
     'Test lims_email module'
     module = 'lims_email'
 
+    def setUp(self):
+        super().setUp()
+        self.smtp_uri = config.get('email', 'uri')
+        self.smtp_server = SMTPServer(('127.0.0.1', 0), None)
+        self.smtp_running = True
+
+        def loop():
+            while self.smtp_running:
+                asyncore.loop(timeout=0.05, count=1)
+        self.smtp_thread = threading.Thread(target=loop, daemon=True)
+        self.smtp_thread.start()
+        config.set('email', 'uri', 'smtp://127.0.0.1:%s' %
+            self.smtp_server.socket.getsockname()[1])
+
+    def tearDown(self):
+        self.smtp_running = False
+        self.smtp_thread.join()
+        self.smtp_server.close()
+        config.set('email', 'uri', self.smtp_uri)
+        super().tearDown()
+
+    def test_smtp_pool(self):
+        'Test SMTP pool'
+        from trytond.modules.lims_email.smtp import SMTPPool
+
+        messages = [('lims@example.com', ['party@example.com'],
+            'Subject: Report %s\n\nBody' % i) for i in range(10)]
+        with SMTPPool(size=2, messages_per_connection=3) as smtp_pool:
+            sent = smtp_pool.send_many(messages)
+
+        self.assertEqual(sent, [True] * 10)
+        self.assertEqual(len(self.smtp_server.messages), 10)
+        self.assertTrue(self.smtp_server.connections <= 5)
+
+    def test_smtp_pool_retry(self):
+        'Test SMTP pool retry'
+        from trytond.modules.lims_email.smtp import SMTPPool
+
+        port = self.smtp_server.socket.getsockname()[1]
+        self.smtp_server.close()
+        config.set('email', 'uri', 'smtp://127.0.0.1:%s' % port)
+        with SMTPPool(size=1, retries=2, retry_delay=0) as smtp_pool:
+            sent = smtp_pool.send('lims@example.com',
+                ['party@example.com'], 'Subject: Report\n\nBody')
+        self.assertFalse(sent)
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
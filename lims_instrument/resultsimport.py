@@ -8,11 +8,13 @@ import xlrd
 from xlutils.copy import copy
 from datetime import datetime
 from sql import Null, Literal
+from sql.aggregate import Min
 
 from trytond.model import ModelView, ModelSQL, fields, Unique
 from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
+from trytond.tools import grouped_slice
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 
@@ -33,11 +35,63 @@ class NotebookLine(metaclass=PoolMeta):
     imported_trace_report = fields.Boolean('Imported Trace report')
 
 
+class ResultsBuffer(object):
+    '''
+    Results parsed from an instrument file, stored in parallel columns of
+    fraction number, analysis code, repetition and values
+    '''
+    __slots__ = ('fractions', 'analyses', 'repetitions', 'values', '_index')
+
+    def __init__(self):
+        self.fractions = []
+        self.analyses = []
+        self.repetitions = []
+        self.values = []
+        self._index = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return zip(self.fractions, self.analyses, self.repetitions,
+            self.values)
+
+    def add(self, fraction, analysis, repetition, values):
+        '''
+        Add the values of a result, replacing the previous ones of the same
+        fraction, analysis and repetition
+        '''
+        key = (fraction, analysis, repetition)
+        position = self._index.get(key)
+        if position is not None:
+            self.values[position] = values
+            return
+        self._index[key] = len(self.values)
+        self.fractions.append(fraction)
+        self.analyses.append(analysis)
+        self.repetitions.append(repetition)
+        self.values.append(values)
+
+    def get(self, fraction, analysis, repetition, default=None):
+        position = self._index.get((fraction, analysis, repetition))
+        if position is None:
+            return default
+        return self.values[position]
+
+    def merge(self, other):
+        '''
+        Add the results of other buffer, the later ones take precedence
+        '''
+        for row in other:
+            self.add(*row)
+        return self
+
+
 class BaseImport(object):
 
     controller = None
     infile = None
-    rawresults = {}
+    rawresults = None
     mimetype = None
     numline = 0
     analysis_code = None
@@ -54,15 +108,29 @@ class BaseImport(object):
         self.controller = None
 
     def parse(self, infile):
-        self.rawresults = {}
+        '''
+        Parse infile into a new results buffer and return it
+        '''
+        self.rawresults = ResultsBuffer()
         if not self.controller:
             self.loadController()
         try:
-            return self.controller.parse(self, infile)
+            self.controller.parse(self, infile)
         except AttributeError:
             traceback.print_exc()
             raise UserError(gettext('lims_instrument.msg_not_implemented',
                 function='parse'))
+        return self.rawresults
+
+    def parse_files(self, infiles):
+        '''
+        Parse each file into its own buffer and merge them in one load
+        '''
+        rawresults = ResultsBuffer()
+        for infile in infiles:
+            rawresults.merge(self.parse(infile))
+        self.rawresults = rawresults
+        return rawresults
 
     def exportResults(self):
         '''
@@ -301,84 +369,129 @@ class NotebookLoadResultsFile(Wizard):
             ])
 
     def transition_collect(self):
-        cursor = Transaction().connection.cursor()
         pool = Pool()
-        Fraction = pool.get('lims.fraction')
-        Notebook = pool.get('lims.notebook')
         NotebookLine = pool.get('lims.notebook.line')
-        Analysis = pool.get('lims.analysis')
 
-        lines = []
-        for fline in [str(item).zfill(2) for item in range(1, 61)]:
-            file_ = getattr(self.start, 'infile_%s' % fline)
-            if not file_:
+        infiles = [getattr(self.start, 'infile_%s' % str(item).zfill(2))
+            for item in range(1, 61)]
+        raw_results = self.start.results_importer.parse_files(
+            [f for f in infiles if f])
+        if not raw_results:
+            return 'empty'
+
+        # Resolve every key present in the files before touching the lines
+        notebooks = self._get_notebooks(
+            set(str(n) for n in raw_results.fractions))
+        codes = self._get_automatic_analyses(set(raw_results.analyses))
+        notebook_lines = self._get_notebook_lines(
+            list(notebooks.values()), codes, set(raw_results.repetitions))
+        devices = self._get_devices(set(v['device']
+            for v in raw_results.values if v.get('device')))
+
+        lines, to_write = [], []
+        for number, analysis, rep, data in sorted(raw_results,
+                key=lambda r: str(r[0])):
+            notebook = notebooks.get(str(number))
+            if not notebook or analysis not in codes:
                 continue
-            self.start.results_importer.parse(file_)
-            raw_results = self.start.results_importer.rawresults
-            fractions_numbers = list(raw_results.keys())
-            if not fractions_numbers:
+            line = notebook_lines.get((notebook, analysis, rep))
+            if not line:
                 continue
-
-            numbers = '\', \''.join(str(n) for n in fractions_numbers)
-            cursor.execute('SELECT id, number '
-                'FROM "' + Fraction._table + '" '
-                'WHERE number IN (\'' + numbers + '\') '
-                'ORDER BY number ASC')
-
-            for f in cursor.fetchall():
-                cursor.execute('SELECT id '
-                    'FROM "' + Notebook._table + '" '
-                    'WHERE fraction = %s '
-                    'LIMIT 1', (f[0],))
-                notebook = cursor.fetchone()
-                if not notebook:
-                    continue
-
-                for analysis in list(raw_results[f[1]].keys()):
-                    cursor.execute('SELECT id '
-                        'FROM "' + Analysis._table + '" '
-                        'WHERE code = %s '
-                            'AND automatic_acquisition = TRUE '
-                        'LIMIT 1', (analysis,))
-                    if not cursor.fetchone():
-                        continue
-
-                    for rep in list(raw_results[f[1]][analysis].keys()):
-                        clause = [
-                            ('notebook', '=', notebook[0]),
-                            ('analysis', '=', analysis),
-                            ('repetition', '=', rep),
-                            ('start_date', '!=', None),
-                            ('result', 'in', [None, '']),
-                            ('converted_result', 'in', [None, '']),
-                            ('literal_result', 'in', [None, '']),
-                            ['OR', ('result_modifier', '=', None),
-                                ('result_modifier.code', 'not in',
-                                ['d', 'nd', 'pos', 'neg', 'ni', 'abs',
-                                    'pre', 'na'])],
-                            ['OR', ('converted_result_modifier', '=', None),
-                                ('converted_result_modifier.code', 'not in',
-                                ['d', 'nd', 'pos', 'neg', 'ni', 'abs',
-                                    'pre'])],
-                            ]
-                        line = NotebookLine.search(clause, limit=1)
-                        if not line:
-                            continue
-                        data = raw_results[f[1]][analysis][rep]
-                        res = self.get_results(line[0], data)
-                        if res:
-                            NotebookLine.write([line[0]], res)
-                            lines.append(line[0])
+            res = self.get_results(line, data, devices)
+            if res:
+                to_write.extend(([line], res))
+                lines.append(line)
+        if to_write:
+            NotebookLine.write(*to_write)
 
         if lines:
             self.result.result_lines = [l.id for l in lines]
             return 'result'
         return 'empty'
 
-    def get_results(self, line, data):
+    def _get_notebooks(self, numbers):
+        '''
+        Return the notebook of each fraction number
+        '''
+        cursor = Transaction().connection.cursor()
         pool = Pool()
-        Device = pool.get('lims.lab.device')
+        Fraction = pool.get('lims.fraction')
+        Notebook = pool.get('lims.notebook')
+        fraction = Fraction.__table__()
+        notebook = Notebook.__table__()
 
+        res = {}
+        for sub_numbers in grouped_slice(list(numbers)):
+            cursor.execute(*fraction.join(notebook,
+                    condition=notebook.fraction == fraction.id
+                    ).select(fraction.number, Min(notebook.id),
+                    where=fraction.number.in_(list(sub_numbers)),
+                    group_by=fraction.number))
+            res.update(cursor.fetchall())
+        return res
+
+    def _get_automatic_analyses(self, codes):
+        '''
+        Return the analysis codes with automatic acquisition
+        '''
+        cursor = Transaction().connection.cursor()
+        Analysis = Pool().get('lims.analysis')
+        analysis = Analysis.__table__()
+
+        res = set()
+        for sub_codes in grouped_slice(list(codes)):
+            cursor.execute(*analysis.select(analysis.code,
+                where=(analysis.code.in_(list(sub_codes)) &
+                    (analysis.automatic_acquisition == Literal(True)))))
+            res.update(c for c, in cursor.fetchall())
+        return res
+
+    def _get_notebook_lines(self, notebook_ids, codes, repetitions):
+        '''
+        Return the lines pending of results by notebook, analysis code and
+        repetition
+        '''
+        NotebookLine = Pool().get('lims.notebook.line')
+
+        res = {}
+        if not notebook_ids or not codes or not repetitions:
+            return res
+        for sub_ids in grouped_slice(notebook_ids):
+            clause = [
+                ('notebook', 'in', list(sub_ids)),
+                ('analysis.code', 'in', list(codes)),
+                ('repetition', 'in', list(repetitions)),
+                ('start_date', '!=', None),
+                ('result', 'in', [None, '']),
+                ('converted_result', 'in', [None, '']),
+                ('literal_result', 'in', [None, '']),
+                ['OR', ('result_modifier', '=', None),
+                    ('result_modifier.code', 'not in',
+                    ['d', 'nd', 'pos', 'neg', 'ni', 'abs',
+                        'pre', 'na'])],
+                ['OR', ('converted_result_modifier', '=', None),
+                    ('converted_result_modifier.code', 'not in',
+                    ['d', 'nd', 'pos', 'neg', 'ni', 'abs',
+                        'pre'])],
+                ]
+            for line in NotebookLine.search(clause):
+                res.setdefault((line.notebook.id, line.analysis.code,
+                    line.repetition), line)
+        return res
+
+    def _get_devices(self, codes):
+        '''
+        Return the device id of each device code
+        '''
+        Device = Pool().get('lims.lab.device')
+
+        res = {}
+        for sub_codes in grouped_slice(list(codes)):
+            for device in Device.search([('code', 'in', list(sub_codes))]):
+                res.setdefault(device.code, device.id)
+        return res
+
+    def get_results(self, line, data, devices=None):
         res = {}
         if 'result' in data or 'literal_result' in data:
             if 'result' in data:
@@ -395,9 +508,10 @@ class NotebookLoadResultsFile(Wizard):
                 res['imported_chromatogram'] = data['chromatogram']
             device = data['device'] if 'device' in data else None
             if device:
-                dev = Device.search([('code', '=', device)])
-                if dev:
-                    res['imported_device'] = dev[0].id
+                if devices is None:
+                    devices = self._get_devices([device])
+                if device in devices:
+                    res['imported_device'] = devices[device]
             if 'dilution_factor' in data:
                 res['imported_dilution_factor'] = data['dilution_factor']
             if 'rm_correction_formula' in data:
@@ -412,56 +526,91 @@ class NotebookLoadResultsFile(Wizard):
         default['result_lines'] = [l.id for l in self.result.result_lines]
         return default
 
-    def get_professionals(self, professionals_codes):
+    def split_professionals(self, professionals_codes):
+        professionals = ''.join(professionals_codes.split())
+        return professionals.split(',')
+
+    def get_professionals(self, professionals_codes, professionals=None):
         '''
         This function gets a string with one or more professionals codes,
         separated by commas, like: 'ABC' or 'JLB, ABC'
         It returns the professionals
         '''
-        cursor = Transaction().connection.cursor()
-        pool = Pool()
-        Professional = pool.get('lims.laboratory.professional')
+        codes = self.split_professionals(professionals_codes)
+        if professionals is None:
+            professionals = self._get_professionals(codes)
 
         res = []
-        professionals = ''.join(professionals_codes.split())
-        professionals = professionals.split(',')
-        for professional in professionals:
-            cursor.execute('SELECT id, code '
-                'FROM "' + Professional._table + '" '
-                'WHERE code = %s '
-                'LIMIT 1', (professional,))
-            prof = cursor.fetchone()
+        for code in codes:
+            prof = professionals.get(code)
             if not prof:
                 return []
             res.append(prof)
         return res
 
-    def check_professionals(self, professionals, method):
+    def _get_professionals(self, codes):
+        '''
+        Return the (id, code) of each professional code
+        '''
+        cursor = Transaction().connection.cursor()
+        Professional = Pool().get('lims.laboratory.professional')
+        professional = Professional.__table__()
+
+        res = {}
+        for sub_codes in grouped_slice(list(codes)):
+            cursor.execute(*professional.select(
+                professional.id, professional.code,
+                where=professional.code.in_(list(sub_codes)),
+                order_by=professional.id))
+            for prof in cursor.fetchall():
+                res.setdefault(prof[1], prof)
+        return res
+
+    def _get_qualifications(self, professional_ids, method_ids):
+        '''
+        Return the analytical qualification state by professional and
+        method
+        '''
         cursor = Transaction().connection.cursor()
-        pool = Pool()
-        LabProfessionalMethod = pool.get('lims.lab.professional.method')
+        LabProfessionalMethod = Pool().get('lims.lab.professional.method')
+        qualification = LabProfessionalMethod.__table__()
+
+        res = {}
+        if not method_ids:
+            return res
+        for sub_ids in grouped_slice(list(professional_ids)):
+            cursor.execute(*qualification.select(
+                qualification.professional, qualification.method,
+                qualification.state,
+                where=(qualification.professional.in_(list(sub_ids)) &
+                    qualification.method.in_(list(method_ids)) &
+                    (qualification.type == 'analytical')),
+                order_by=qualification.id))
+            for professional, method, state in cursor.fetchall():
+                res.setdefault((professional, method), state)
+        return res
+
+    def check_professionals(self, professionals, method,
+            qualifications=None):
+        if qualifications is None:
+            qualifications = self._get_qualifications(
+                [p[0] for p in professionals], [method.id])
 
         validated = False
         msg = ''
         for professional in professionals:
-            cursor.execute('SELECT state '
-                'FROM "' + LabProfessionalMethod._table + '" '
-                'WHERE professional = %s '
-                    'AND method = %s '
-                    'AND type = \'analytical\' '
-                'LIMIT 1', (professional[0], method.id))
-            qualification = cursor.fetchone()
+            qualification = qualifications.get((professional[0], method.id))
             if not qualification:
                 validated = False
                 msg += '%s not qualified for method: %s' % (
                     professional[1], method.code)
                 return validated, msg
-            elif qualification[0] == 'training':
+            elif qualification == 'training':
                 if not validated:
                     msg += '%s in training for method: %s. ' \
                         'Add qualified professional' % (
                             professional[1], method.code)
-            elif (qualification[0] in ('qualified', 'requalified')):
+            elif (qualification in ('qualified', 'requalified')):
                 validated = True
 
         return validated, msg
@@ -472,6 +621,7 @@ class NotebookLoadResultsFile(Wizard):
         ModelData = pool.get('ir.model.data')
         NotebookLine = pool.get('lims.notebook.line')
         AnalyticProfessional = pool.get('lims.notebook.line.professional')
+        NotebookSummary = pool.get('lims.notebook.summary')
         sql_table = NotebookLine.__table__()
 
         NOW = datetime.now()
@@ -480,6 +630,18 @@ class NotebookLoadResultsFile(Wizard):
         export_results = self.start.results_importer.exportResults()
         result_modifier_na = ModelData.get_id('lims', 'result_modifier_na')
 
+        # Resolve the professionals and their qualifications at once
+        codes, method_ids = set(), set()
+        for line in self.result.result_lines:
+            if line.imported_professionals:
+                codes.update(self.split_professionals(
+                    line.imported_professionals))
+                if line.method:
+                    method_ids.add(line.method.id)
+        professionals = self._get_professionals(codes)
+        qualifications = self._get_qualifications(
+            [p[0] for p in professionals.values()], method_ids)
+
         previous_professionals = []
         new_professionals = []
         for line in self.result.result_lines:
@@ -545,11 +707,13 @@ class NotebookLoadResultsFile(Wizard):
             values.append(line.imported_trace_report)
 
             line_previous_professionals = []
+            line_new_professionals = []
             if line.imported_professionals:
-                profs = self.get_professionals(line.imported_professionals)
+                profs = self.get_professionals(line.imported_professionals,
+                    professionals)
                 if profs:
                     validated, msg = self.check_professionals(
-                        profs, line.method)
+                        profs, line.method, qualifications)
                     if validated:
                         line_previous_professionals = [p for p in
                             line.professionals]
@@ -573,16 +737,12 @@ class NotebookLoadResultsFile(Wizard):
                 messages += message
 
                 # Update rawresults
-                if export_results:
-                    rawresults = self.start.results_importer.rawresults
-                    number = line.fraction.number
-                    if number in rawresults:
-                        code = line.analysis.code
-                        if code in rawresults[number]:
-                            rep = line.repetition
-                            if rep in rawresults[number][code]:
-                                rawresults[number][code][rep]['outcome'] = (
-                                    outcome)
+                rawresults = self.start.results_importer.rawresults
+                if export_results and rawresults:
+                    values = rawresults.get(line.fraction.number,
+                        line.analysis.code, line.repetition)
+                    if values is not None:
+                        values['outcome'] = outcome
 
             else:
                 previous_professionals.extend(line_previous_professionals)
@@ -612,6 +772,10 @@ class NotebookLoadResultsFile(Wizard):
                     columns, values,
                     where=(sql_table.id == line.id)))
 
+        # Results are written with SQL, bypassing the notebook summary
+        NotebookSummary.update_notebooks(
+            [line.notebook.id for line in self.result.result_lines])
+
         # Update Professionals
         AnalyticProfessional.delete(previous_professionals)
         AnalyticProfessional.create(new_professionals)
@@ -659,14 +823,11 @@ class NotebookLoadResultsFile(Wizard):
         workbook = xlrd.open_workbook(file_contents=filedata.getvalue(),
                 formatting_info=True)
         wb_copy = copy(workbook)
-        for fraction in rawresults:
-            for analysis in rawresults[fraction]:
-                for rep in rawresults[fraction][analysis]:
-                    repetition = rawresults[fraction][analysis][rep]
-                    if 'outcome' in repetition and 'status_cell' in repetition:
-                        sheet, row, col = repetition['status_cell']
-                        wb_sheet = wb_copy.get_sheet(sheet)
-                        wb_sheet.write(row, col, repetition['outcome'])
+        for repetition in (rawresults.values if rawresults else []):
+            if 'outcome' in repetition and 'status_cell' in repetition:
+                sheet, row, col = repetition['status_cell']
+                wb_sheet = wb_copy.get_sheet(sheet)
+                wb_sheet.write(row, col, repetition['outcome'])
         output = io.StringIO()
         wb_copy.save(output)
         return {'file': bytearray(output.getvalue())}
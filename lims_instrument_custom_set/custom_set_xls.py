@@ -2,12 +2,11 @@
 # This file is part of lims_instrument_custom_set module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-import io
 import xlrd
 
 from trytond.pool import Pool
 from trytond.transaction import Transaction
-from trytond.modules.lims.formula_parser import FormulaParser
+from trytond.modules.lims.formula_parser import evaluate_many
 
 IGNORE_SHEET = '###'
 ANALYSIS_CODE = 'Analysis Code'
@@ -23,14 +22,14 @@ def getControllerName():
 
 
 def parse(self, infile):
-    LabWorkYear = Pool().get('lims.lab.workyear')
-
-    filedata = io.StringIO(infile)
-    workbook = xlrd.open_workbook(file_contents=filedata.getvalue())
+    # Sheets are loaded one at a time and released once read
+    workbook = xlrd.open_workbook(file_contents=infile, on_demand=True)
+    paddings = {}
     worksheets = workbook.sheet_names()
     for worksheet_name in worksheets:
         worksheet = workbook.sheet_by_name(worksheet_name)
         if worksheet.cell_value(0, 0) == IGNORE_SHEET:
+            workbook.unload_sheet(worksheet_name)
             continue
         self.analysis_code = None
         self.formula = None
@@ -38,6 +37,7 @@ def parse(self, infile):
         num_rows = worksheet.nrows - 1
         curr_row = -1
         header_found = False
+        results = []
         while curr_row < num_rows:
             curr_row += 1
             row = worksheet.row(curr_row)
@@ -69,15 +69,13 @@ def parse(self, infile):
                     header_found = False
                     continue
 
-                workyear = LabWorkYear.search(
-                    ['code', '=', str(int(row[1]))
-                    ])
-                padding = None
-                if workyear and workyear[0] and workyear[0].sample_sequence:
-                    padding = workyear[0].sample_sequence.padding
+                year = str(int(row[1]))
+                if year not in paddings:
+                    paddings[year] = get_padding(year)
+                padding = paddings[year]
                 if padding:
                     sample = '%%0%sd' % padding % int(row[0])
-                    fraction = str(int(row[1])) + '/' + sample + \
+                    fraction = year + '/' + sample + \
                         '-' + str(int(row[2]))
                     repetition = int(row[3])
                     values = {}
@@ -89,23 +87,26 @@ def parse(self, infile):
                         h = ''.join(h.split('.'))
                         values[h] = row[i]
                         i += 1
-                    formulaParser = FormulaParser(self.formula, values)
-                    values['result'] = formulaParser.getValue()
-                    values['row_number'] = curr_row + 1
-                    if fraction in self.rawresults:
-                        if self.analysis_code in self.rawresults[fraction]:
-                            self.rawresults[fraction][self.analysis_code][
-                                repetition] = values
-                        else:
-                            self.rawresults[fraction][self.analysis_code] = {
-                                repetition: values,
-                                }
-                    else:
-                        self.rawresults[fraction] = {
-                            self.analysis_code: {
-                                repetition: values,
-                                },
-                            }
+                    results.append((fraction, repetition, values,
+                        curr_row + 1))
+
+        # The formula is compiled once and evaluated for all the rows
+        if results:
+            evaluated = evaluate_many(self.formula, [r[2] for r in results])
+            for (fraction, repetition, values, row_number), result in zip(
+                    results, evaluated):
+                values['result'] = result
+                values['row_number'] = row_number
+                self.rawresults.add(fraction, self.analysis_code,
+                    repetition, values)
+        workbook.unload_sheet(worksheet_name)
+
+
+def get_padding(year):
+    LabWorkYear = Pool().get('lims.lab.workyear')
+    workyear = LabWorkYear.search(['code', '=', year])
+    if workyear and workyear[0] and workyear[0].sample_sequence:
+        return workyear[0].sample_sequence.padding
 
 
 def getAnalysisCode(self, row):
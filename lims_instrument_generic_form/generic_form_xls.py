@@ -128,17 +128,4 @@ def parse(self, infile):
                 values['device'] = device
             values['row_number'] = curr_row + 1
 
-            if fraction in self.rawresults:
-                if analysis_code in self.rawresults[fraction]:
-                    self.rawresults[fraction][analysis_code][
-                        repetition] = values
-                else:
-                    self.rawresults[fraction][analysis_code] = {
-                        repetition: values,
-                        }
-            else:
-                self.rawresults[fraction] = {
-                    analysis_code: {
-                        repetition: values,
-                        },
-                    }
+            self.rawresults.add(fraction, analysis_code, repetition, values)
@@ -4,19 +4,20 @@
 # the full copyright notices and license terms.
 import collections.abc
 from sql import (Table as SqlTable, Column as SqlColumn, Literal,
-    Desc, Asc, NullsFirst, NullsLast)
+    Desc, Asc, NullsFirst, NullsLast, Values, Cast)
 from sql.aggregate import Count
 import formulas
 import schedula
 import datetime
 from decimal import Decimal
-from itertools import chain
+from itertools import chain, groupby
 from collections import defaultdict
 
+from trytond import backend
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
-from trytond.tools import cursor_dict
+from trytond.tools import cursor_dict, grouped_slice
 from trytond.pyson import PYSONEncoder, Eval
 from trytond.rpc import RPC
 from trytond.exceptions import UserError
@@ -24,7 +25,7 @@ from trytond.cache import LRUDictTransaction
 from trytond.model.model import record as model_record
 from trytond.model.modelstorage import cache_size as model_cache_size
 from trytond.model.modelsql import convert_from
-from .interface import FIELD_TYPE_TRYTON, FIELD_TYPE_CAST
+from .interface import FIELD_TYPE_TRYTON, FIELD_TYPE_CAST, FIELD_TYPE_SQL
 
 
 ALLOWED_RESULT_TYPES = (str, int, float, Decimal, datetime.time,
@@ -643,21 +644,35 @@ class Data(ModelSQL, ModelView):
 
     @classmethod
     def create(cls, vlist):
+        database = Transaction().database
         sql_table = cls.get_sql_table()
         cursor = Transaction().connection.cursor()
 
         ids = []
-        for record in vlist:
-            fields = []
-            values = []
-            for key, value in record.items():
-                fields.append(SqlColumn(sql_table, key))
-                values.append(value)
-
-            query = sql_table.insert(fields, values=[values],
-                returning=[sql_table.id])
-            cursor.execute(*query)
-            ids.append(cursor.fetchone()[0])
+        if database.has_multirow_insert():
+            # Consecutive records with the same columns are inserted
+            # together with a single multi-row statement
+            for keys, records in groupby(vlist, key=lambda r: tuple(r)):
+                fields = [SqlColumn(sql_table, key) for key in keys]
+                for sub_records in grouped_slice(list(records)):
+                    values = [[record[key] for key in keys]
+                        for record in sub_records]
+                    query = sql_table.insert(fields, values=values,
+                        returning=[sql_table.id])
+                    cursor.execute(*query)
+                    ids.extend(r[0] for r in cursor)
+        else:
+            for record in vlist:
+                fields = []
+                values = []
+                for key, value in record.items():
+                    fields.append(SqlColumn(sql_table, key))
+                    values.append(value)
+
+                query = sql_table.insert(fields, values=[values],
+                    returning=[sql_table.id])
+                cursor.execute(*query)
+                ids.append(cursor.fetchone()[0])
         records = cls.browse(ids)
         cls.update_formulas(records)
         return records
@@ -702,70 +717,114 @@ class Data(ModelSQL, ModelView):
             sql_table = cls.get_sql_table()
             interface = cls.get_interface()
 
-        formula_fields = []
         fields = TableField.search([
             ('table', '=', table),
             ('formula', 'not in', [None, '']),
             ])
-        for field in fields:
-            col = Column.search([
-                ('interface', '=', interface),
-                ('alias', '=', field.name),
-                ])
-            order = col and col[0].evaluation_order or 0
-            formula_fields.append({
-                'order': order,
-                'field': field,
-                })
-        if not formula_fields:
+        if not fields:
             return
-        formula_fields = sorted(formula_fields, key=lambda x: x['order'])
+        evaluation_order = dict((c.alias, c.evaluation_order or 0)
+            for c in Column.search([
+                ('interface', '=', interface),
+                ('alias', 'in', [f.name for f in fields]),
+                ]))
+        formula_fields = sorted(fields,
+            key=lambda f: evaluation_order.get(f.name, 0))
 
         if not records:
             records = cls.search([])
-        for record in records:
-            vals = {}
-            fields = []
-            values = []
-            for field in formula_fields:
-                for x in (field['field'].inputs or '').split():
+        rows = [{} for record in records]
+        updates = [{} for record in records]
+        for field in formula_fields:
+            inputs = (field.inputs or '').split()
+            for record, vals in zip(records, rows):
+                for x in inputs:
                     if x not in vals:
                         vals[x] = getattr(record, x)
-                field_name = field['field'].name
-                value = record.get_formula_value(field['field'], vals)
+            field_name = field.name
+            values = cls.get_formula_values(field, rows)
+            for value, vals, update in zip(values, rows, updates):
                 if value is None:
                     continue
-                fields.append(SqlColumn(sql_table, field_name))
-                values.append(value)
+                update[field_name] = value
                 vals[field_name] = value
 
-            if not values:
+        if backend.name == 'postgresql':
+            cls._update_formulas_values(sql_table, formula_fields,
+                records, updates)
+            return
+        for record, update in zip(records, updates):
+            if not update:
                 continue
-            query = sql_table.update(fields, values,
+            query = sql_table.update(
+                [SqlColumn(sql_table, f) for f in update.keys()],
+                list(update.values()),
                 where=(sql_table.id == record.id))
             cursor.execute(*query)
 
+    @classmethod
+    def _update_formulas_values(cls, sql_table, formula_fields, records,
+            updates):
+        '''
+        Apply the formula values of many records with one
+        UPDATE ... FROM (VALUES ...) per set of updated fields
+        '''
+        database = Transaction().database
+        cursor = Transaction().connection.cursor()
+
+        sql_types = dict((f.name, database.sql_type(
+                    FIELD_TYPE_SQL[f.type]).base) for f in formula_fields)
+        to_update = defaultdict(list)
+        for record, update in zip(records, updates):
+            if not update:
+                continue
+            # Each cell is cast because PostgreSQL resolves one type per
+            # VALUES column from all its rows
+            to_update[tuple(update.keys())].append(
+                [record.id] + [Cast(Literal(v), sql_types[f])
+                    for f, v in update.items()])
+
+        for field_names, rows in to_update.items():
+            for sub_rows in grouped_slice(rows):
+                values = Values(list(sub_rows))
+                columns = [SqlColumn(sql_table, f) for f in field_names]
+                expressions = [SqlColumn(values, 'column%s' % (i + 2))
+                    for i in range(len(field_names))]
+                query = sql_table.update(columns, expressions,
+                    from_=[values],
+                    where=(sql_table.id == SqlColumn(values, 'column1')))
+                cursor.execute(*query)
+
     def get_formula_value(self, field, vals={}):
+        return self.get_formula_values(field, [vals])[0]
+
+    @classmethod
+    def get_formula_values(cls, field, rows):
+        '''
+        Evaluate the formula of field for each row of values, compiling
+        the formula only once for the whole column
+        '''
         ast = field.get_ast()
-        inputs = []
-        for x in (field.inputs or '').split():
-            inputs.append(vals.get(x))
-        try:
-            value = ast(*inputs)
-        except schedula.utils.exc.DispatcherError as e:
-            raise UserError(e.args[0] % e.args[1:])
-
-        if isinstance(value, list):
-            value = str(value)
-        elif not isinstance(value, ALLOWED_RESULT_TYPES):
-            value = value.tolist()
-        if isinstance(value, formulas.tokens.operand.XlError):
-            value = None
-        elif isinstance(value, list):
-            for x in chain(*value):
-                if isinstance(x, formulas.tokens.operand.XlError):
-                    value = None
-        return value
+        inputs = (field.inputs or '').split()
+        res = []
+        for vals in rows:
+            try:
+                value = ast(*[vals.get(x) for x in inputs])
+            except schedula.utils.exc.DispatcherError as e:
+                raise UserError(e.args[0] % e.args[1:])
+
+            if isinstance(value, list):
+                value = str(value)
+            elif not isinstance(value, ALLOWED_RESULT_TYPES):
+                value = value.tolist()
+            if isinstance(value, formulas.tokens.operand.XlError):
+                value = None
+            elif isinstance(value, list):
+                for x in chain(*value):
+                    if isinstance(x, formulas.tokens.operand.XlError):
+                        value = None
+            res.append(value)
+        return res
 
     @classmethod
     def delete(cls, records):
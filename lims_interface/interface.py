@@ -12,14 +12,16 @@ import csv
 import hashlib
 import tempfile
 import json
+from threading import Lock
 from openpyxl import load_workbook
 from decimal import Decimal
 from datetime import datetime, date, time
 from dateutil import relativedelta
-from itertools import chain
+from itertools import chain, islice
 from collections import defaultdict
 
 from trytond.config import config
+from trytond.cache import LRUDict
 from trytond.model import (Workflow, ModelView, ModelSQL, fields,
     sequence_ordered, Unique)
 from trytond.wizard import (Wizard, StateTransition, StateView, StateAction,
@@ -29,6 +31,7 @@ from trytond.pyson import PYSONDecoder, PYSONEncoder, Eval, Bool, Not, And, Or
 from trytond.transaction import Transaction
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
+from trytond.tools import grouped_slice
 from .function import custom_functions
 
 FUNCTIONS = formulas.get_functions()
@@ -76,6 +79,7 @@ VALID_NEXT_SYMBOLS = '_0123456789'
 VALID_SYMBOLS = VALID_FIRST_SYMBOLS + VALID_NEXT_SYMBOLS
 
 BLOCKSIZE = 65536
+COLLECT_CHUNK_SIZE = 1000
 
 if config.getboolean('lims_interface', 'filestore', default=False):
     file_id = 'origin_file_id'
@@ -84,6 +88,10 @@ else:
     file_id = None
     store_prefix = None
 
+_formula_cache = LRUDict(config.getint('cache', 'lims_interface_formula',
+    default=1024))
+_formula_cache_lock = Lock()
+
 
 def convert_to_symbol(text):
     if not text:
@@ -106,6 +114,37 @@ def convert_to_symbol(text):
     return symbol
 
 
+def get_formula_ast(formula, key=None):
+    '''
+    Return the compiled function of an expression. Compiled functions are
+    kept by database, key (table and field) and formula text, so a formula
+    is only parsed and compiled once per process.
+    '''
+    cache_key = (Transaction().database.name, key, formula)
+    with _formula_cache_lock:
+        try:
+            return _formula_cache[cache_key]
+        except KeyError:
+            pass
+    parser = formulas.Parser()
+    ast = parser.ast(formula)[1].compile()
+    with _formula_cache_lock:
+        _formula_cache[cache_key] = ast
+    return ast
+
+
+def clear_formula_cache():
+    with _formula_cache_lock:
+        _formula_cache.clear()
+
+
+def _repetition_key(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
 def str2date(value, lang=None):
     Lang = Pool().get('ir.lang')
     if lang is None:
@@ -296,6 +335,11 @@ class Interface(Workflow, ModelSQL, ModelView):
                 [sql_table.state], ['cancelled'],
                 where=sql_table.state == 'canceled'))
 
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        clear_formula_cache()
+
     @classmethod
     def view_attributes(cls):
         return [
@@ -356,8 +400,7 @@ class Interface(Workflow, ModelSQL, ModelView):
         def get_inputs(formula):
             if not formula:
                 return
-            parser = formulas.Parser()
-            ast = parser.ast(formula)[1].compile()
+            ast = get_formula_ast(formula)
             return (' '.join([x for x in ast.inputs])).lower()
 
         for interface in interfaces:
@@ -996,6 +1039,16 @@ class Column(sequence_ordered(), ModelSQL, ModelView):
         if self.interface:
             return self.interface.state
 
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        clear_formula_cache()
+
+    @classmethod
+    def delete(cls, columns):
+        super().delete(columns)
+        clear_formula_cache()
+
     @classmethod
     def validate(cls, columns):
         for column in columns:
@@ -1648,14 +1701,6 @@ class Compilation(Workflow, ModelSQL, ModelView):
                 getattr(c, 'collect_%s' % c.interface.template_type)()
 
     def collect_csv(self, create_new_lines=True):
-        pool = Pool()
-        Origin = pool.get('lims.interface.compilation.origin')
-        Data = pool.get('lims.interface.data')
-        NotebookLine = pool.get('lims.notebook.line')
-
-        data_create = []
-        data_write = []
-
         schema, formula_fields = self._get_schema()
         schema_keys = list(schema.keys())
         separator = {
@@ -1669,21 +1714,14 @@ class Compilation(Workflow, ModelSQL, ModelView):
         delimiter = separator[self.interface.field_separator]
         first_row = self.interface.first_row - 1
         encoding = self.interface.charset
-        with Transaction().set_context(
-                lims_interface_table=self.table):
-            imported_files = []
-            for origin in self.origins:
-                if origin.imported:
-                    continue
-                filedata = io.BytesIO(origin.origin_file)
-                wrapper = io.TextIOWrapper(filedata, encoding=encoding)
-                try:
-                    str_data = io.StringIO(wrapper.read())
-                except UnicodeDecodeError:
-                    raise UserError(gettext(
-                        'lims_interface.invalid_interface_charset'))
-                reader = csv.reader(str_data, delimiter=delimiter)
-                count = 0
+        resources = {}
+
+        def read_lines(origin):
+            filedata = io.BytesIO(origin.origin_file)
+            wrapper = io.TextIOWrapper(filedata, encoding=encoding)
+            reader = csv.reader(wrapper, delimiter=delimiter)
+            count = 0
+            try:
                 for row in reader:
                     if count < first_row:
                         count += 1
@@ -1720,168 +1758,175 @@ class Compilation(Workflow, ModelSQL, ModelView):
                             line[k] = str2date(value, self.interface.language)
                         elif (schema[k]['type'] == 'many2one' and
                                 default_value):
-                            resource = get_model_resource(
-                                schema[k]['model_name'], value,
-                                schema[k]['field_name'])
-                            line[k] = resource[0].id
+                            if k not in resources:
+                                resources[k] = get_model_resource(
+                                    schema[k]['model_name'], value,
+                                    schema[k]['field_name'])[0].id
+                            line[k] = resources[k]
                         else:
                             line[k] = str(value)
-
-                    f_fields = sorted(formula_fields.items(),
-                        key=lambda x: x[1]['evaluation_order'])
-                    for field in f_fields:
-                        line[field[0]] = self._get_formula_value(field, line)
-
-                    line['notebook_line'] = self._get_notebook_line(line)
-                    if (line['notebook_line']):
-                        nl = NotebookLine(line['notebook_line'])
-                        for k in schema_keys:
-                            default_value = schema[k]['default_value']
-                            if (default_value not in (None, '') and
-                                    default_value.startswith('=')):
-                                path = default_value[1:].split('.')
-                                field = path.pop(0)
-                                try:
-                                    value = getattr(nl, field)
-                                    while path:
-                                        field = path.pop(0)
-                                        value = getattr(value, field)
-                                except AttributeError:
-                                    value = None
-                                line[k] = value
-                    line_id = self._get_compilation_line_id(line)
-                    if line_id:
-                        line['id'] = line_id
-                        data_write.append(line)
-                    else:
-                        data_create.append(line)
                     count += 1
-                imported_files.append(origin)
-
-            if imported_files:
-                Origin.write(imported_files, {'imported': True})
+                    yield line
+            except UnicodeDecodeError:
+                raise UserError(gettext(
+                    'lims_interface.invalid_interface_charset'))
 
-            if data_create and create_new_lines:
-                Data.create(data_create)
-            for data in data_write:
-                data_line = Data(data['id'])
-                del data['id']
-                del data['notebook_line']
-                del data['compilation']
-                Data.write([data_line], data)
+        self._collect_lines(read_lines, schema, formula_fields,
+            create_new_lines)
 
     def collect_excel(self, create_new_lines=True):
+        schema, formula_fields = self._get_schema()
+        schema_keys = list(schema.keys())
+        first_row = self.interface.first_row
+        resources = {}
+
+        def read_lines(origin):
+            filedata = io.BytesIO(origin.origin_file)
+            book = load_workbook(filename=filedata, read_only=True,
+                data_only=True)
+            sheet = book.active
+            singletons = {}
+            for k in schema_keys:
+                if (schema[k]['singleton'] and
+                        schema[k]['default_value'] in (None, '')):
+                    singletons[k] = sheet.cell(row=schema[k]['row'],
+                        column=schema[k]['col']).value
+            try:
+                for row in sheet.iter_rows(min_row=first_row,
+                        values_only=True):
+                    line = {'compilation': self.id}
+                    for k in schema_keys:
+                        value = None
+                        default_value = schema[k]['default_value']
+                        if default_value not in (None, ''):
+                            if not create_new_lines:
+                                continue
+                            if default_value.startswith('='):
+                                continue
+                            value = default_value
+                        else:
+                            col = schema[k]['col']
+                            if k in singletons:
+                                value = singletons[k]
+                            elif col <= len(row):
+                                value = row[col - 1]
+                            if value is None:
+                                line[k] = None
+                                continue
+
+                        if schema[k]['type'] == 'integer':
+                            line[k] = int(value)
+                        elif schema[k]['type'] == 'float':
+                            line[k] = float(value)
+                        elif schema[k]['type'] == 'numeric':
+                            line[k] = Decimal(str(value))
+                        elif schema[k]['type'] == 'boolean':
+                            line[k] = bool(value)
+                        elif schema[k]['type'] == 'date':
+                            if default_value:
+                                line[k] = str2date(
+                                    value, self.interface.language)
+                            else:
+                                if isinstance(value, datetime):
+                                    line[k] = value
+                                else:
+                                    line[k] = None
+                        elif (schema[k]['type'] == 'many2one' and
+                                default_value):
+                            if k not in resources:
+                                resources[k] = get_model_resource(
+                                    schema[k]['model_name'], value,
+                                    schema[k]['field_name'])[0].id
+                            line[k] = resources[k]
+                        else:
+                            line[k] = str(value)
+                    yield line
+            finally:
+                book.close()
+
+        self._collect_lines(read_lines, schema, formula_fields,
+            create_new_lines)
+
+    def _collect_lines(self, read_lines, schema, formula_fields,
+            create_new_lines=True):
+        '''
+        Load the lines read from the pending origins by chunks: notebook
+        lines are resolved with one query per chunk, and the data lines
+        are created and written together
+        '''
         pool = Pool()
         Origin = pool.get('lims.interface.compilation.origin')
         Data = pool.get('lims.interface.data')
-        NotebookLine = pool.get('lims.notebook.line')
 
-        data_create = []
-        data_write = []
-
-        schema, formula_fields = self._get_schema()
         schema_keys = list(schema.keys())
-        first_row = self.interface.first_row
+        f_fields = sorted(formula_fields.items(),
+            key=lambda x: x[1]['evaluation_order'])
+
         with Transaction().set_context(
                 lims_interface_table=self.table):
+            compilation_lines = self._get_compilation_lines_index()
             imported_files = []
             for origin in self.origins:
                 if origin.imported:
                     continue
-                filedata = io.BytesIO(origin.origin_file)
-                book = load_workbook(filename=filedata, data_only=True)
-                sheet = book.active
-                max_row = sheet.max_row + 1
-                if first_row <= max_row:
-                    for i in range(first_row, max_row):
-                        line = {'compilation': self.id}
-                        for k in schema_keys:
-                            value = None
-                            default_value = schema[k]['default_value']
-                            if default_value not in (None, ''):
-                                if not create_new_lines:
-                                    continue
-                                if default_value.startswith('='):
-                                    continue
-                                value = default_value
-                            else:
-                                col = schema[k]['col']
-                                row = i
-                                if schema[k]['singleton']:
-                                    row = schema[k]['row']
-                                value = sheet.cell(row=row, column=col).value
-                                if value is None:
-                                    line[k] = None
-                                    continue
-
-                            if schema[k]['type'] == 'integer':
-                                line[k] = int(value)
-                            elif schema[k]['type'] == 'float':
-                                line[k] = float(value)
-                            elif schema[k]['type'] == 'numeric':
-                                line[k] = Decimal(str(value))
-                            elif schema[k]['type'] == 'boolean':
-                                line[k] = bool(value)
-                            elif schema[k]['type'] == 'date':
-                                if default_value:
-                                    line[k] = str2date(
-                                        value, self.interface.language)
-                                else:
-                                    if isinstance(value, datetime):
-                                        line[k] = value
-                                    else:
-                                        line[k] = None
-                            elif (schema[k]['type'] == 'many2one' and
-                                    default_value):
-                                resource = get_model_resource(
-                                    schema[k]['model_name'], value,
-                                    schema[k]['field_name'])
-                                line[k] = resource[0].id
-                            else:
-                                line[k] = str(value)
-
-                        f_fields = sorted(formula_fields.items(),
-                            key=lambda x: x[1]['evaluation_order'])
-                        for field in f_fields:
-                            line[field[0]] = self._get_formula_value(
-                                field, line)
-
-                        line['notebook_line'] = self._get_notebook_line(line)
-                        if (line['notebook_line']):
-                            nl = NotebookLine(line['notebook_line'])
-                            for k in schema_keys:
-                                default_value = schema[k]['default_value']
-                                if (default_value not in (None, '') and
-                                        default_value.startswith('=')):
-                                    path = default_value[1:].split('.')
-                                    field = path.pop(0)
-                                    try:
-                                        value = getattr(nl, field)
-                                        while path:
-                                            field = path.pop(0)
-                                            value = getattr(value, field)
-                                    except AttributeError:
-                                        value = None
-                                    line[k] = value
-                        line_id = self._get_compilation_line_id(line)
-                        if line_id:
-                            line['id'] = line_id
-                            data_write.append(line)
-                        else:
-                            data_create.append(line)
+                lines = read_lines(origin)
+                while True:
+                    chunk = list(islice(lines, COLLECT_CHUNK_SIZE))
+                    if not chunk:
+                        break
+                    data_create, data_write = self._collect_chunk(chunk,
+                        schema, schema_keys, f_fields, compilation_lines)
+                    if data_create and create_new_lines:
+                        Data.create(data_create)
+                    to_write = []
+                    for data in data_write:
+                        data_line = Data(data['id'])
+                        del data['id']
+                        del data['notebook_line']
+                        del data['compilation']
+                        to_write.extend(([data_line], data))
+                    if to_write:
+                        Data.write(*to_write)
                 imported_files.append(origin)
 
             if imported_files:
                 Origin.write(imported_files, {'imported': True})
 
-            if data_create and create_new_lines:
-                Data.create(data_create)
-            for data in data_write:
-                data_line = Data(data['id'])
-                del data['id']
-                del data['notebook_line']
-                del data['compilation']
-                Data.write([data_line], data)
+    def _collect_chunk(self, lines, schema, schema_keys, f_fields,
+            compilation_lines):
+        data_create = []
+        data_write = []
+
+        for field in f_fields:
+            values = self._get_formula_values(field, lines)
+            for line, value in zip(lines, values):
+                line[field[0]] = value
+
+        notebook_lines = self._get_notebook_lines(lines)
+        for line, nl in zip(lines, notebook_lines):
+            line['notebook_line'] = nl and nl.id or None
+            if nl:
+                for k in schema_keys:
+                    default_value = schema[k]['default_value']
+                    if (default_value not in (None, '') and
+                            default_value.startswith('=')):
+                        path = default_value[1:].split('.')
+                        field = path.pop(0)
+                        try:
+                            value = getattr(nl, field)
+                            while path:
+                                field = path.pop(0)
+                                value = getattr(value, field)
+                        except AttributeError:
+                            value = None
+                        line[k] = value
+            line_id = self._get_compilation_line_id(line, compilation_lines)
+            if line_id:
+                line['id'] = line_id
+                data_write.append(line)
+            else:
+                data_create.append(line)
+        return data_create, data_write
 
     def collect_txt(self, create_new_lines=True):
         return
@@ -1920,37 +1965,147 @@ class Compilation(Workflow, ModelSQL, ModelView):
         return schema, formula_fields
 
     def _get_formula_value(self, field, line):
-        parser = formulas.Parser()
-        ast = parser.ast(field[1]['formula'])[1].compile()
-        inputs = (' '.join([x for x in ast.inputs])).lower().split()
-        inputs = [line[x] for x in inputs]
-        try:
-            value = ast(*inputs)
-        except schedula.utils.exc.DispatcherError as e:
-            raise UserError(e.args[0] % e.args[1:])
+        return self._get_formula_values(field, [line])[0]
 
-        if isinstance(value, list):
-            value = str(value)
-        elif not isinstance(value, (str, int, float, Decimal, type(None))):
-            value = value.tolist()
-        if isinstance(value, formulas.tokens.operand.XlError):
-            value = None
-        elif isinstance(value, list):
-            for x in chain(*value):
-                if isinstance(x, formulas.tokens.operand.XlError):
-                    value = None
-        return value
+    def _get_formula_values(self, field, lines):
+        ast = get_formula_ast(field[1]['formula'],
+            (self.table and self.table.id, field[0]))
+        inputs = (' '.join([x for x in ast.inputs])).lower().split()
+        res = []
+        for line in lines:
+            try:
+                value = ast(*[line[x] for x in inputs])
+            except schedula.utils.exc.DispatcherError as e:
+                raise UserError(e.args[0] % e.args[1:])
+
+            if isinstance(value, list):
+                value = str(value)
+            elif not isinstance(value, (str, int, float, Decimal, type(None))):
+                value = value.tolist()
+            if isinstance(value, formulas.tokens.operand.XlError):
+                value = None
+            elif isinstance(value, list):
+                for x in chain(*value):
+                    if isinstance(x, formulas.tokens.operand.XlError):
+                        value = None
+            res.append(value)
+        return res
 
     def _get_notebook_line(self, line):
+        nb_line, = self._get_notebook_lines([line])
+        return nb_line and nb_line.id or None
+
+    def _get_notebook_lines(self, lines):
+        '''
+        Return the notebook line of each line (or None), searching the
+        notebook lines of all the lines at once
+        '''
         pool = Pool()
         NotebookLine = pool.get('lims.notebook.line')
 
+        res = [None] * len(lines)
         fraction_field = self.interface.fraction_field
         analysis_field = self.interface.analysis_field
         repetition_field = self.interface.repetition_field
         if not fraction_field or not analysis_field or not repetition_field:
-            return None
+            return res
+        method_field = self.interface.method_field
+
+        keys = []
+        for line in lines:
+            fraction_value = line.get(fraction_field.alias)
+            analysis_value = line.get(analysis_field.alias)
+            repetition_value = line.get(repetition_field.alias)
+            if (fraction_value is None or
+                    analysis_value is None or
+                    repetition_value is None):
+                keys.append(None)
+                continue
+            method_value = None
+            if method_field:
+                method_value = line.get(method_field.alias)
+                if method_value is not None:
+                    method_value = method_value.split(' - ')[0]
+            keys.append((str(fraction_value),
+                analysis_value.split(' - ')[0],
+                _repetition_key(repetition_value),
+                method_value))
+        if not any(keys):
+            return res
+
+        nb_lines = defaultdict(list)
+        for sub_keys in grouped_slice(list(set(k for k in keys if k))):
+            sub_keys = list(sub_keys)
+            clause = [
+                ('notebook.fraction.number', 'in',
+                    list(set(k[0] for k in sub_keys))),
+                ('analysis.code', 'in', list(set(k[1] for k in sub_keys))),
+                ('analysis.automatic_acquisition', '=', True),
+                ('repetition', 'in', list(set(k[2] for k in sub_keys))),
+                ('annulled', '=', False),
+                ]
+            for nb_line in NotebookLine.search(clause):
+                nb_lines[(nb_line.notebook.fraction.number,
+                    nb_line.analysis.code, nb_line.repetition)].append(
+                    nb_line)
+
+        for i, key in enumerate(keys):
+            if not key:
+                continue
+            for nb_line in nb_lines.get(key[:3], []):
+                if key[3] is not None and (not nb_line.method or
+                        nb_line.method.code != key[3]):
+                    continue
+                res[i] = nb_line
+                break
+        return res
+
+    def _get_compilation_lines_index(self):
+        '''
+        Index the existing lines of the compilation by notebook line and by
+        fraction, analysis, repetition (and method)
+        '''
+        pool = Pool()
+        Data = pool.get('lims.interface.data')
+
+        by_notebook_line = {}
+        by_key = {}
+        fraction_field = self.interface.fraction_field
+        analysis_field = self.interface.analysis_field
+        repetition_field = self.interface.repetition_field
+        method_field = self.interface.method_field
+        key_fields = []
+        if fraction_field and analysis_field and repetition_field:
+            key_fields = [fraction_field.alias, analysis_field.alias,
+                repetition_field.alias]
+            if method_field:
+                key_fields.append(method_field.alias)
+
+        lines = Data.search([('compilation', '=', self.id)])
+        for line in Data.read([x.id for x in lines],
+                ['id', 'notebook_line'] + key_fields):
+            if line['notebook_line']:
+                by_notebook_line.setdefault(line['notebook_line'], line['id'])
+            if key_fields:
+                key = tuple(line[k] for k in key_fields[:3])
+                by_key.setdefault(key, line['id'])
+                if method_field:
+                    by_key.setdefault(key + (line[key_fields[3]],), line['id'])
+        return by_notebook_line, by_key
+
+    def _get_compilation_line_id(self, line, compilation_lines=None):
+        if compilation_lines is None:
+            compilation_lines = self._get_compilation_lines_index()
+        by_notebook_line, by_key = compilation_lines
 
+        if line.get('notebook_line'):
+            return by_notebook_line.get(line['notebook_line'])
+
+        fraction_field = self.interface.fraction_field
+        analysis_field = self.interface.analysis_field
+        repetition_field = self.interface.repetition_field
+        if not fraction_field or not analysis_field or not repetition_field:
+            return None
         fraction_value = line.get(fraction_field.alias)
         analysis_value = line.get(analysis_field.alias)
         repetition_value = line.get(repetition_field.alias)
@@ -1958,63 +2113,13 @@ class Compilation(Workflow, ModelSQL, ModelView):
                 analysis_value is None or
                 repetition_value is None):
             return None
-
-        clause = [
-            ('notebook.fraction.number', '=', fraction_value),
-            ('analysis.code', '=', analysis_value.split(' - ')[0]),
-            ('analysis.automatic_acquisition', '=', True),
-            ('repetition', '=', repetition_value),
-            ('annulled', '=', False),
-            ]
+        key = (fraction_value, analysis_value, repetition_value)
         method_field = self.interface.method_field
         if method_field:
             method_value = line.get(method_field.alias)
             if method_value is not None:
-                clause.append(
-                    ('method.code', '=', method_value.split(' - ')[0]))
-
-        nb_line = NotebookLine.search(clause)
-        if nb_line:
-            return nb_line[0].id
-        return None
-
-    def _get_compilation_line_id(self, line):
-        pool = Pool()
-        Data = pool.get('lims.interface.data')
-
-        clause = [('compilation', '=', line['compilation'])]
-        if line.get('notebook_line'):
-            clause.append(('notebook_line', '=', line['notebook_line']))
-
-        else:
-            sub_clause = [('id', '=', -1)]
-            fraction_field = self.interface.fraction_field
-            analysis_field = self.interface.analysis_field
-            repetition_field = self.interface.repetition_field
-            if fraction_field and analysis_field and repetition_field:
-
-                fraction_value = line.get(fraction_field.alias)
-                analysis_value = line.get(analysis_field.alias)
-                repetition_value = line.get(repetition_field.alias)
-
-                if (fraction_value is not None and
-                        analysis_value is not None and
-                        repetition_value is not None):
-                    sub_clause = [
-                        (fraction_field.alias, '=', fraction_value),
-                        (analysis_field.alias, '=', analysis_value),
-                        (repetition_field.alias, '=', repetition_value),
-                        ]
-                    method_field = self.interface.method_field
-                    if method_field:
-                        method_value = line.get(method_field.alias)
-                        if method_value is not None:
-                            sub_clause.append(
-                                (method_field.alias, '=', method_value))
-
-            clause.extend(sub_clause)
-        line = Data.search(clause)
-        return line and line[0].id or None
+                key += (method_value,)
+        return by_key.get(key)
 
     @classmethod
     @ModelView.button
@@ -2,12 +2,11 @@
 # This file is part of lims_interface module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-import formulas
-
 from trytond import backend
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.transaction import Transaction
-from .interface import FIELD_TYPE_SQL, FIELD_TYPE_SELECTION
+from .interface import (FIELD_TYPE_SQL, FIELD_TYPE_SELECTION,
+    get_formula_ast, clear_formula_cache)
 
 
 class ModelEmulation:
@@ -104,10 +103,18 @@ class TableField(ModelSQL, ModelView):
     group_colspan = fields.Integer('Group Colspan')
     group_col = fields.Integer('Group Col')
 
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        clear_formula_cache()
+
+    @classmethod
+    def delete(cls, table_fields):
+        super().delete(table_fields)
+        clear_formula_cache()
+
     def get_ast(self):
-        parser = formulas.Parser()
-        ast = parser.ast(self.formula)[1].compile()
-        return ast
+        return get_formula_ast(self.formula, (self.table.id, self.name))
 
 
 class TableGroupedField(ModelSQL, ModelView):
@@ -134,17 +141,25 @@ class TableGroupedField(ModelSQL, ModelView):
     group = fields.Integer('Group')
     default_width = fields.Integer('Default Width')
 
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        clear_formula_cache()
+
+    @classmethod
+    def delete(cls, table_fields):
+        super().delete(table_fields)
+        clear_formula_cache()
+
     def get_inputs(self, name=None):
         if not self.formula:
             return
-        parser = formulas.Parser()
-        ast = parser.ast(self.formula)[1].compile()
+        ast = self.get_ast()
         return (' '.join([x for x in ast.inputs])).lower()
 
     def get_ast(self):
-        parser = formulas.Parser()
-        ast = parser.ast(self.formula)[1].compile()
-        return ast
+        return get_formula_ast(self.formula,
+            ('grouped', self.table.id, self.name))
 
 
 class TableView(ModelSQL, ModelView):
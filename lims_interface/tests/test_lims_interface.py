@@ -3,14 +3,59 @@
 # the full copyright notices and license terms.
 import unittest
 
+from sql import Table as SqlTable
+
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond import backend
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.pool import Pool
+from trytond.transaction import Transaction
 
 
 class LimsTestCase(ModuleTestCase):
     'Test lims_interface module'
     module = 'lims_interface'
 
+    @unittest.skipIf(backend.name != 'postgresql',
+        'formula values are updated in bulk only on postgresql')
+    @with_transaction()
+    def test_update_formulas_values_mixed_types(self):
+        'Test bulk update of a char formula with mixed result types'
+        pool = Pool()
+        Table = pool.get('lims.interface.table')
+        Data = pool.get('lims.interface.data')
+        cursor = Transaction().connection.cursor()
+
+        table, = Table.create([{
+                    'name': 'lims_interface_test_mixed',
+                    'fields_': [('create', [{
+                                    'name': 'a',
+                                    'string': 'A',
+                                    'type': 'float',
+                                    }, {
+                                    'name': 'b',
+                                    'string': 'B',
+                                    'type': 'char',
+                                    'formula': '=IF(A>1,"N/A",A*1.5)',
+                                    'inputs': 'a',
+                                    }])],
+                    }])
+        table.create_table()
+        sql_table = SqlTable(table.name)
+        cursor.execute(*sql_table.insert([sql_table.a],
+                values=[[0.5], [2.0]], returning=[sql_table.id]))
+        ids = [r[0] for r in cursor]
+
+        field, = [f for f in table.fields_ if f.name == 'b']
+        records = Data.browse(ids)
+        values = Data.get_formula_values(field, [{'a': 0.5}, {'a': 2.0}])
+        Data._update_formulas_values(sql_table, [field], records,
+            [{'b': v} for v in values])
+
+        cursor.execute(*sql_table.select(sql_table.b,
+                order_by=sql_table.id))
+        self.assertEqual([r[0] for r in cursor], ['0.75', 'N/A'])
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
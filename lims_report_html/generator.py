@@ -1,9 +1,32 @@
 # This file is part of lims_report_html module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-
+from io import BytesIO
+from PyPDF2 import PdfFileMerger
 from weasyprint import HTML, CSS
 
+from trytond.cache import LRUDict
+from trytond.config import config
+
+# Header and footer overlays already laid out, by their html, stylesheets,
+# page orientation and base url
+_overlay_cache = LRUDict(config.getint('cache', 'lims_report_html_overlay',
+    default=128))
+
+
+def merge_pdfs(documents):
+    '''
+    Merge the PDF documents of an iterable, reading each one only when
+    it is appended
+    '''
+    merger = PdfFileMerger(strict=False)
+    for document in documents:
+        merger.append(BytesIO(document))
+    output = BytesIO()
+    merger.write(output)
+    merger.close()
+    return output.getvalue()
+
 
 class PdfGenerator:
 
@@ -26,6 +49,9 @@ class PdfGenerator:
                 return box
             return PdfGenerator.get_element(box.all_children(), element)
 
+    def write_pdf(self):
+        return self.render_html().write_pdf()
+
     def render_html(self):
         if self.header_html:
             header_body, header_height = self._compute_overlay_element(
@@ -64,6 +90,15 @@ class PdfGenerator:
         return main_doc
 
     def _compute_overlay_element(self, element: str):
+        key = (element, getattr(self, '{}_html'.format(element)),
+            tuple(self.stylesheets), self.page_orientation, self.base_url)
+        overlay = _overlay_cache.get(key)
+        if overlay is None:
+            overlay = self._layout_overlay_element(element)
+            _overlay_cache[key] = overlay
+        return overlay
+
+    def _layout_overlay_element(self, element: str):
         overlay_layout = (
             '@page {size: A4 %s; margin: 0;}' % self.page_orientation +
             '\nheader {position: fixed; width: 100%; top: 0;}' +
@@ -7,11 +7,10 @@ from io import BytesIO
 from decimal import Decimal
 from datetime import date, datetime
 from binascii import b2a_base64
-from functools import partial
 from PyPDF2 import PdfFileMerger
 from PyPDF2.utils import PdfReadError
 from jinja2 import contextfilter, Markup
-from jinja2 import Environment, FunctionLoader
+from jinja2 import Environment, DictLoader
 from lxml import html as lxml_html
 from base64 import b64encode
 from babel.support import Translations as BabelTranslations
@@ -23,12 +22,19 @@ from trytond.report import Report
 from trytond.pool import Pool
 from trytond.pyson import Eval, Bool, Or
 from trytond.transaction import Transaction
-from trytond.cache import Cache
+from trytond.cache import Cache, LRUDict
+from trytond.config import config
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 from trytond.tools import file_open
 from trytond import backend
-from .generator import PdfGenerator
+from .generator import PdfGenerator, merge_pdfs
+
+
+# Environments with the compiled templates of the reports, by database,
+# template, modification dates and locale
+_environment_cache = LRUDict(config.getint('cache',
+    'lims_report_html_environment', default=256))
 
 
 class ReportTemplate(DeactivableMixin, ModelSQL, ModelView):
@@ -313,6 +319,14 @@ class ReportTemplateSection(ModelSQL, ModelView):
 
 class LimsReport(Report):
 
+    @classmethod
+    def _get_report_name(cls, action, records):
+        '''
+        Return the report name as the rendered report does
+        '''
+        record_name = records[0].rec_name if len(records) == 1 else None
+        return '-'.join(filter(None, [action.name, record_name]))
+
     @classmethod
     def execute_custom_lims_report(cls, ids, data):
         pool = Pool()
@@ -338,26 +352,10 @@ class LimsReport(Report):
         if not isinstance(content, str):
             content = bytearray(content) if bytes == str else bytes(content)
 
-        record = records[0]
-        if oext == 'pdf' and (record.previous_sections or
-                record.following_sections):
-            merger = PdfFileMerger(strict=False)
-            # Previous Sections
-            for section in record.previous_sections:
-                filedata = BytesIO(section.data)
-                merger.append(filedata)
-            # Main Report
-            filedata = BytesIO(content)
-            merger.append(filedata)
-            # Following Sections
-            for section in record.following_sections:
-                filedata = BytesIO(section.data)
-                merger.append(filedata)
-            output = BytesIO()
-            merger.write(output)
-            content = output.getvalue()
-
-        return (oext, content, action.direct_print, action.name)
+        if oext == 'pdf':
+            content = cls._merge_sections(records[0], content)
+        return (oext, content, action.direct_print,
+            cls._get_report_name(action, records))
 
     @classmethod
     def execute_html_lims_report(cls, ids, data):
@@ -379,28 +377,34 @@ class LimsReport(Report):
         oext, content = cls._execute_html_lims_report(records, data, action)
         if not isinstance(content, str):
             content = bytearray(content) if bytes == str else bytes(content)
-        return (oext, content, action.direct_print, action.name)
+        return (oext, content, action.direct_print,
+            cls._get_report_name(action, records))
 
     @classmethod
     def _execute_html_lims_report(cls, records, data, action):
         record = records[0]
+        document = cls._get_html_lims_document(record, data, action)
+        document = PdfGenerator(**document).write_pdf()
+        return 'pdf', cls._merge_sections(record, document)
+
+    @classmethod
+    def _get_html_lims_document(cls, record, data, action):
         template_id, tcontent, theader, tfooter = (
             cls.get_lims_template(action, record))
         context = Transaction().context
-        context['template'] = template_id
+        context['template'] = template_id and template_id.id
         if not template_id:
             context['default_translations'] = os.path.join(
                 os.path.dirname(__file__), 'report', 'translations')
+        sources = {'content': tcontent}
+        if theader:
+            sources['header'] = theader
+        if tfooter:
+            sources['footer'] = tfooter
         with Transaction().set_context(**context):
-            content = cls.render_lims_template(action,
-                tcontent, record=record, records=[record],
-                data=data)
-            header = theader and cls.render_lims_template(action,
-                theader, record=record, records=[record],
-                data=data)
-            footer = tfooter and cls.render_lims_template(action,
-                tfooter, record=record, records=[record],
-                data=data)
+            rendered = cls.render_lims_templates(action, sources,
+                key=cls.get_lims_template_key(action, record),
+                record=record, records=[record], data=data)
 
         stylesheets = cls.parse_stylesheets(tcontent)
         if theader:
@@ -411,30 +415,31 @@ class LimsReport(Report):
         page_orientation = (record.template and
             record.template.page_orientation or 'portrait')
 
-        document = PdfGenerator(content,
-            header_html=header, footer_html=footer,
-            side_margin=1, extra_vertical_margin=30,
-            stylesheets=stylesheets,
-            page_orientation=page_orientation).render_html().write_pdf()
+        return {
+            'main_html': rendered['content'],
+            'header_html': rendered.get('header'),
+            'footer_html': rendered.get('footer'),
+            'side_margin': 1,
+            'extra_vertical_margin': 30,
+            'stylesheets': stylesheets,
+            'page_orientation': page_orientation,
+            }
+
+    @classmethod
+    def _merge_sections(cls, record, document):
+        if not record.previous_sections and not record.following_sections:
+            return document
 
-        if record.previous_sections or record.following_sections:
-            merger = PdfFileMerger(strict=False)
+        def documents():
             # Previous Sections
             for section in record.previous_sections:
-                filedata = BytesIO(section.data)
-                merger.append(filedata)
+                yield section.data
             # Main Report
-            filedata = BytesIO(document)
-            merger.append(filedata)
+            yield document
             # Following Sections
             for section in record.following_sections:
-                filedata = BytesIO(section.data)
-                merger.append(filedata)
-            output = BytesIO()
-            merger.write(output)
-            document = output.getvalue()
-
-        return 'pdf', document
+                yield section.data
+        return merge_pdfs(documents())
 
     @classmethod
     def get_lims_template(cls, action, record):
@@ -455,10 +460,37 @@ class LimsReport(Report):
                 raise UserError(gettext('lims_report_html.msg_no_template'))
         return template_id, content, header, footer
 
+    @classmethod
+    def get_lims_template_key(cls, action, record):
+        '''
+        Key of the compiled templates of the record: the templates used
+        and their modification dates
+        '''
+        key = [(action.id, action.write_date or action.create_date)]
+        template = record.template
+        if template:
+            for t in (template, template.header, template.footer):
+                if t:
+                    key.append((t.id, t.write_date or t.create_date))
+        return tuple(key)
+
     @classmethod
     def render_lims_template(cls, action, template_string,
             record=None, records=None, data=None):
-        User = Pool().get('res.user')
+        return cls.render_lims_templates(action,
+            {'content': template_string}, record=record, records=records,
+            data=data)['content']
+
+    @classmethod
+    def render_lims_templates(cls, action, sources, key=None,
+            record=None, records=None, data=None):
+        '''
+        Render the template sources by name with a single report context.
+        The compiled templates are cached by key when it is set.
+        '''
+        pool = Pool()
+        User = pool.get('res.user')
+        Lang = pool.get('ir.lang')
         user = User(Transaction().user)
 
         if data and data.get('alt_lang'):
@@ -468,46 +500,65 @@ class LimsReport(Report):
         else:
             locale = Transaction().language
         with Transaction().set_context(locale=locale):
-            env = cls.get_lims_environment()
+            env = cls.get_lims_environment(sources, key)
 
-        report_template = env.from_string(template_string)
+        lang, = Lang.search([('code', '=', locale.split('_')[0] or 'en')])
         context = cls.get_context(records, header={}, data=data)
         context.update({
             'report': action,
             'get_image': cls.get_image,
             'operation': cls.operation,
+            '_render_lang': lang,
             })
-        res = report_template.render(**context)
-        res = cls.parse_images(res)
-        # print('TEMPLATE:\n', res)
+        res = {}
+        for name in sources:
+            res[name] = cls.parse_images(
+                env.get_template(name).render(**context))
         return res
 
     @classmethod
-    def get_lims_environment(cls):
+    def get_lims_environment(cls, sources=None, key=None):
+        transaction = Transaction()
+        context = transaction.context
+        locale = context.get('locale').split('_')[0]
+        if key is not None:
+            key = (transaction.database.name, cls.__name__, key, locale,
+                context.get('template'), context.get('default_translations'))
+            env = _environment_cache.get(key)
+            if env is not None:
+                return env
+
         extensions = ['jinja2.ext.i18n', 'jinja2.ext.autoescape',
             'jinja2.ext.with_', 'jinja2.ext.loopcontrols', 'jinja2.ext.do']
         env = Environment(extensions=extensions,
-            loader=FunctionLoader(lambda name: ''))
+            loader=DictLoader(sources or {}), auto_reload=False)
 
         env.filters.update(cls.get_lims_filters())
 
-        locale = Transaction().context.get('locale').split('_')[0]
         translations = TemplateTranslations(locale)
         env.install_gettext_translations(translations)
+        if key is not None:
+            _environment_cache[key] = env
         return env
 
     @classmethod
     def get_lims_filters(cls):
-        Lang = Pool().get('ir.lang')
+        '''
+        Filters of the environment, they must not depend on the
+        transaction as the environment is shared by the reports
+        '''
 
         def module_path(name):
             module, path = name.split('/', 1)
             with file_open(os.path.join(module, path)) as f:
                 return 'file://%s' % f.name
 
-        def render(value, digits=2, lang=None, filename=None):
+        @contextfilter
+        def render(context, value, digits=2, lang=None, filename=None):
             if value is None or value == '':
                 return ''
+            if lang is None:
+                lang = context.get('_render_lang')
 
             if isinstance(value, (float, Decimal)):
                 return lang.format('%.*f', (digits, value), grouping=True)
@@ -556,12 +607,9 @@ class LimsReport(Report):
                 result = Markup(result)
             return result
 
-        locale = Transaction().context.get('locale').split('_')[0]
-        lang, = Lang.search([('code', '=', locale or 'en')])
-
         return {
             'modulepath': module_path,
-            'render': partial(render, lang=lang),
+            'render': render,
             'subrender': subrender,
             }
 
@@ -593,6 +641,8 @@ class LimsReport(Report):
         if not image:
             return ''
         b64_image = b64encode(image).decode()
+        if image.lstrip()[:1] == b'<':
+            return 'data:image/svg+xml;base64,%s' % b64_image
         return 'data:image/png;base64,%s' % b64_image
 
     @classmethod
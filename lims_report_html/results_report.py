@@ -550,45 +550,22 @@ class ResultReport(LimsReport, metaclass=PoolMeta):
         current_data['alt_lang'] = results_report.report_language.code
 
         template = results_report.template
-        if template and template.type == 'base':  # HTML
-            result = cls.execute_html_lims_report(ids, current_data)
-        else:
+        if not template or template.type != 'base':
             current_data['action_id'] = None
             if template and template.report:
                 current_data['action_id'] = template.report.id
-            result = cls.execute_custom_lims_report(ids, current_data)
 
-        cached_reports = CachedReport.search([
-            ('version_detail', '=', results_report.id),
-            ('report_language', '=', results_report.report_language.id),
-            ['OR',
-                ('report_cache', '!=', None),
-                ('report_cache_id', '!=', None)],
-            ])
-        if cached_reports:
-            result = (cached_reports[0].report_format,
-                cached_reports[0].report_cache) + result[2:]
+        result = cls._get_cached_result(results_report, current_data)
+        if result:
+            return result
 
+        if template and template.type == 'base':  # HTML
+            result = cls.execute_html_lims_report(ids, current_data)
         else:
-            if current_data.get('save_cache', False):
-                cached_reports = CachedReport.search([
-                    ('version_detail', '=', results_report.id),
-                    ('report_language', '=',
-                        results_report.report_language.id),
-                    ])
-                if cached_reports:
-                    CachedReport.write(cached_reports, {
-                        'report_cache': result[1],
-                        'report_format': result[0],
-                        })
-                else:
-                    CachedReport.create([{
-                        'version_detail': results_report.id,
-                        'report_language': results_report.report_language.id,
-                        'report_cache': result[1],
-                        'report_format': result[0],
-                        }])
-
+            result = cls.execute_custom_lims_report(ids, current_data)
+        if current_data.get('save_cache', False):
+            CachedReport.set_cached_report(results_report,
+                result[0], result[1])
         return result
 
 
@@ -531,8 +531,8 @@ class Service(metaclass=PoolMeta):
 class Service2(metaclass=PoolMeta):
     __name__ = 'lims.service'
 
-    def get_invoice_line(self):
-        invoice_line = super().get_invoice_line()
+    def get_invoice_line(self, cache=None):
+        invoice_line = super().get_invoice_line(cache)
         if not invoice_line:
             return
         if self.sale_lines:
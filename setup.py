@@ -44,8 +44,8 @@ minor_version = int(minor_version)
 # TODO: check new openpyxl versions, v.3 seems to be buggy in PyPI
 requires = ['appdirs', 'Babel', 'Click', 'formulas', 'Jinja2 < 3.1',
     get_require_version('kalenis_user_view'), 'openpyxl==2.6.4', 'matplotlib',
-    'pandas', 'psycopg2', 'PyPDF2 < 2', 'pytz', 'unidecode', 'WeasyPrint',
-    'werkzeug < 2', 'xlrd', 'xlutils']
+    'numpy', 'pandas', 'psycopg2', 'PyPDF2 < 2', 'python-dateutil', 'pytz',
+    'unidecode', 'WeasyPrint', 'werkzeug < 2', 'xlrd', 'xlutils']
 
 
 packages = []